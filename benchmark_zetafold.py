@@ -0,0 +1,41 @@
+#!/usr/bin/python
+from __future__ import print_function
+import argparse
+from zetafold.benchmark import *
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser( description = "Benchmark folding over representative workloads, keep a history, and compare runs for regressions" )
+    subparsers = parser.add_subparsers( dest = 'command' )
+    run_parser = subparsers.add_parser( 'run', help = 'Run benchmarks and append the results to --history' )
+    run_parser.add_argument( "--workloads", nargs = '*', default = None, help = 'Workloads: favorites, contrafold, random_<N>, multistrand, circle [default: %s]' % ' '.join( default_workloads ) )
+    run_parser.add_argument( "--full", action = 'store_true', default = False, help = 'Default workloads plus random_500 and random_1000 (slow!)' )
+    run_parser.add_argument( "--phases", nargs = '*', default = all_phases, choices = all_phases, help = 'Phases to time [default: all]' )
+    run_parser.add_argument( "--engine", type = str, default = 'explicit', choices = engines, help = 'Recursions to use [default: explicit]' )
+    run_parser.add_argument( "-params", "--parameters", type = str, default = '', help = 'Parameter file to use [default: latest]' )
+    run_parser.add_argument( "--max_examples", type = int, default = None, help = 'Use at most this many inputs from each workload' )
+    run_parser.add_argument( "--repeat", type = int, default = 1, help = 'Keep the fastest of this many runs of each phase' )
+    run_parser.add_argument( "--label", type = str, default = None, help = 'Label for this run, to select it in compare' )
+    run_parser.add_argument( "--history", type = str, default = 'benchmark_history.jsonl', help = 'JSON-lines history file [default: benchmark_history.jsonl]' )
+    compare_parser = subparsers.add_parser( 'compare', help = 'Compare two runs from --history, flagging regressions' )
+    compare_parser.add_argument( "base", nargs = '?', default = None, help = 'Records to compare against: commit, label, or run_id, or key=value filters like commit=ab12cd3,engine=simple [default: second most recent run]' )
+    compare_parser.add_argument( "new", nargs = '?', default = None, help = 'Records to compare [default: most recent run]' )
+    compare_parser.add_argument( "--threshold", type = float, default = 0.1, help = 'Flag changes bigger than this fraction [default: 0.1]' )
+    compare_parser.add_argument( "--history", type = str, default = 'benchmark_history.jsonl', help = 'JSON-lines history file [default: benchmark_history.jsonl]' )
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        workloads = args.workloads if args.workloads else ( full_workloads if args.full else default_workloads )
+        run_benchmarks( workloads, args.phases, params = args.parameters, engine = args.engine, history_file = args.history,
+                        label = args.label, max_examples = args.max_examples, repeat = args.repeat )
+        print( 'Appended results to', args.history )
+    else:
+        records = read_history( args.history )
+        new_records = select_records( records, args.new )
+        base_records = select_records( records, args.base, exclude_run_ids = [ record[ 'run_id' ] for record in new_records ] )
+        if not base_records or not new_records:
+            print( 'Could not find records to compare in', args.history )
+            exit( 1 )
+        for ( tag, selected ) in [ ( 'base', base_records ), ( 'new', new_records ) ]:
+            print( '%-4s: %s' % ( tag, ', '.join( sorted( set( '%s [commit %s, engine %s%s]' % ( record[ 'run_id' ], record[ 'commit' ], record[ 'engine' ], ', label %s' % record[ 'label' ] if record[ 'label' ] else '' ) for record in selected ) ) ) ) )
+        regressions = compare_records( base_records, new_records, args.threshold )
+        if regressions: exit( 1 )
@@ -2,12 +2,27 @@
 from __future__ import print_function
 
 import argparse
+import json
+import numpy as np
+import shutil
+import tempfile
 
 #from zetafold.output_helpers import *
 from zetafold.partition import *
 from zetafold.util.output_util import *
 from zetafold.parameters import get_params_from_file
-from zetafold.score_structure import score_structure
+from zetafold.score_structure import score_structure, score_structures
+from zetafold.structure_features import get_structure_features
+from zetafold.data.training_examples import TrainingExample
+from zetafold.data.binary_dataset import write_binary_dataset, BinaryDataset
+from zetafold.partition_cache import cached_partition, PartitionCache
+from zetafold.batch import read_batch_inputs, fold_batch
+from zetafold.server import FoldingServer, Job
+from zetafold.util.import_time import get_import_times, get_unneeded_modules
+from zetafold.deriv_check import get_numerical_log_derivs, show_deriv_check
+from zetafold.benchmark import run_benchmarks, read_history, select_records, compare_records, get_workload, get_structures
+from zetafold.adjoint import _get_log_derivs_adjoint, get_parameter_slots, ParameterMonomial
+from zetafold.training import bfgs_minimize
 
 def test_zetafold( verbose = False, use_simple_recursions = False ):
 
@@ -218,11 +233,60 @@ def test_zetafold( verbose = False, use_simple_recursions = False ):
     # test secstruct
     assert( secstruct_from_bps( [(0,5),(1,4)],7 ) == '((..)).' )
     assert( bps_from_secstruct(  '((..)).' ) == [(0,5),(1,4)] )
+    assert( pair_tables_from_secstructs( [ '((..)).', '.(...).' ] ).tolist() == [ [5,4,-1,-1,1,0,-1], [-1,5,-1,-1,-1,1,-1] ] )
+    assert( pair_tables_from_secstructs( [] ).shape == ( 0, 0 ) )
+    assert( zip( *get_allow_base_pair_mask( pair_table_from_secstruct( '.(.).' ), allow_extra_base_pairs = True ).nonzero() ) == [ (0,0), (0,4), (1,3), (2,2), (3,1), (4,0), (4,4) ] )
     assert( parse_motifs( '.(((.)(.))).' ) == [[[1, 2], [9, 10]], [[2, 3], [5, 6], [8, 9]], [[3, 4, 5]], [[6, 7, 8]], [[10, 11, 0, 1]]] )
     assert( parse_motifs( '(((.)(.))).'  ) == [[[0, 1], [8, 9]], [[1, 2], [4, 5], [7, 8]], [[2, 3, 4]], [[5, 6, 7]], [[9, 10, 0]]] )
     assert( parse_motifs( '.(((.)(.)))'  ) == [[[1, 2], [9, 10]], [[2, 3], [5, 6], [8, 9]], [[3, 4, 5]], [[6, 7, 8]], [[10, 0, 1]]] )
     assert( parse_motifs( '(((.)(.)))'   ) == [[[0, 1], [8, 9]], [[1, 2], [4, 5], [7, 8]], [[2, 3, 4]], [[5, 6, 7]], [[9, 0]]] )
 
+    print( 'Check binary training dataset round trip' )
+    dataset_dir = tempfile.mkdtemp()
+    examples = [ TrainingExample( 'hairpin', 'GGGGAAACCCC', '((((...))))' ), TrainingExample( 'duplex', 'GCAACG CGAAGC', '((..(( ))..))', '(..... .....)' ) ]
+    write_binary_dataset( dataset_dir, examples, [ ( 'both', [ 'duplex', 'hairpin' ] ) ] )
+    dataset = BinaryDataset( dataset_dir )
+    for ( example, dataset_example ) in zip( examples[::-1], dataset.get_training_examples( 'both' ) ):
+        assert( ( dataset_example.name, dataset_example.sequence, dataset_example.structure, dataset_example.force_base_pairs ) == ( example.name, example.sequence, example.structure, example.force_base_pairs ) )
+        assert( np.array_equal( dataset_example.pair_table, example.pair_table ) )
+        assert( ( dataset_example.force_pair_table is None ) == ( example.force_pair_table is None ) )
+        if example.force_pair_table is not None: assert( np.array_equal( dataset_example.force_pair_table, example.force_pair_table ) )
+    duplex = dataset.get_training_examples( 'both' )[ 0 ]
+    p = partition( duplex.sequence, params = 'minimal', structure = duplex.force_pair_table, suppress_all_output = True )
+    assert_equal( p.Z, partition( duplex.sequence, params = 'minimal', structure = duplex.force_base_pairs, suppress_all_output = True ).Z )
+    assert( p.structure == None and np.array_equal( p.structure_pair_table, duplex.force_pair_table ) )
+    assert_equal( score_structure( duplex.sequence, duplex.pair_table, params = 'minimal' ), score_structure( duplex.sequence, duplex.structure, params = 'minimal' ) )
+    shutil.rmtree( dataset_dir )
+
+    print( 'Check cached partition results, in memory and on disk' )
+    cache_dir = tempfile.mkdtemp()
+    sequences = [ 'GCAACG', 'CGAAGC' ]
+    p = partition( sequences, params = 'minimal', calc_bpp = True, mfe = True, suppress_all_output = True )
+    for n in range( 2 ):
+        cache = PartitionCache( cache_dir ) # second time around, starts empty in memory but finds result on disk
+        result = cached_partition( sequences, params = 'minimal', calc_bpp = True, mfe = True, cache = cache, bpp_cutoff = 0.0 )
+        assert( cached_partition( sequences, params = 'minimal', calc_bpp = True, mfe = True, cache = cache, bpp_cutoff = 0.0 ) is result )
+        assert( ( cache.hits, cache.misses ) == ( 1 + n, 1 - n ) )
+        assert_equal( result.Z, p.Z )
+        assert( result.struct_MFE == p.struct_MFE )
+        for (bpp_row, bpp_row_ref) in zip( result.get_bpp_matrix(), p.bpp ):
+            for (bpp_ij, bpp_ij_ref) in zip( bpp_row, bpp_row_ref ): assert( bpp_ij == bpp_ij_ref )
+    assert( cached_partition( sequences, params = 'minimal', circle = True, cache = cache ) is not result )
+    shutil.rmtree( cache_dir )
+
+    print( 'Check batch folding of FASTA and tab-separated inputs' )
+    fasta_lines = [ '>hairpin', 'GGGGAAA', 'CCCC', '((((...))))', '>duplex', 'GCAACG+CGAAGC' ]
+    tsv_lines = [ '# name, sequences, circle, structure', 'hairpin\tGGGGAAACCCC\t0\t((((...))))', 'duplex\tGCAACG CGAAGC' ]
+    options = { 'mfe': True, 'bpp': False, 'bpp_cutoff': 0.0, 'allow_extra_base_pairs': False, 'deriv_params': None, 'deriv_method': 'analytic' }
+    for lines in [ fasta_lines, tsv_lines ]:
+        batch_inputs = list( read_batch_inputs( lines ) )
+        records = [ json.loads( record ) for record in fold_batch( batch_inputs, get_params_from_file( 'minimal' ), options ) ]
+        assert( [ record[ 'name' ] for record in records ] == [ 'hairpin', 'duplex' ] )
+        for ( batch_input, record ) in zip( batch_inputs, records ):
+            p = partition( batch_input.sequences, structure = batch_input.structure, params = 'minimal', mfe = True, suppress_all_output = True )
+            assert_equal( record[ 'Z' ], p.Z )
+            assert( record[ 'mfe' ] == p.struct_MFE )
+
     # score_structure
     sequence = 'GCUCAGUUGGGAGAGC'
     structure= '((((........))))'
@@ -238,7 +302,53 @@ def test_zetafold( verbose = False, use_simple_recursions = False ):
     print("Check also double-sequence and double structure get 2*Z", dG_new, 2*dG)
     assert_equal( dG_new, 2*dG )
 
+    print( 'Check batch scoring of several structures (with shared motifs) against score_structure' )
+    structures = [ structure, structure.replace( '(((((.......)))))', '.................' ), structure.replace( '(((((.......))))).', '..................' ) ]
+    deriv_params = [ 'l', 'C_init', 'Kd_CG' ]
+    ( dGs, log_derivs_all ) = score_structures( sequence, structures, deriv_params = deriv_params )
+    for (structure_n, dG, log_derivs) in zip( structures, dGs, log_derivs_all ):
+        ( dG_ref, log_derivs_ref ) = score_structure( sequence, structure_n, deriv_params = deriv_params )
+        assert_equal( dG, dG_ref )
+        for (log_deriv, log_deriv_ref) in zip( log_derivs, log_derivs_ref ): assert_equal( log_deriv, log_deriv_ref )
+    ( dGs, log_derivs_all ) = score_structures( sequence, [], deriv_params = deriv_params )
+    assert( dGs.shape == ( 0, ) and log_derivs_all.shape == ( 0, len( deriv_params ) ) and score_structures( sequence, [] ).shape == ( 0, ) )
+
     print()
+    print( 'Check folding server batches score and fold requests' )
+    folding_server = FoldingServer( get_params_from_file( 'minimal' ), batch_window = 0.05 )
+    ( sequence, structure ) = ( 'GGGGAAACCCC', '((((...))))' )
+    jobs = [ folding_server.submit( 'score', { 'sequences': sequence, 'structures': [ structure ] } ),
+             folding_server.submit( 'score', { 'sequences': sequence, 'structure': structure } ),
+             folding_server.submit( 'fold', { 'sequences': sequence, 'mfe': True } ),
+             folding_server.submit( 'fold', { 'sequences': sequence, 'mfe': True } ) ]
+    for job in jobs: job.done.wait()
+    assert( folding_server.num_batches == 1 )
+    dG = score_structure( sequence, structure, params = 'minimal' )
+    for job in jobs[:2]: assert_equal( job.result[ 'dG' ][ 0 ], dG )
+    p = partition( sequence, params = 'minimal', mfe = True, suppress_all_output = True )
+    for job in jobs[2:]: assert( ( job.result[ 'dG' ], job.result[ 'mfe' ] ) == ( p.dG, p.struct_MFE ) )
+    # a malformed structure only fails its own request, not others batched with it
+    jobs = [ folding_server.submit( 'score', { 'sequences': sequence, 'structure': structure } ),
+             folding_server.submit( 'score', { 'sequences': sequence, 'structure': '((((...)))' } ) ]
+    for job in jobs: job.done.wait()
+    assert( folding_server.num_batches == 2 )
+    assert_equal( jobs[ 0 ].result[ 'dG' ][ 0 ], dG )
+    assert( 'error' in jobs[ 1 ].result )
+    # results that nobody fetches are dropped after result_ttl
+    assert( folding_server.pop_job( jobs[ 0 ].job_id ) is jobs[ 0 ] and len( folding_server.jobs ) == 5 )
+    folding_server.result_ttl = 0.0
+    folding_server.get_status()
+    assert( len( folding_server.jobs ) == 0 )
+    # with worker processes, timing starts when a worker picks up the job, and a lost task (dead worker) times out with an error
+    folding_server = FoldingServer( get_params_from_file( 'minimal' ), jobs = 2, timeout = 0.5 )
+    job = folding_server.submit( 'fold', { 'sequences': sequence, 'mfe': True } )
+    job.done.wait( 10.0 )
+    assert( job.result[ 'mfe' ] == p.struct_MFE and job.submit_time <= job.start_time <= job.finish_time )
+    job = Job( 'lost', 'fold', {} )
+    folding_server.wait_for_batch( folding_server.pool.map_async( os._exit, [ 1 ] ), None, [ job ] )
+    assert( job.done.is_set() and 'error' in job.result )
+    folding_server.pool.terminate()
+
     print( 'Do deriv-check on small but complex case' )
     sequence = 'GCUCAGUGAGAGC'
     print("Testing score_structure on short sequence, full parameters with AA added in for good measure: ", sequence, structure)
@@ -247,6 +357,202 @@ def test_zetafold( verbose = False, use_simple_recursions = False ):
     params.set_parameter( 'C_eff_stack_CG_AA', 100000 )
     dG = partition( sequence, deriv_check=True, params = params  ) # deriv_check runs asserts
 
+    print()
+    print( 'Check adjoint (reverse-mode) and forward-mode derivs against analytic derivs' )
+    for (sequence, structure) in [ ('GCUCAGUGAGAGC',None), (['GCAACG','CGAAGC'],None), ('GCUCAGUUGGGAGAGCAA','((((........))))..') ]:
+        p         = partition( sequence, structure = structure, allow_extra_base_pairs = True, params = params, deriv_params = [], suppress_all_output = True, use_simple_recursions = use_simple_recursions )
+        p_adjoint = partition( sequence, structure = structure, allow_extra_base_pairs = True, params = params, deriv_params = [], suppress_all_output = True, use_simple_recursions = use_simple_recursions, deriv_method = 'adjoint' )
+        p_forward = partition( sequence, structure = structure, allow_extra_base_pairs = True, params = params, deriv_params = [], suppress_all_output = True, use_simple_recursions = use_simple_recursions, deriv_method = 'forward' )
+        assert_equal( p.Z, p_adjoint.Z )
+        assert_equal( p.Z, p_forward.Z )
+        for log_deriv, log_deriv_adjoint, log_deriv_forward in zip( p.log_derivs, p_adjoint.log_derivs, p_forward.log_derivs ):
+            if abs( log_deriv ) > 1.0e-8:
+                assert_equal( log_deriv_adjoint, log_deriv )
+                assert_equal( log_deriv_forward, log_deriv )
+            else:
+                assert( abs( log_deriv_adjoint ) < 1.0e-8 )
+                assert( abs( log_deriv_forward ) < 1.0e-8 )
+
+    print( 'Check parameters are put back if the adjoint sweep is interrupted' )
+    def interrupt( *args ): raise KeyboardInterrupt
+    p_adjoint.Z_final.get_contribs = p_adjoint.Z_final.update_func = interrupt
+    try:
+        _get_log_derivs_adjoint( p_adjoint, [] )
+        assert( False )
+    except KeyboardInterrupt: pass
+    assert( not any( isinstance( d[ key ], ParameterMonomial ) for (d,key) in get_parameter_slots( params ) ) )
+    assert( not any( isinstance( weight, ParameterMonomial ) for weight in p_adjoint.compiled.loop_weight ) )
+    assert( not p_adjoint.options.calc_adjoint )
+    p_again = partition( sequence, structure = structure, allow_extra_base_pairs = True, params = params, deriv_params = [], suppress_all_output = True, use_simple_recursions = use_simple_recursions, deriv_method = 'adjoint' )
+    assert_equal( p_again.Z, p.Z )
+    for log_deriv_again, log_deriv_adjoint in zip( p_again.log_derivs, p_adjoint.log_derivs ): assert_equal( log_deriv_again, log_deriv_adjoint )
+
+    print( 'Check Hessian-vector product of log Z against finite difference of adjoint derivs' )
+    sequence = 'GCAACGCGAAGC'
+    deriv_parameters = [ 'l', 'l_BP', 'C_init', 'Kd_CG', 'C_eff_stack_CG_CG', 'K_coax' ]
+    hessian_vector = [ 0.3, -0.5, 0.7, 0.2, -0.4, 0.6 ]
+    p = partition( sequence, circle = True, params = params, deriv_params = deriv_parameters, hessian_vector = hessian_vector, suppress_all_output = True, use_simple_recursions = use_simple_recursions )
+    save_vals = [ params.get_parameter_value( parameter ) for parameter in deriv_parameters ]
+    epsilon = 1.0e-5
+    log_derivs_shift = []
+    for sign in [ 1, -1 ]:
+        for parameter,save_val,v in zip( deriv_parameters, save_vals, hessian_vector ): params.set_parameter( parameter, save_val * exp( sign * epsilon * v ) )
+        log_derivs_shift.append( partition( sequence, circle = True, params = params, deriv_params = deriv_parameters, deriv_method = 'adjoint', suppress_all_output = True ).log_derivs )
+        for parameter,save_val in zip( deriv_parameters, save_vals ): params.set_parameter( parameter, save_val )
+    for n,parameter in enumerate( deriv_parameters ):
+        assert_equal( p.log_derivs_hessian_vector[ n ], ( log_derivs_shift[0][n] - log_derivs_shift[1][n] ) / ( 2 * epsilon ) )
+
+    print( 'Check several Hessian-vector products from one fold' )
+    hessian_vectors = [ hessian_vector, [ 1.0, 0.0, 0.0, 0.0, 0.0, -1.0 ] ]
+    p_vectors = partition( sequence, circle = True, params = params, deriv_params = deriv_parameters, hessian_vector = hessian_vectors, suppress_all_output = True, use_simple_recursions = use_simple_recursions )
+    for vector,products in zip( hessian_vectors, p_vectors.log_derivs_hessian_vector ):
+        p_vector = partition( sequence, circle = True, params = params, deriv_params = deriv_parameters, hessian_vector = vector, suppress_all_output = True, use_simple_recursions = use_simple_recursions )
+        for n,parameter in enumerate( deriv_parameters ): assert_equal( products[ n ], p_vector.log_derivs_hessian_vector[ n ] )
+
+    print( 'Check score from compiled structure feature counts against score_structure' )
+    for (sequence, structure) in [ ('GGGGAAACCCCAUCCGAAAGGAUGGG','((((...))))((((....))))...'), (['GCAACG','CGAAGC'],'(((((( ))))))') ]:
+        features = get_structure_features( sequence, structure, params, deriv_parameters )
+        params.set_parameter( 'l', 2.0 * params.l ) # make sure scores follow parameter changes
+        ( dG, log_derivs, log_derivs_hessian_vector ) = score_structure( sequence, structure, params = params, deriv_params = deriv_parameters, hessian_vector = hessian_vector )
+        ( dG_features, log_derivs_features, log_derivs_hessian_vector_features ) = features.score( params, True, hessian_vector )
+        params.set_parameter( 'l', 0.5 * params.l )
+        assert_equal( dG_features, dG )
+        for n,parameter in enumerate( deriv_parameters ):
+            assert_equal( log_derivs_features[ n ], log_derivs[ n ] )
+            if abs( log_derivs_hessian_vector[ n ] ) > 1.0e-8:
+                assert_equal( log_derivs_hessian_vector_features[ n ], log_derivs_hessian_vector[ n ] )
+            else:
+                assert( abs( log_derivs_hessian_vector_features[ n ] ) < 1.0e-8 )
+        log_derivs_hessian_vectors = score_structure( sequence, structure, params = params, deriv_params = deriv_parameters, hessian_vector = hessian_vectors )[ 2 ]
+        log_derivs_hessian_vectors_features = features.score( params, True, hessian_vectors )[ 2 ]
+        for products,products_features in zip( log_derivs_hessian_vectors, log_derivs_hessian_vectors_features ):
+            for n,parameter in enumerate( deriv_parameters ):
+                if abs( products[ n ] ) > 1.0e-8: assert_equal( products_features[ n ], products[ n ] )
+                else: assert( abs( products_features[ n ] ) < 1.0e-8 )
+
+    print( 'Do deriv-check with adjoint and forward-mode derivs on circle and on motif, which have no analytic expressions' )
+    for deriv_method in [ 'adjoint', 'forward' ]:
+        p = partition( 'GCAACGCGAAGC', circle = True, deriv_check = True, deriv_method = deriv_method, params = params, suppress_all_output = True, use_simple_recursions = use_simple_recursions )
+    params = get_params_from_file( 'minimal' )
+    params.set_parameter( 'K_coax', 0.0 )
+    params.set_parameter( 'C_eff_motif_startbpCG_strandCG_bpGC_strandCAG_bpGC', 10.0 )
+    for deriv_method in [ 'adjoint', 'forward' ]:
+        p = partition( ['CG','CAG'], deriv_check = True, deriv_method = deriv_method, params = params, suppress_all_output = True, use_simple_recursions = use_simple_recursions )
+
+    print( 'Check central-difference derivs from a process pool against adjoint derivs, and one-sided ones in this process' )
+    p = partition( 'GCAACGCGAAGC', circle = True, deriv_params = [], deriv_method = 'adjoint', params = 'minimal', suppress_all_output = True, use_simple_recursions = use_simple_recursions )
+    numerical_log_derivs = get_numerical_log_derivs( p, p.deriv_params, jobs = 2, central = True )
+    numerical_log_derivs_one_sided = get_numerical_log_derivs( p, p.deriv_params )
+    relative_errors = show_deriv_check( p.deriv_params, p.log_derivs, numerical_log_derivs, 'd(logZ)/d(log parameter)' )
+    for ( log_deriv, numerical_log_deriv, numerical_log_deriv_one_sided, relative_error ) in zip( p.log_derivs, numerical_log_derivs, numerical_log_derivs_one_sided, relative_errors ):
+        if abs( log_deriv ) > 0.001:
+            assert( relative_error < 1.0e-6 )
+            assert_equal( numerical_log_deriv, log_deriv, 1.0e-6 )
+            assert_equal( numerical_log_deriv_one_sided, log_deriv, 1.0e-3 )
+
+    print( 'Check parameters loaded from the same file are independent copies, with matching fingerprints' )
+    params = get_params_from_file( 'minimal' )
+    params_copy = get_params_from_file( 'minimal' )
+    assert( params.get_fingerprint() == params_copy.get_fingerprint() )
+    Kd = params.base_pair_types[0].Kd
+    params_copy.set_parameter( 'Kd_' + params.base_pair_types[0].get_tag(), 2.0 * Kd )
+    params_copy.set_parameter( 'C_eff_stacked_pair', 2.0 )
+    assert( params.get_fingerprint() != params_copy.get_fingerprint() )
+    assert( params.base_pair_types[0].Kd == Kd and params_copy.base_pair_types[0].Kd == 2.0 * Kd )
+    assert( params.get_fingerprint() == get_params_from_file( 'minimal' ).get_fingerprint() )
+    assert( params.get_fingerprint() == params.copy().get_fingerprint() )
+
+    print( 'Check compiled parameter products are rebuilt after set_parameter' )
+    params = get_params_from_file( 'minimal' )
+    compiled = params.get_compiled()
+    assert( params.get_compiled() is compiled )
+    params.set_parameter( 'l', 2.0 * params.l )
+    compiled = params.get_compiled()
+    for (q,base_pair_type) in enumerate( params.base_pair_types ):
+        assert_equal( compiled.loop_weight[ q ], params.l**2 * params.l_BP / base_pair_type.Kd )
+        for (q2,base_pair_type2) in enumerate( params.base_pair_types ):
+            assert_equal( compiled.stack_weight[ q ][ q2 ], params.C_eff_stack[ base_pair_type ][ base_pair_type2 ] / base_pair_type.Kd )
+
+    print( 'Check base pair probability output formats read back the same' )
+    p = partition( 'GGGGAAACCCC', params = 'minimal', calc_bpp = True, suppress_all_output = True )
+    bpp_dir = tempfile.mkdtemp()
+    bpp = np.array( p.bpp )
+    for ( bpp_file, bpp_format ) in [ ( 'bpp.txt', None ), ( 'bpp.sparse.txt', 'sparse' ), ( 'bpp.npy', None ), ( 'bpp.npz', None ) ]:
+        bpp_file = os.path.join( bpp_dir, bpp_file )
+        write_bpp( p.bpp, bpp_file, bpp_format, bpp_cutoff = 1.0e-3 )
+        bpp_read = read_bpp( bpp_file )
+        if get_bpp_format( bpp_file, bpp_format ) in ( 'sparse', 'npz' ): assert( np.allclose( bpp_read, np.where( bpp > 1.0e-3, bpp, 0.0 ) ) )
+        else: assert( np.allclose( bpp_read, bpp ) )
+    matrix_lines = [ ''.join( ' %25.12f' % bpp_ij for bpp_ij in bpp_i ) + '\n' for bpp_i in p.bpp ]
+    assert( open( os.path.join( bpp_dir, 'bpp.txt' ) ).readlines() == matrix_lines )
+    shutil.rmtree( bpp_dir )
+
+    print( 'Check production mode (one Z_final and one backtrack, plus spot checks) gives the same results as validation' )
+    sequence = 'GCGGAUUUAGCUCAGUUGGGAGAGCGCCAGACUGAAGAUCUGGAGGUCCUGUGUUCGAUCCACAGAAUUCGCACCA'
+    p = partition( sequence, mfe = True, calc_bpp = True, deriv_params = [], suppress_all_output = True, use_simple_recursions = use_simple_recursions )
+    for n_spot_check in [ 0, 5 ]:
+        p_production = partition( sequence, mfe = True, calc_bpp = True, deriv_params = [], suppress_all_output = True, use_simple_recursions = use_simple_recursions, production = True, n_spot_check = n_spot_check )
+        assert( len( p_production.check_positions ) == 1 + n_spot_check and len( set( p_production.check_positions ) ) == 1 + n_spot_check )
+        assert( p_production.Z == p.Z and p_production.bpp == p.bpp and p_production.struct_MFE == p.struct_MFE and p_production.log_derivs == p.log_derivs )
+
+    print( 'Check benchmark records go into the history, and compare flags regressions' )
+    history_dir = tempfile.mkdtemp()
+    history_file = os.path.join( history_dir, 'benchmark_history.jsonl' )
+    for label in [ 'base', 'new' ]:
+        records = run_benchmarks( [ 'random_20', 'circle' ], [ 'Z', 'mfe' ], params = 'minimal', history_file = history_file, label = label, max_examples = 1, verbose = False )
+    assert( [ ( record[ 'workload' ], record[ 'phase' ] ) for record in records ] == [ ( 'random_20', 'Z' ), ( 'random_20', 'mfe' ), ( 'circle', 'Z' ), ( 'circle', 'mfe' ) ] )
+    assert( records[ 0 ][ 'num_nt' ] == 20 and records[ 0 ][ 'wall_time' ] > 0 and records[ 0 ][ 'peak_memory_mb' ] > 0 )
+    history = read_history( history_file )
+    assert( len( history ) == 8 and select_records( history ) == history[ 4: ] and select_records( history, 'base' ) == history[ :4 ] )
+    assert( compare_records( history[ :4 ], history[ 4: ], threshold = 1.0e6, verbose = False ) == [] )
+    slower_records = [ dict( record, wall_time = 2 * record[ 'wall_time' ] ) for record in history[ :4 ] ]
+    assert( [ regression[ 2 ] for regression in compare_records( history[ :4 ], slower_records, verbose = False ) ] == [ 'wall_time' ] * 4 )
+    shutil.rmtree( history_dir )
+    # MFE to score for inputs without a reference structure is found before the measured process
+    sequences = get_workload( 'random_20', 1 )[ 0 ].sequences
+    assert( get_structures( 'random_20', 'minimal', 'explicit', 1 ) == [ partition( sequences, params = 'minimal', mfe = True, suppress_all_output = True ).struct_MFE ] )
+    records = run_benchmarks( [ 'random_20' ], [ 'score_structure' ], params = 'minimal', max_examples = 1, verbose = False )
+    assert( records[ 0 ][ 'phase' ] == 'score_structure' and records[ 0 ][ 'wall_time' ] > 0 )
+
+    print( 'Check recursion stats count calls and terms, without changing results' )
+    sequence = 'GGGGAAACCCCAAGGGGAAACCCC'
+    p = partition( sequence, params = 'minimal', suppress_all_output = True, use_simple_recursions = use_simple_recursions )
+    p_stats = partition( sequence, params = 'minimal', calc_stats = True, suppress_all_output = True, use_simple_recursions = use_simple_recursions )
+    assert( p.stats == None and p_stats.Z == p.Z )
+    assert( p_stats.stats.get_function_stats( 'update_Z_BPq' )[ 0 ] == len( p.params.base_pair_types ) * p.N * ( p.N - 1 ) / 2 )
+    assert( p_stats.stats.get_term_stats( 'update_Z_BPq', 'stacked pair' )[ 0 ] == 36 )
+    assert( p_stats.stats.get_term_stats( 'update_Z_BPq', '"left stack"' )[ :2 ] == ( 960, 960 ) )
+    assert( p_stats.stats.get_term_stats( 'update_Z_BP', 'any base pair type' )[ 0 ] > 0 )
+    assert( not any( 'could also use' in term[ 1 ] for term in p_stats.stats.terms ) )
+    params = get_params_from_file( 'minimal' )
+    params.set_parameter( 'K_coax', 0.0 )
+    params.set_parameter( 'C_eff_motif_startbpCG_strandCG_bpGC_strandCAG_bpGC', 10.0 )
+    p_stats = partition( ['CG','CAG'], params = params, calc_stats = True, suppress_all_output = True, use_simple_recursions = use_simple_recursions )
+    assert( p_stats.stats.get_term_stats( 'update_Z_BPq', 'motif' )[ 0 ] == 1 )
+
+    print( 'Check BFGS matches scipy, and picks up where it left off from a checkpointed state' )
+    from scipy.optimize import minimize, rosen, rosen_der
+    import cPickle as pickle
+    rosen_and_der = lambda x: ( rosen( x ), rosen_der( x ) )
+    x0 = [ -1.2, 1.0, 0.5 ]
+    result_scipy = minimize( rosen_and_der, x0, method = 'BFGS', jac = True )
+    result = bfgs_minimize( rosen_and_der, x0, jac = True )
+    assert( result.nit == result_scipy.nit and np.array_equal( result.x, result_scipy.x ) and np.array_equal( result.hess_inv, result_scipy.hess_inv ) )
+    saved_states = []
+    def checkpoint( state ):
+        saved_states.append( pickle.dumps( state ) )
+        if state[ 'iteration' ] == 10: raise KeyboardInterrupt # run dies
+    try: bfgs_minimize( rosen_and_der, x0, jac = True, checkpoint = checkpoint )
+    except KeyboardInterrupt: pass
+    result_resumed = bfgs_minimize( rosen_and_der, None, jac = True, state = pickle.loads( saved_states[ -1 ] ) )
+    assert( result_resumed.nit == result.nit and np.array_equal( result_resumed.x, result.x ) )
+    assert( bfgs_minimize( rosen_and_der, None, jac = True, state = dict( pickle.loads( saved_states[ -1 ] ), maxiter = 12 ) ).nit == 12 ) # budget carries over
+
+    print( 'Check importing zetafold.partition does not load modules that folding does not need' )
+    import_times = get_import_times( 'zetafold.partition' )
+    assert( 'zetafold.partition' in [ module for ( module, self_time, cumulative, depth ) in import_times ] )
+    assert( get_unneeded_modules( import_times ) == [] )
+
 
 if __name__=='__main__':
     parser = argparse.ArgumentParser( description = "Test nearest neighbor model partitition function for RNA sequence" )
@@ -2,17 +2,17 @@
 from __future__ import print_function
 from zetafold.parameters import get_params
 from zetafold.data.training_examples import *
+from zetafold.data.binary_dataset import get_binary_dataset
 from zetafold.training import *
 from scipy.optimize import minimize
 import numpy as np
-from multiprocessing import Pool
 import math
 import argparse
-import __builtin__
 
 parser = argparse.ArgumentParser( description = "Test nearest neighbor model partitition function for RNA sequence" )
 parser.add_argument("-params","--parameters", type=str, help='Parameter file to use [default: use latest zetafold version]')
 parser.add_argument("--train_data", type=str, help="Training data to use. Give none to get list.")
+parser.add_argument("--dataset", type=str, help="Binary dataset directory (from zetafold/data/binary_dataset.py) with training data [default: text files in zetafold/data]")
 parser.add_argument("--train_params", help="Parameters to optimize. Give none to get list.", nargs='*')
 parser.add_argument("--train_params_exclude", help="Parameters to optimize. Give none to get list.", nargs='*')
 parser.add_argument("--jobs","-j", type=int, default=4, help='Number of jobs to run in parallel')
@@ -23,10 +23,22 @@ parser.add_argument("--init_params",help="Initial values for parameters (default
 parser.add_argument("--init_log_params",help="Initial values for log parameters (alternative to init_params)",nargs='*')
 parser.add_argument("--no_coax", action='store_true', default=False, help='Turn off coaxial stacking')
 parser.add_argument("--deriv_check", action='store_true', default=False, help='Run numerical vs. analytical deriv check')
+parser.add_argument("--central_differences", action='store_true', default=False, help='Use central rather than one-sided differences in --deriv_check (twice the runs, much smaller error)')
 parser.add_argument("--allow_extra_base_pairs",action='store_true',default=False, help='allow extra base pairs compatible with --structure')
 parser.add_argument("--use_priors",action='store_true', help='add priors to force log parameters to stay in reasonable bounds.')
 parser.add_argument("--use_bounds",action='store_true', help='force log parameters to stay in reasonable bounds; not applied to BFGS')
-parser.add_argument("--method",type=str,default='BFGS',help="Minimization routine")
+parser.add_argument("--method",type=str,default='BFGS',help="Minimization routine. Newton-CG, trust-ncg, and trust-krylov also use the Hessian (require --use_derivs), which takes one more pass at each iterate, at about 5x the cost of a gradient pass -- e.g., for C_init and l on tRNA, trust-ncg took 6 gradient and 5 Hessian passes (31 s) and Newton-CG 9 and 8 (44 s), vs. 10 gradient passes (11 s) for BFGS. SGD and Adam are minibatch stochastic optimizers (see below).")
+parser.add_argument("--minibatch_size",type=int,default=10,help="Number of training examples per step for SGD/Adam")
+parser.add_argument("--learning_rate",type=float,default=0.1,help="Step size in log parameters for SGD/Adam")
+parser.add_argument("--lr_decay",type=float,default=0.0,help="Learning rate at step t is learning_rate/(1 + lr_decay*t) for SGD/Adam")
+parser.add_argument("--num_steps",type=int,default=100,help="Maximum number of steps for SGD/Adam")
+parser.add_argument("--validation_data", type=str, help="Held-out training set to track convergence with SGD/Adam")
+parser.add_argument("--validate_every",type=int,default=10,help="Steps between evaluations of --validation_data")
+parser.add_argument("--patience",type=int,default=None,help="Stop SGD/Adam after this many validation evaluations without improvement")
+parser.add_argument("--seed",type=int,default=0,help="Random seed for choosing minibatches")
+parser.add_argument("--checkpoint",type=str,default='checkpoint.pkl',help="Binary file for saving training state")
+parser.add_argument("--checkpoint_every",type=int,default=1,help="Iterations between checkpoints")
+parser.add_argument("--resume", action='store_true', default=False, help='Resume training from --checkpoint. BFGS, SGD, and Adam pick up where they left off; other (scipy) methods keep no state, so they restart from the saved parameters, with a fresh iteration budget')
 args     = parser.parse_args()
 
 # set up parameter file
@@ -34,11 +46,18 @@ params = get_params( args.parameters, suppress_all_output = True )
 if args.no_coax: params.set_parameter( 'K_coax', 0.0 )
 
 # set up training examples
+if args.dataset:
+    dataset = get_binary_dataset( args.dataset )
+    ( training_sets, training_set_names, get_training_examples ) = ( dataset.training_sets, dataset.training_set_names, dataset.get_training_examples )
 if args.train_data == None or not args.train_data in training_sets.keys():
     print( '\nMust specify --train_data. Options are:' )
     for set_name in training_set_names:  print( '%30s (%s)' % (set_name,len(training_sets[set_name]) ) )
     exit()
-training_examples = [ all_training_examples[ tag ] for tag in training_sets[ args.train_data ] ]
+training_examples = get_training_examples( args.train_data )
+validation_examples = []
+if args.validation_data:
+    assert( args.validation_data in training_sets.keys() )
+    validation_examples = get_training_examples( args.validation_data )
 
 train_parameters = args.train_params
 if train_parameters == None:
@@ -67,20 +86,48 @@ else:
         if val == 0.0:  x0[ n ] = -np.Inf # to achieve 0
         else: x0[ n ] = np.log( val )
 
-pool = __builtin__
-if args.jobs > 1: pool = Pool( args.jobs )
+pool = TrainingPool( args.jobs, params, train_parameters, training_examples, args.allow_extra_base_pairs, validation_examples )
 
 priors = get_priors( train_parameters) if args.use_priors else None
-loss = lambda x:free_energy_gap(      x,params,train_parameters,training_examples,args.allow_extra_base_pairs,priors,pool,args.outfile)
-grad = lambda x:free_energy_gap_deriv(x,params,train_parameters,training_examples,args.allow_extra_base_pairs,priors,pool)
-jac = grad if args.use_derivs else None
+loss = lambda x:free_energy_gap(      x,params,train_parameters,priors,pool,args.outfile)
+grad = lambda x:free_energy_gap_deriv(x,params,train_parameters,priors,pool)
+loss_and_grad = MemoizeLastX( lambda x:free_energy_gap_and_deriv(x,params,train_parameters,priors,pool,args.outfile) )
+# the minimizer asks for several Hessian-vector products at each x, so get the whole Hessian once per x.
+hessian = MemoizeLastX( lambda x:free_energy_gap_hessian(x,params,train_parameters,priors,pool) )
+hessp = lambda x,v:np.dot( hessian(x), v )
+# with derivatives, get loss and gradient from a single pass through the training examples (jac = True)
+(fun,jac) = (loss_and_grad,True) if args.use_derivs else (loss,None)
+if not args.method in ['Newton-CG','trust-ncg','trust-krylov']: hessp = None
+elif not args.use_derivs:
+    print( '\nMust specify --use_derivs with --method %s' % args.method )
+    exit()
 bounds = None
 if args.use_bounds: bounds = get_bounds( train_parameters )
-if args.deriv_check: train_deriv_check( x0, loss, grad, train_parameters )
+losses = lambda xs:free_energy_gaps(xs,params,train_parameters,priors,pool)
+if args.deriv_check: train_deriv_check( x0, loss, grad, train_parameters, losses = losses, central = args.central_differences )
+
+checkpoint = TrainingCheckpoint( args.checkpoint, args.method, train_parameters, args.checkpoint_every )
+optimizer_state = None
+if args.resume:
+    x0 = checkpoint.resume()[ 'x' ]
+    optimizer_state = checkpoint.state[ 'optimizer_state' ]
+    if not args.method in [ 'BFGS', 'SGD', 'Adam' ]: print( 'Method %s keeps no optimizer state, so it restarts from the saved parameters.' % args.method )
+else:
+    create_outfile( args.outfile, params, train_parameters )
 
-create_outfile( args.outfile, params, train_parameters )
-result = minimize( loss, x0, method = args.method, jac = jac, bounds = bounds )
-final_loss = loss( result.x )
+if args.method in ['SGD','Adam']:
+    minibatch_loss_and_grad = lambda x,examples:minibatch_free_energy_gap_and_deriv(x,params,train_parameters,priors,pool,examples)
+    validation_loss = ( lambda x:validation_free_energy_gap(x,pool) ) if validation_examples else None
+    result = stochastic_minimize( minibatch_loss_and_grad, x0, len( training_examples ), method = args.method,
+                                  minibatch_size = args.minibatch_size, learning_rate = args.learning_rate, lr_decay = args.lr_decay,
+                                  num_steps = args.num_steps, bounds = bounds, validation_loss = validation_loss,
+                                  validate_every = args.validate_every, patience = args.patience, seed = args.seed, outfile = args.outfile,
+                                  state = optimizer_state, checkpoint = lambda state:checkpoint.update( state['x'], state ) )
+elif args.method == 'BFGS':
+    result = bfgs_minimize( fun, x0, jac = jac, state = optimizer_state, checkpoint = lambda state:checkpoint.update( state['x'], state ) )
+else:
+    result = minimize( fun, x0, method = args.method, jac = jac, hessp = hessp, bounds = bounds, callback = checkpoint.update )
+final_loss = loss_and_grad( result.x )[0] if args.use_derivs else loss( result.x )
 
 print(result)
 print('Final parameters:', result.x, 'Loss:',final_loss )
@@ -1,7 +1,6 @@
 #!/usr/bin/python
 import argparse
 from zetafold.partition import *
-from tests_zetafold import test_zetafold
 
 if __name__ =='__main__':
 
@@ -22,12 +21,34 @@ if __name__ =='__main__':
     parser.add_argument("--simple", action='store_true', default=False, help='Use simple recursions (slow!)')
     parser.add_argument("--calc_Kd_deriv_DP", action='store_true', default=False, help='Calculate derivative with respect to Kd_BP inline with dynamic programming [rarely used]')
     parser.add_argument( "--deriv_params",help="Parameters for which to calculate derivatives. Default: None, or all params if --calc_deriv",nargs='*')
+    parser.add_argument("--deriv_method", type=str, default='analytic', choices=['analytic','adjoint','forward'], help='How to compute derivatives: analytic expressions, one reverse (adjoint) sweep through the recursions, or forward-mode derivatives carried along with the recursions')
     parser.add_argument("--deriv_check", action='store_true', default=False, help='Run numerical vs. analytical deriv check')
+    parser.add_argument("--central_differences", action='store_true', default=False, help='Use central rather than one-sided differences in --deriv_check (twice the runs, much smaller error)')
+    parser.add_argument("--production", action='store_true', default=False, help='Skip the exhaustive cross-checks (partition function and MFE from every starting position); same results, faster')
+    parser.add_argument("--spot_check", type=int, default=0, help='With --production, still check the partition function from this many random starting positions')
+    parser.add_argument("--batch", type=str, default=None, help='Fold every sequence in this FASTA or tab-separated (name, sequences, circle, structure) file, possibly gzipped; - for stdin. Writes JSON lines to --output')
+    parser.add_argument("-o","--output", type=str, default='-', help='Output file for --batch [default: - for stdout; gzipped if it ends in .gz]')
+    parser.add_argument("-j","--jobs", type=int, default=1, help='Number of processes for --batch and --deriv_check')
+    parser.add_argument("--bpp_file", type=str, default='bpp.txt', help='Where to put base pair probabilities from --bpp [default: bpp.txt]')
+    parser.add_argument("--bpp_format", type=str, default=None, choices=['matrix','sparse','npy','npz'], help='Dense text matrix, sparse text lines (i j bpp), or numpy dense .npy / sparse .npz [default: from --bpp_file extension, else matrix]')
+    parser.add_argument("--no_bpp_plot", action='store_true', default=False, help='Skip the base pair probability heatmap')
+    parser.add_argument("--bpp_cutoff", type=float, default=1.0e-5, help='Leave base pair probabilities below this out of sparse and --batch output')
+    parser.add_argument("--stats", action='store_true', default=False, help='Profile the recursions: calls, inner-loop iterations and time for each update function and diagrammed term')
+    parser.add_argument("--cache_dir", type=str, default=None, help='Directory to cache --batch results in, to reuse across runs')
     args     = parser.parse_args()
 
     if args.calc_deriv and args.deriv_params == None: args.deriv_params = []
 
-    if args.sequences != None: # run tests
-        p = partition( args.sequences, circle = args.circle, params = args.parameters, verbose = args.verbose, mfe = args.mfe, calc_bpp = args.bpp, n_stochastic = int(args.stochastic), do_enumeration = args.enumerate, structure = args.structure, allow_extra_base_pairs = args.allow_extra_base_pairs, calc_gap_structure = args.calc_gap_structure, deriv_params = args.deriv_params, no_coax = args.no_coax, use_simple_recursions = args.simple, deriv_check = args.deriv_check )
+    if args.batch != None:
+        from zetafold.batch import run_batch
+        params = get_params( args.parameters, suppress_all_output = True )
+        if args.no_coax: params.set_parameter( 'K_coax', 0.0 )
+        options = { 'mfe': args.mfe, 'bpp': args.bpp, 'bpp_cutoff': args.bpp_cutoff, 'allow_extra_base_pairs': args.allow_extra_base_pairs,
+                    'deriv_params': args.deriv_params, 'deriv_method': args.deriv_method }
+        run_batch( args.batch, args.output, params, options, jobs = args.jobs, cache_dir = args.cache_dir )
+    elif args.sequences != None: # run tests
+        p = partition( args.sequences, circle = args.circle, params = args.parameters, verbose = args.verbose, mfe = args.mfe, calc_bpp = args.bpp, n_stochastic = int(args.stochastic), do_enumeration = args.enumerate, structure = args.structure, allow_extra_base_pairs = args.allow_extra_base_pairs, calc_gap_structure = args.calc_gap_structure, deriv_params = args.deriv_params, deriv_method = args.deriv_method, no_coax = args.no_coax, use_simple_recursions = args.simple, deriv_check = args.deriv_check, bpp_file = args.bpp_file, bpp_format = args.bpp_format, bpp_cutoff = args.bpp_cutoff, bpp_plot = not args.no_bpp_plot, production = args.production, n_spot_check = args.spot_check, deriv_check_jobs = args.jobs, central_differences = args.central_differences, calc_stats = args.stats )
+        if args.stats: p.show_stats()
     else:
+        from tests_zetafold import test_zetafold
         test_zetafold( verbose = args.verbose, use_simple_recursions = args.simple )
@@ -0,0 +1,280 @@
+from __future__ import print_function
+from .derivatives import _get_log_derivs
+from .parameters import compile_params
+
+##################################################################################################
+# Reverse-mode ('adjoint') derivatives of log Z with respect to all parameters.
+#
+# Every term in the recursions is a product of DP cells and parameters. The contribs that
+#  get recorded for backtracking already list the value of each term and the cells it used,
+#  so if the parameters are temporarily replaced by ParameterMonomials, each term value
+#  also carries the powers of the parameters that went into it. Then one sweep back through
+#  the DP cells, from Z_final to the diagonal, accumulates
+#
+#      d(log Z)/d(log parameter) = sum over terms  [ d(log Z)/d(cell) * term * power ]
+#
+#  and no parameter-specific formulas are needed.
+#
+# The explicit recursions do the same sweep without any ParameterMonomials: create_explicit_recursions.py
+#  writes out the reverse of each update (the 'adjoint block'), which reads each parameter factor's
+#  index from a ParameterFactors and adds into a flat list, so the inner loops are plain float
+#  arithmetic. The contribs-based sweep remains for the simple recursions.
+##################################################################################################
+def _get_log_derivs_adjoint( self, deriv_parameters = [] ):
+    '''
+    Output
+
+       d( log Z )/ d( log parameter )
+
+    for parameters in params.parameter_tags by a single reverse sweep through the
+    dynamic programming matrices. Any other requested derivatives (e.g., 'Kd' or
+    'C_eff_stacked_pair' when those are not parameters in the file) fall back
+    to the expressions in derivatives.py.
+    '''
+    if deriv_parameters == None: return None
+    if deriv_parameters == []:
+        for tag in self.params.parameter_tags: deriv_parameters.append( tag )
+
+    slots = get_parameter_slots( self.params )
+    slot_log_derivs = get_slot_log_derivs( self, slots )
+
+    derivs = [None]*len(deriv_parameters)
+    for n,parameter in enumerate( deriv_parameters ):
+        if parameter in self.params.parameter_tags:
+            derivs[ n ] = sum( slot_log_derivs[ m ] for m in get_slots_for_parameter( self.params, slots, parameter ) )
+        else:
+            derivs[ n ] = _get_log_derivs( self, [ parameter ] )[ 0 ]
+    return derivs
+
+##################################################################################################
+def get_slot_log_derivs( self, slots ):
+    '''
+    d( log Z )/ d( log slot ) for each slot, i.e. the expected number of times each
+    parameter slot shows up in the Boltzmann weights of the ensemble.
+    '''
+    N = self.N
+    Z = self.Z_final.val( 0 )
+    if Z == 0.0: return [0.0]*len( slots )
+    if self.use_simple_recursions: return get_slot_log_derivs_from_contribs( self, slots )
+
+    # Q_bar = d( log Z )/d( cell ), filled in by the adjoint blocks in explicit_recursions.py
+    factors = ParameterFactors( self.params, slots )
+    for X in self.Z_all: X.Q_bar = [ [0.0]*N for i in range( N ) ]
+    self.Z_final.Q_bar = [0.0]*N
+    self.Z_final.Q_bar[ 0 ] = 1.0/Z
+    self.options.adjoint_factors = factors
+    self.options.calc_adjoint = True
+    try:
+        self.Z_final.update_func( self, 0 )
+
+        # go through updates in exactly the reverse order of Partition.run()
+        for offset in range( N-1, 0, -1 ):
+            for i in range( N-1, -1, -1 ):
+                if (not self.calc_all_elements) and ( i + offset ) >= self.N: continue
+                j = (i + offset) % N
+                for X in reversed( self.Z_all ):
+                    if X.Q_bar[ i ][ j ] == 0.0: continue
+                    X.update_func( self, i, j )
+
+        # diagonal values set in initialize_dynamic_programming_matrices() are the leaves of the recursions.
+        for X,diag_val in get_diagonal_values( self ):
+            assert( diag_val == self.params.C_init )
+            for i in range( N ): factors.bar[ factors.C_init ] += X.Q_bar[ i ][ i ] * X.val( i, i )
+    finally:
+        self.options.calc_adjoint = False
+        self.options.adjoint_factors = None
+        for X in self.Z_all + [ self.Z_final ]: del X.Q_bar
+
+    return factors.get_slot_log_derivs( len( slots ) )
+
+def get_slot_log_derivs_from_contribs( self, slots ):
+    '''
+    Same as get_slot_log_derivs(), going through the contribs of each cell -- for recursions without adjoint blocks.
+    '''
+    N = self.N
+    Z = self.Z_final.val( 0 )
+    slot_log_derivs = [0.0]*len( slots )
+
+    # Z_bar = d( log Z )/d( cell )
+    Z_bar = {}
+    for X in self.Z_all: Z_bar[ X ] = [ [0.0]*N for i in range( N ) ]
+
+    save_vals = tag_parameter_slots( slots )
+    try:
+        self.compiled = compile_params( self.params )
+        self.Z_final.contribs_updated[ 0 ] = False
+        backpropagate( self.Z_final.get_contribs( self, 0 ), 1.0/Z, Z_bar, slot_log_derivs )
+
+        # go through updates in exactly the reverse order of Partition.run()
+        for offset in range( N-1, 0, -1 ):
+            for i in range( N-1, -1, -1 ):
+                if (not self.calc_all_elements) and ( i + offset ) >= self.N: continue
+                j = (i + offset) % N
+                for X in reversed( self.Z_all ):
+                    if Z_bar[ X ][ i ][ j ] == 0.0: continue
+                    X.contribs_updated[ i ][ j ] = False
+                    backpropagate( X.get_contribs( self, i, j ), Z_bar[ X ][ i ][ j ], Z_bar, slot_log_derivs )
+
+        # diagonal values set in initialize_dynamic_programming_matrices() are the leaves of the recursions.
+        for X,diag_val in get_diagonal_values( self ):
+            for i in range( N ):
+                if X.val( i, i ) == 0.0: continue # e.g., forced base pairs
+                backpropagate( [ (diag_val, []) ], Z_bar[ X ][ i ][ i ], Z_bar, slot_log_derivs )
+    finally:
+        # also after an exception, since params get reused by later folds
+        restore_parameter_slots( slots, save_vals )
+        self.compiled = self.params.get_compiled()
+        _combined_powers.clear()
+
+    return slot_log_derivs
+
+def backpropagate( contribs, weight, Z_bar, slot_log_derivs ):
+    '''
+    contribs are the terms [ value, [ (DP matrix, i, j), ... ] ] that were summed into one cell, and
+    weight is d( log Z )/ d( that cell ).
+    '''
+    for contrib in contribs:
+        val = contrib[ 0 ]
+        w = weight * val
+        if w == 0.0: continue
+        if isinstance( val, ParameterMonomial ):
+            for n,power in val.powers.items(): slot_log_derivs[ n ] += power * w
+        for (X,i,j) in contrib[ 1 ]: Z_bar[ X ][ i ][ j ] += w / X.val( i, j )
+
+def get_diagonal_values( self ):
+    '''
+    Keep in sync with initialize_dynamic_programming_matrices() -- Z_linear(i,i) = 1 does not depend on parameters.
+    '''
+    C_init = self.params.C_init
+    return [ (self.C_eff_basic, C_init), (self.C_eff_no_BP_singlet, C_init), (self.C_eff_no_coax_singlet, C_init), (self.C_eff, C_init) ]
+
+##################################################################################################
+class ParameterFactors:
+    '''
+    The parameter factors read by the adjoint blocks in explicit_recursions.py -- factors.l,
+     factors.Kd[ base_pair_type ], factors.C_eff[ motif_type ], factors.C_eff_stack[ bpt1 ][ bpt2 ],
+     factors.compiled.loop_weight[ q ], etc. -- each replaced by its index into the flat list bar,
+     which accumulates d( log Z )/d( log factor ). powers[ f ] gives the slots (and their powers)
+     multiplied into factor f.
+    '''
+    def __init__( self, params, slots ):
+        self.powers = []
+        save_vals = tag_parameter_slots( slots )
+        try:
+            for attr in ( 'C_init', 'l', 'l_BP', 'K_coax', 'l_coax', 'C_std' ): setattr( self, attr, self.number( getattr( params, attr ) ) )
+            self.Kd = dict( ( base_pair_type, self.number( base_pair_type.Kd ) ) for base_pair_type in params.base_pair_types )
+            self.C_eff = dict( ( motif_type, self.number( motif_type.C_eff ) ) for motif_type in params.motif_types )
+            self.C_eff_stack = {}
+            for bpt1 in params.C_eff_stack:
+                self.C_eff_stack[ bpt1 ] = dict( ( bpt2, self.number( val ) ) for (bpt2,val) in params.C_eff_stack[ bpt1 ].items() )
+            self.compiled = compile_params( params )
+            for attr in ( 'loop_weight', 'stack_weight', 'cut_weight', 'coax_loop_weight', 'coax_cut_weight' ):
+                setattr( self.compiled, attr, self.number( getattr( self.compiled, attr ) ) )
+        finally:
+            restore_parameter_slots( slots, save_vals )
+            _combined_powers.clear()
+        self.bar = [0.0]*len( self.powers )
+
+    def number( self, val ):
+        if isinstance( val, list ): return [ self.number( x ) for x in val ]
+        self.powers.append( dict( val.powers ) if isinstance( val, ParameterMonomial ) else {} )
+        return len( self.powers ) - 1
+
+    def get_slot_log_derivs( self, num_slots ):
+        slot_log_derivs = [0.0]*num_slots
+        for (bar,powers) in zip( self.bar, self.powers ):
+            if bar == 0.0: continue
+            for n,power in powers.items(): slot_log_derivs[ n ] += power * bar
+        return slot_log_derivs
+
+##################################################################################################
+class ParameterMonomial( float ):
+    '''
+    A float that remembers which parameter slots (and what powers of them) were multiplied
+    together to produce it. Sums give back plain floats.
+    '''
+    __slots__ = ('powers',)
+
+    def __new__( cls, val, powers = None ):
+        x = float.__new__( cls, val )
+        x.powers = powers if powers else {}
+        return x
+
+    # these get called a lot in the innermost loops of the recursions, so avoid any extra work --
+    #  in particular, terms that vanish (most of them) need no parameter bookkeeping.
+    def __mul__( self, other ):
+        if type( other ) is float:
+            if other == 0.0: return 0.0
+            return ParameterMonomial( float.__mul__( self, other ), self.powers )
+        if isinstance( other, ParameterMonomial ): return ParameterMonomial( float.__mul__( self, other ), combine_powers( self.powers, other.powers, 1 ) )
+        if isinstance( other, _REAL ): return ParameterMonomial( float.__mul__( self, other ), self.powers )
+        return NotImplemented
+
+    def __div__( self, other ):
+        if type( other ) is float: return ParameterMonomial( float.__truediv__( self, other ), self.powers )
+        if isinstance( other, ParameterMonomial ): return ParameterMonomial( float.__truediv__( self, other ), combine_powers( self.powers, other.powers, -1 ) )
+        if isinstance( other, _REAL ): return ParameterMonomial( float.__truediv__( self, other ), self.powers )
+        return NotImplemented
+
+    def __rdiv__( self, other ):
+        if isinstance( other, _REAL ): return ParameterMonomial( float.__rtruediv__( self, other ), combine_powers( {}, self.powers, -1 ) )
+        return NotImplemented
+
+    def __pow__( self, exponent ):
+        return ParameterMonomial( float.__pow__( self, exponent ), combine_powers( {}, self.powers, exponent ) )
+
+    __rmul__ = __mul__
+    __truediv__  = __div__
+    __rtruediv__ = __rdiv__
+
+_REAL = (int, float)
+
+def combine_powers( powers1, powers2, sign ):
+    # the same few products (l * l_BP, etc.) come up over and over, so remember them.
+    key = ( id( powers1 ), id( powers2 ), sign )
+    if key in _combined_powers: return _combined_powers[ key ][ 0 ]
+    powers = dict( powers1 )
+    for n,power in powers2.items(): powers[ n ] = powers.get( n, 0 ) + sign * power
+    _combined_powers[ key ] = ( powers, powers1, powers2 ) # hold on to inputs so their ids stay unique
+    return powers
+
+_combined_powers = {}
+
+##################################################################################################
+def get_parameter_slots( params ):
+    '''
+    All the floats inside params that the recursions read, as (dict,key) pairs:
+     attributes of params itself (C_init, l, ...), of each base pair type (Kd), and of
+     each motif type (C_eff), as well as every entry of C_eff_stack.
+    '''
+    slots = []
+    for obj in [ params ] + params.base_pair_types + params.motif_types:
+        for attr in sorted( vars( obj ) ):
+            if isinstance( getattr( obj, attr ), float ): slots.append( (vars( obj ), attr) )
+    for bpt1 in params.base_pair_types:
+        for bpt2 in params.base_pair_types:
+            slots.append( (params.C_eff_stack[ bpt1 ], bpt2) )
+    return slots
+
+def get_slots_for_parameter( params, slots, parameter ):
+    '''
+    Which slots does set_parameter() actually change for this parameter tag? Find out by
+    setting it to a different value, then put everything back.
+    '''
+    save_vals = [ d[ key ] for (d,key) in slots ]
+    save_val = params.get_parameter_value( parameter )
+    params.set_parameter( parameter, 2.0 * save_val + 1.0 )
+    changed = [ n for n,(d,key) in enumerate( slots ) if d[ key ] != save_vals[ n ] ]
+    restore_parameter_slots( slots, save_vals )
+    params.parameter_values[ params.parameter_tags.index( parameter ) ] = save_val
+    return changed
+
+def tag_parameter_slots( slots ):
+    save_vals = []
+    for n,(d,key) in enumerate( slots ):
+        save_vals.append( d[ key ] )
+        d[ key ] = ParameterMonomial( d[ key ], { n:1 } )
+    return save_vals
+
+def restore_parameter_slots( slots, save_vals ):
+    for (d,key),val in zip( slots, save_vals ): d[ key ] = val
@@ -0,0 +1,162 @@
+from __future__ import print_function
+import sys
+import json
+import gzip
+import zlib
+import traceback
+from collections import OrderedDict, deque
+from itertools import chain
+from multiprocessing import Pool
+from .partition_cache import cached_partition, PartitionCache
+
+##################################################################################################
+# Batch folding: many inputs in, one JSON record per input out, in the same order.
+#
+# Inputs (plain or gzip-compressed, from a file or stdin) are either FASTA:
+#
+#      >name
+#      GGGGAAACCCC          <-- may run over several lines; strands separated by space, '+' or ','
+#      ((((...))))          <-- optional: forced structure
+#
+#  or tab-separated lines ('#' starts a comment):
+#
+#      name   sequences   [circle]   [structure]
+#
+#  with circle given as 1/0 or True/False. Inputs are read and folded as they are needed,
+#  with at most max_pending of them in flight, so memory use does not grow with the number of inputs.
+##################################################################################################
+class BatchInput:
+    def __init__( self, name, sequences, circle = False, structure = None ):
+        self.name = name
+        self.sequences = sequences
+        self.circle = circle
+        self.structure = structure
+
+def read_lines( fid, chunk_size = 1<<16 ):
+    '''
+    Lines of fid (without line endings), decompressing on the fly if it holds gzip data.
+    '''
+    decompressor = None
+    leftover = ''
+    chunk = fid.read( chunk_size )
+    if chunk[:2] == '\x1f\x8b': decompressor = zlib.decompressobj( 16 + zlib.MAX_WBITS )
+    while chunk:
+        if decompressor: chunk = decompressor.decompress( chunk )
+        lines = ( leftover + chunk ).split( '\n' )
+        leftover = lines.pop()
+        for line in lines: yield line.rstrip( '\r' )
+        chunk = fid.read( chunk_size )
+    if decompressor: leftover += decompressor.flush()
+    if leftover: yield leftover.rstrip( '\r' )
+
+structure_chars = set( '.()[]{}<> +,' )
+
+def read_batch_inputs( lines ):
+    '''
+    BatchInputs from lines in FASTA or tab-separated format (see above), decided by the first line.
+    '''
+    lines = iter( lines )
+    for line in lines:
+        if line.strip(): break
+    else:
+        return
+    if line.startswith( '>' ):
+        for batch_input in read_fasta( line, lines ): yield batch_input
+    else:
+        for batch_input in read_tsv( line, lines ): yield batch_input
+
+def read_fasta( first_line, lines ):
+    name = first_line[1:].strip()
+    sequence_lines = []
+    structure_lines = []
+    def get_input():
+        structure = ''.join( structure_lines ) if structure_lines else None
+        return BatchInput( name, ' '.join( ''.join( sequence_lines ).replace( '+', ' ' ).replace( ',', ' ' ).split() ), False, structure )
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith( ';' ): continue
+        if line.startswith( '>' ):
+            yield get_input()
+            name = line[1:].strip()
+            sequence_lines = []
+            structure_lines = []
+        elif set( line ) <= structure_chars: structure_lines.append( line )
+        else: sequence_lines.append( line )
+    yield get_input()
+
+def read_tsv( first_line, lines ):
+    for line in chain( [ first_line ], lines ):
+        if not line.strip() or line.startswith( '#' ): continue
+        cols = line.rstrip( '\n' ).split( '\t' )
+        assert( len( cols ) >= 2 )
+        circle = len( cols ) > 2 and cols[ 2 ].strip() in ( '1', 'True', 'true' )
+        structure = cols[ 3 ].strip() if len( cols ) > 3 and cols[ 3 ].strip() else None
+        yield BatchInput( cols[ 0 ].strip(), cols[ 1 ].strip(), circle, structure )
+
+##################################################################################################
+_worker = {} # params, options, and cache for this process
+
+def init_batch_worker( params, options, cache_dir ):
+    _worker[ 'params' ] = params
+    _worker[ 'options' ] = options
+    _worker[ 'cache' ] = PartitionCache( cache_dir, max_entries = 100 if cache_dir else 0 )
+
+def fold_batch_input( batch_input ):
+    '''
+    JSON record for one BatchInput, using the params and options from init_batch_worker().
+    Errors end up in the record, rather than stopping the whole batch.
+    '''
+    options = _worker[ 'options' ]
+    record = OrderedDict( [ ( 'name', batch_input.name ), ( 'sequences', batch_input.sequences ), ( 'circle', batch_input.circle ) ] )
+    if batch_input.structure: record[ 'structure' ] = batch_input.structure
+    try:
+        result = cached_partition( batch_input.sequences, circle = batch_input.circle, params = _worker[ 'params' ],
+                                   mfe = options[ 'mfe' ], calc_bpp = options[ 'bpp' ],
+                                   structure = batch_input.structure, allow_extra_base_pairs = options[ 'allow_extra_base_pairs' ],
+                                   deriv_params = options[ 'deriv_params' ], deriv_method = options[ 'deriv_method' ],
+                                   cache = _worker[ 'cache' ], bpp_cutoff = options[ 'bpp_cutoff' ] )
+    except Exception as e:
+        record[ 'error' ] = ''.join( traceback.format_exception_only( type( e ), e ) ).strip()
+        return json.dumps( record )
+    record[ 'Z' ] = result.Z
+    record[ 'dG' ] = result.dG
+    if options[ 'mfe' ]: record[ 'mfe' ] = result.struct_MFE
+    if options[ 'bpp' ]: record[ 'bpp' ] = [ [ int( i ), int( j ), float( bpp_ij ) ] for ( i, j, bpp_ij ) in zip( result.bpp_i, result.bpp_j, result.bpp_p ) ]
+    if result.deriv_params: record[ 'log_derivs' ] = OrderedDict( ( parameter, float( log_deriv ) ) for ( parameter, log_deriv ) in zip( result.deriv_params, result.log_derivs ) )
+    return json.dumps( record )
+
+def fold_batch( batch_inputs, params, options, jobs = 1, cache_dir = None, max_pending = None ):
+    '''
+    JSON records for batch_inputs, in order, folded on jobs processes. options is a dict with
+     mfe, bpp, bpp_cutoff, allow_extra_base_pairs, deriv_params, and deriv_method.
+    '''
+    worker_args = ( params, options, cache_dir )
+    if jobs <= 1:
+        init_batch_worker( *worker_args )
+        for batch_input in batch_inputs: yield fold_batch_input( batch_input )
+        return
+
+    if max_pending == None: max_pending = 16 * jobs
+    pool = Pool( jobs, initializer = init_batch_worker, initargs = worker_args )
+    pending = deque()
+    for batch_input in batch_inputs:
+        pending.append( pool.apply_async( fold_batch_input, ( batch_input, ) ) )
+        if len( pending ) >= max_pending: yield pending.popleft().get()
+    while pending: yield pending.popleft().get()
+    pool.close()
+    pool.join()
+
+def run_batch( input_file, output_file, params, options, jobs = 1, cache_dir = None ):
+    '''
+    Fold everything in input_file ('-' for stdin), writing JSON lines to output_file ('-' for stdout,
+     gzip-compressed if it ends in .gz).
+    '''
+    fid_in = sys.stdin if input_file == '-' else open( input_file, 'rb' )
+    if output_file == '-': fid_out = sys.stdout
+    elif output_file.endswith( '.gz' ): fid_out = gzip.open( output_file, 'wb' )
+    else: fid_out = open( output_file, 'w' )
+    for record in fold_batch( read_batch_inputs( read_lines( fid_in ) ), params, options, jobs, cache_dir ):
+        fid_out.write( record + '\n' )
+    if fid_in is not sys.stdin: fid_in.close()
+    if fid_out is not sys.stdout: fid_out.close()
+    else: fid_out.flush()
@@ -0,0 +1,241 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import random
+import resource
+import platform
+import subprocess
+from collections import OrderedDict
+from datetime import datetime
+from multiprocessing import Pool
+from .partition import partition
+from .parameters import get_params
+from .score_structure import score_structure
+from .batch import BatchInput
+
+##################################################################################################
+# Benchmarks: time each phase (feature) of folding over representative workloads, and keep the
+#  results in a JSON-lines history so that commits, or engines, can be compared.
+#
+# Workloads:
+#
+#   favorites      favorites training set (tRNA, P4P6, riboswitches, ...)
+#   contrafold     first 10 of the contrafold_under200 training set
+#   random_<N>     5 random sequences of length N (e.g., random_50 ... random_1000), same every time
+#   multistrand    random duplexes, each strand paired with a mutated reverse complement
+#   circle         random circular sequences
+#
+# Phases:  Z, bpp, mfe, stochastic (10 samples), derivs (all parameters), score_structure
+#  (reference structure where there is one, otherwise the MFE, found in a separate process beforehand).
+#
+# Each workload and phase runs in a fresh process, so that caches from one do not speed up another,
+#  and peak memory is that of the phase alone. Engine is 'explicit' (default recursions) or 'simple'
+#  (use_simple_recursions). Each record in the history has:
+#
+#   run_id, timestamp, commit, label, engine, host, workload, phase, num_examples, num_nt,
+#   wall_time (s), max_example_time (s), peak_memory_mb, examples_per_second, nt_per_second
+##################################################################################################
+default_workloads = [ 'favorites', 'contrafold', 'random_50', 'random_100', 'random_200', 'multistrand', 'circle' ]
+full_workloads = default_workloads + [ 'random_500', 'random_1000' ]
+all_phases = [ 'Z', 'bpp', 'mfe', 'stochastic', 'derivs', 'score_structure' ]
+engines = [ 'explicit', 'simple' ]
+
+def get_random_sequence( rng, N ): return ''.join( rng.choice( 'ACGU' ) for i in range( N ) )
+
+def get_reverse_complement( sequence, rng, mutation_rate = 0.1 ):
+    complement = { 'A':'U', 'U':'A', 'G':'C', 'C':'G' }
+    return ''.join( rng.choice( 'ACGU' ) if rng.random() < mutation_rate else complement[ c ] for c in reversed( sequence ) )
+
+def get_workload( workload, max_examples = None ):
+    '''
+    List of BatchInputs for workload (see above).
+    '''
+    rng = random.Random( workload ) # same sequences every time
+    if workload in ( 'favorites', 'contrafold' ):
+        from .data.training_examples import get_training_examples
+        training_examples = get_training_examples( 'favorites' if workload == 'favorites' else 'contrafold_under200' )
+        if workload == 'contrafold' and max_examples == None: max_examples = 10
+        batch_inputs = [ BatchInput( training_example.name, training_example.sequence, False, training_example.structure ) for training_example in training_examples ]
+    elif workload.startswith( 'random_' ):
+        N = int( workload[ len( 'random_' ): ] )
+        batch_inputs = [ BatchInput( '%s_%d' % ( workload, n ), get_random_sequence( rng, N ) ) for n in range( 5 ) ]
+    elif workload == 'multistrand':
+        batch_inputs = []
+        for N in [ 10, 20, 30 ]:
+            sequence = get_random_sequence( rng, N )
+            batch_inputs.append( BatchInput( 'duplex_%d' % N, sequence + ' ' + get_reverse_complement( sequence, rng ) ) )
+    elif workload == 'circle':
+        batch_inputs = [ BatchInput( 'circle_%d' % N, get_random_sequence( rng, N ), True ) for N in [ 30, 60, 90 ] ]
+    else:
+        raise ValueError( 'Unknown workload: %s' % workload )
+    return batch_inputs[ :max_examples ]
+
+def get_num_nt( batch_input ): return len( batch_input.sequences.replace( ' ', '' ) )
+
+def get_partition_kwargs( batch_input, params, engine ):
+    return { 'circle': batch_input.circle, 'params': params, 'suppress_all_output': True, 'production': True,
+             'use_simple_recursions': ( engine == 'simple' ) }
+
+def get_structures( workload, params, engine, max_examples = None ):
+    '''
+    Structures for the score_structure phase on workload: the reference structure where there is one,
+     otherwise the MFE. Run this in its own process, so that the folds count toward neither the
+     time nor the peak memory of the measured one.
+    '''
+    return [ batch_input.structure if batch_input.structure != None else
+             partition( batch_input.sequences, mfe = True, **get_partition_kwargs( batch_input, params, engine ) ).struct_MFE
+             for batch_input in get_workload( workload, max_examples ) ]
+
+def run_phase( phase, batch_input, params, engine, structure = None ):
+    '''
+    Run phase for one input (scoring structure, for score_structure); returns time taken.
+    '''
+    kwargs = get_partition_kwargs( batch_input, params, engine )
+    sequences = batch_input.sequences
+    if phase == 'score_structure':
+        start_time = time.time()
+        score_structure( sequences, structure, circle = batch_input.circle, params = params )
+        return time.time() - start_time
+    if phase == 'bpp':          kwargs[ 'calc_bpp' ] = True
+    elif phase == 'mfe':        kwargs[ 'mfe' ] = True
+    elif phase == 'stochastic': kwargs[ 'n_stochastic' ] = 10
+    elif phase == 'derivs':     kwargs[ 'deriv_params' ] = []
+    else: assert( phase == 'Z' )
+    start_time = time.time()
+    partition( sequences, **kwargs )
+    return time.time() - start_time
+
+def run_benchmark_phase( workload, phase, params, engine, max_examples = None, structures = None ):
+    '''
+    Run phase over workload (meant to be called in a fresh process); returns dict of measurements.
+    structures (from get_structures()) are needed for score_structure.
+    '''
+    batch_inputs = get_workload( workload, max_examples )
+    if structures == None: structures = [ None ] * len( batch_inputs )
+    stdout = sys.stdout
+    sys.stdout = open( os.devnull, 'w' ) # stochastic backtracks, etc. print even with suppress_all_output
+    try:
+        example_times = [ run_phase( phase, batch_input, params, engine, structure ) for (batch_input, structure) in zip( batch_inputs, structures ) ]
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    wall_time = sum( example_times )
+    num_nt = sum( get_num_nt( batch_input ) for batch_input in batch_inputs )
+    return OrderedDict( [
+        ( 'workload', workload ), ( 'phase', phase ),
+        ( 'num_examples', len( batch_inputs ) ), ( 'num_nt', num_nt ),
+        ( 'wall_time', wall_time ), ( 'max_example_time', max( example_times ) if example_times else 0.0 ),
+        ( 'peak_memory_mb', resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / 1024.0 ), # kB on Linux
+        ( 'examples_per_second', len( batch_inputs ) / wall_time if wall_time > 0 else None ),
+        ( 'nt_per_second', num_nt / wall_time if wall_time > 0 else None ) ] )
+
+def get_commit():
+    '''
+    Short hash of the git commit of this code, with -dirty if there are uncommitted changes, or None.
+    '''
+    repo_dir = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+    try:
+        commit = subprocess.check_output( [ 'git', 'rev-parse', '--short', 'HEAD' ], cwd = repo_dir, stderr = open( os.devnull, 'w' ) ).strip()
+        if subprocess.check_output( [ 'git', 'status', '--porcelain', '--untracked-files=no' ], cwd = repo_dir ).strip(): commit += '-dirty'
+        return commit
+    except ( OSError, subprocess.CalledProcessError ):
+        return None
+
+def run_benchmarks( workloads = default_workloads, phases = all_phases, params = '', engine = 'explicit',
+                    history_file = None, label = None, max_examples = None, repeat = 1, verbose = True ):
+    '''
+    Benchmark each phase on each workload, keeping the fastest of repeat runs. Records (see above)
+     are appended to history_file, if given, as they come in. Returns the records.
+    '''
+    assert( engine in engines )
+    params = get_params( params, suppress_all_output = True )
+    run_info = OrderedDict( [ ( 'run_id', '%s-%d' % ( datetime.now().strftime( '%Y%m%d-%H%M%S.%f' ), os.getpid() ) ),
+                              ( 'timestamp', time.time() ), ( 'commit', get_commit() ), ( 'label', label ),
+                              ( 'engine', engine ), ( 'host', platform.node() ) ] )
+    records = []
+    for workload in workloads:
+        structures = None
+        for phase in phases:
+            if phase == 'score_structure' and structures == None:
+                pool = Pool( 1 ) # any folding for structures to score happens outside the measured processes
+                structures = pool.apply( get_structures, ( workload, params, engine, max_examples ) )
+                pool.close()
+                pool.join()
+            results = []
+            for n in range( repeat ):
+                pool = Pool( 1 ) # fresh process for each measurement
+                results.append( pool.apply( run_benchmark_phase, ( workload, phase, params, engine, max_examples, structures ) ) )
+                pool.close()
+                pool.join()
+            record = OrderedDict( run_info )
+            record.update( min( results, key = lambda result: result[ 'wall_time' ] ) )
+            records.append( record )
+            if verbose: print( '%-14s %-16s %10.3f s %10.1f nt/s %8.1f MB' % ( workload, phase, record[ 'wall_time' ], record[ 'nt_per_second' ] or 0.0, record[ 'peak_memory_mb' ] ) )
+            if history_file:
+                with open( history_file, 'a' ) as fid: fid.write( json.dumps( record ) + '\n' )
+    return records
+
+##################################################################################################
+def read_history( history_file ):
+    records = []
+    with open( history_file ) as fid:
+        for line in fid:
+            if line.strip(): records.append( json.loads( line ) )
+    return records
+
+def select_records( records, spec = None, exclude_run_ids = [] ):
+    '''
+    Records matching spec: comma-separated key=value filters (e.g., 'commit=ab12cd3,engine=simple'),
+     where a bare value matches a commit (prefix), label, or run_id. With no spec, the most recent
+     run not in exclude_run_ids.
+    '''
+    if not spec:
+        run_ids = [ record[ 'run_id' ] for record in records if not record[ 'run_id' ] in exclude_run_ids ]
+        if not run_ids: return []
+        return [ record for record in records if record[ 'run_id' ] == run_ids[ -1 ] ]
+    def matches( record, term ):
+        if '=' in term:
+            ( key, value ) = term.split( '=', 1 )
+            if key == 'commit': return ( record.get( 'commit' ) or '' ).startswith( value )
+            return str( record.get( key ) ) == value
+        return ( record.get( 'commit' ) or '' ).startswith( term ) or record.get( 'label' ) == term or record.get( 'run_id' ) == term
+    return [ record for record in records if all( matches( record, term ) for term in spec.split( ',' ) ) ]
+
+def summarize_records( records ):
+    '''
+    { ( workload, phase ): ( best wall_time, peak_memory_mb of that run ) }
+    '''
+    summary = {}
+    for record in records:
+        key = ( record[ 'workload' ], record[ 'phase' ] )
+        if not key in summary or record[ 'wall_time' ] < summary[ key ][ 0 ]: summary[ key ] = ( record[ 'wall_time' ], record[ 'peak_memory_mb' ] )
+    return summary
+
+def compare_records( base_records, new_records, threshold = 0.1, verbose = True ):
+    '''
+    Compare wall time and peak memory for each workload and phase in both sets of records; returns
+     [ ( workload, phase, what, base value, new value ), ... ] for those that got worse by more than threshold.
+    '''
+    base = summarize_records( base_records )
+    new  = summarize_records( new_records )
+    regressions = []
+    if verbose: print( '%-14s %-16s %12s %12s %8s %10s %10s' % ( 'workload', 'phase', 'base (s)', 'new (s)', 'ratio', 'base MB', 'new MB' ) )
+    for key in sorted( set( base ) & set( new ) ):
+        ( ( base_time, base_memory ), ( new_time, new_memory ) ) = ( base[ key ], new[ key ] )
+        ratio = new_time / base_time if base_time > 0 else 1.0
+        flags = []
+        if ratio > 1.0 + threshold:
+            regressions.append( key + ( 'wall_time', base_time, new_time ) )
+            flags.append( 'SLOWER' )
+        elif ratio < 1.0 - threshold: flags.append( 'faster' )
+        if new_memory > ( 1.0 + threshold ) * base_memory:
+            regressions.append( key + ( 'peak_memory_mb', base_memory, new_memory ) )
+            flags.append( 'MORE MEMORY' )
+        if verbose: print( '%-14s %-16s %12.3f %12.3f %8.2f %10.1f %10.1f  %s' % ( key + ( base_time, new_time, ratio, base_memory, new_memory, ' '.join( flags ) ) ) )
+    if verbose:
+        missing = sorted( set( base ) ^ set( new ) )
+        if missing: print( 'Only in one of the two:', ' '.join( '%s/%s' % key for key in missing ) )
+        print( '%d regression(s) beyond %.0f%%' % ( len( regressions ), 100 * threshold ) )
+    return regressions
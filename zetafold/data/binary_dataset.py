@@ -0,0 +1,201 @@
+#!/usr/bin/python
+from __future__ import print_function
+import argparse
+import os
+import sys
+from glob import glob
+import numpy as np
+if __package__ == None: sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from zetafold.data.training_examples import TrainingExample, read_training_example, read_training_sets
+from zetafold.util import sequence_util
+from zetafold.util import secstruct_util
+
+##################################################################################################
+# Binary training datasets.
+#
+# A dataset is a directory of .npy arrays. The residues of all examples are concatenated, and
+#  example n runs from starts[ n ] to starts[ n+1 ]:
+#
+#      sequence           residues, one byte each
+#      ligated            is residue connected to the next one? (False at strand ends)
+#      pair_table         partner of each residue in the target structure (within its example), or -1
+#      force_pair_table   same for force_base_pairs, if has_force[ n ]
+#
+#  Examples are listed in names and lengths, with name_order sorting names for lookup. Training
+#  set s has members set_members[ set_starts[ s ] : set_starts[ s+1 ] ].
+#
+#  The arrays are memory-mapped when loaded, so worker processes all read one copy from the page cache.
+##################################################################################################
+array_names = [ 'names', 'name_order', 'lengths', 'starts', 'sequence', 'ligated', 'pair_table', 'force_pair_table', 'has_force', 'set_names', 'set_starts', 'set_members' ]
+
+def write_binary_dataset( dataset_dir, training_examples, training_sets = [] ):
+    '''
+    Save list of TrainingExamples, and training_sets as [ ( training_set_name, [ example names ] ), ... ]
+    '''
+    lengths = []
+    sequence = []
+    ligated = []
+    pair_table = []
+    force_pair_table = []
+    has_force = []
+    for training_example in training_examples:
+        ( example_sequence, example_ligated, strands ) = sequence_util.initialize_sequence_and_ligated( training_example.sequence, False )
+        N = len( example_sequence )
+        assert( len( training_example.pair_table ) == N )
+        lengths.append( N )
+        sequence.append( np.frombuffer( example_sequence, dtype = 'S1' ) )
+        ligated.append( np.array( example_ligated, dtype = bool ) )
+        pair_table.append( training_example.pair_table )
+        has_force.append( training_example.force_pair_table is not None )
+        if training_example.force_pair_table is not None:
+            assert( len( training_example.force_pair_table ) == N )
+            force_pair_table.append( training_example.force_pair_table )
+        else:
+            force_pair_table.append( np.full( N, -1, dtype = int ) )
+
+    names = np.array( [ training_example.name for training_example in training_examples ], dtype = str )
+    example_idx = dict( (name,n) for (n,name) in enumerate( names ) )
+    set_members = []
+    for ( training_set_name, set_examples ) in training_sets:
+        missing = [ name for name in set_examples if not name in example_idx ]
+        if missing: print( 'WARNING! Leaving examples out of training set %s, since they are not in the dataset: %s' % ( training_set_name, ' '.join( missing ) ) )
+        set_members.append( [ example_idx[ name ] for name in set_examples if name in example_idx ] )
+    def concatenate( arrays, dtype ): return np.concatenate( arrays ).astype( dtype ) if arrays else np.zeros( 0, dtype = dtype )
+    arrays = {
+        'names':            names,
+        'name_order':       np.argsort( names, kind = 'mergesort' ),
+        'lengths':          np.array( lengths, dtype = np.int32 ),
+        'starts':           np.cumsum( [ 0 ] + lengths ).astype( np.int64 ),
+        'sequence':         concatenate( sequence, 'S1' ),
+        'ligated':          concatenate( ligated, bool ),
+        'pair_table':       concatenate( pair_table, np.int32 ),
+        'force_pair_table': concatenate( force_pair_table, np.int32 ),
+        'has_force':        np.array( has_force, dtype = bool ),
+        'set_names':        np.array( [ training_set_name for ( training_set_name, set_examples ) in training_sets ], dtype = str ),
+        'set_starts':       np.cumsum( [ 0 ] + [ len( members ) for members in set_members ] ).astype( np.int64 ),
+        'set_members':      concatenate( [ np.array( members, dtype = np.int32 ) for members in set_members ], np.int32 ) }
+    if not os.path.isdir( dataset_dir ): os.makedirs( dataset_dir )
+    for array_name in array_names: np.save( os.path.join( dataset_dir, array_name + '.npy' ), arrays[ array_name ] )
+
+def convert_text_dataset( dataset_dir, training_example_files, training_set_files ):
+    '''
+    Convert *.examples.txt and *.sets.txt files into a binary dataset. As when the text
+     files are loaded, an example name that shows up in more than one file takes the last one.
+    '''
+    examples = {}
+    for training_example_file in training_example_files:
+        fid = open( training_example_file, 'rb' )
+        training_example = read_training_example( fid )
+        while training_example != None:
+            examples[ training_example.name ] = training_example
+            training_example = read_training_example( fid )
+        fid.close()
+    training_sets = []
+    for training_set_file in training_set_files: training_sets += read_training_sets( training_set_file )
+    training_examples = [ examples[ name ] for name in sorted( examples.keys() ) ]
+    write_binary_dataset( dataset_dir, training_examples, training_sets )
+
+_open_datasets = {}
+
+def get_binary_dataset( dataset_dir ):
+    '''
+    BinaryDataset for dataset_dir, shared by everything in this process that asks for it.
+    '''
+    dataset_dir = os.path.abspath( dataset_dir )
+    if not dataset_dir in _open_datasets: _open_datasets[ dataset_dir ] = BinaryDataset( dataset_dir )
+    return _open_datasets[ dataset_dir ]
+
+class BinaryDataset:
+    '''
+    Memory-mapped arrays of a binary dataset (see above), with
+      training_sets      = { training_set_name: array of example indices }
+      training_set_names = training set names in order
+    '''
+    def __init__( self, dataset_dir ):
+        self.dataset_dir = os.path.abspath( dataset_dir )
+        for array_name in array_names:
+            setattr( self, array_name, np.load( os.path.join( self.dataset_dir, array_name + '.npy' ), mmap_mode = 'r' ) )
+        self.training_set_names = [ str( training_set_name ) for training_set_name in self.set_names ]
+        self.training_sets = {}
+        for s,training_set_name in enumerate( self.training_set_names ):
+            self.training_sets[ training_set_name ] = self.set_members[ self.set_starts[ s ] : self.set_starts[ s+1 ] ]
+
+    def __len__( self ): return len( self.names )
+
+    def find( self, name ):
+        '''
+        Index of example called name, or None
+        '''
+        k = np.searchsorted( self.names, name, sorter = self.name_order )
+        if k < len( self.names ) and self.names[ self.name_order[ k ] ] == name: return int( self.name_order[ k ] )
+        return None
+
+    def get_residues( self, n ): return slice( self.starts[ n ], self.starts[ n+1 ] )
+    def get_pair_table( self, n ): return self.pair_table[ self.get_residues( n ) ]
+    def get_force_pair_table( self, n ):
+        if not self.has_force[ n ]: return None
+        return self.force_pair_table[ self.get_residues( n ) ]
+
+    def get_strings( self, n, chars ):
+        '''
+        Residue characters chars of example n as a string, with a space between strands.
+        '''
+        ligated = self.ligated[ self.get_residues( n ) ]
+        strand_ends = np.nonzero( ~ligated[:-1] )[ 0 ] + 1
+        return ' '.join( chars[ a:b ].tostring() for (a,b) in zip( [0] + list( strand_ends ), list( strand_ends ) + [ len( chars ) ] ) )
+
+    def get_example( self, n ): return DatasetExample( self, n )
+
+    def get_training_examples( self, training_set_name ):
+        return [ self.get_example( n ) for n in self.training_sets[ training_set_name ] ]
+
+class DatasetExample( TrainingExample ):
+    '''
+    TrainingExample that reads its sequence and structures from a BinaryDataset whenever they are needed,
+     rather than holding on to copies. Pickles as just the dataset directory and index. pair_table and
+     force_pair_table are views of the stored arrays; structure and force_base_pairs are for display.
+    '''
+    def __init__( self, dataset, n ):
+        self.dataset = dataset
+        self.n = int( n )
+        self.name = str( dataset.names[ n ] )
+
+    @property
+    def sequence( self ): return self.dataset.get_strings( self.n, self.dataset.sequence[ self.dataset.get_residues( self.n ) ] )
+
+    @property
+    def pair_table( self ): return self.dataset.get_pair_table( self.n )
+
+    @property
+    def force_pair_table( self ): return self.dataset.get_force_pair_table( self.n )
+
+    @property
+    def structure( self ): return self.dataset.get_strings( self.n, np.frombuffer( secstruct_util.secstruct_from_pair_table( self.dataset.get_pair_table( self.n ) ), dtype = 'S1' ) )
+
+    @property
+    def force_base_pairs( self ):
+        force_pair_table = self.dataset.get_force_pair_table( self.n )
+        if force_pair_table is None: return None
+        return self.dataset.get_strings( self.n, np.frombuffer( secstruct_util.secstruct_from_pair_table( force_pair_table ), dtype = 'S1' ) )
+
+    def __getstate__( self ):
+        state = dict( self.__dict__ )
+        state[ 'dataset' ] = self.dataset.dataset_dir
+        return state
+
+    def __setstate__( self, state ):
+        self.__dict__.update( state )
+        self.dataset = get_binary_dataset( state[ 'dataset' ] )
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser( description = "Convert *.examples.txt and *.sets.txt training data into a binary dataset" )
+    parser.add_argument( "dataset_dir", help = 'Directory for the binary dataset' )
+    parser.add_argument( "--examples", nargs = '*', help = 'Example files [default: all *.examples.txt in zetafold/data]' )
+    parser.add_argument( "--sets", nargs = '*', help = 'Training set files [default: all *.sets.txt in zetafold/data]' )
+    args = parser.parse_args()
+    data_dir = os.path.dirname( os.path.abspath(__file__) )
+    if args.examples == None: args.examples = sorted( glob( data_dir + '/*.examples.txt' ) )
+    if args.sets == None: args.sets = sorted( glob( data_dir + '/*.sets.txt' ) )
+    convert_text_dataset( args.dataset_dir, args.examples, args.sets )
+    dataset = BinaryDataset( args.dataset_dir )
+    print( 'Wrote %d examples and %d training sets to %s' % ( len( dataset ), len( dataset.training_set_names ), args.dataset_dir ) )
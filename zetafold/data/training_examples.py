@@ -1,40 +1,150 @@
 import os
 from glob import glob
+import cPickle as pickle
+import numpy as np
+from zetafold.util.secstruct_util import get_pair_table
 
 class TrainingExample:
     '''
-    Info needed for train_zetafold
+    Info needed for train_zetafold. Structures are parsed into pair tables once, here; training uses
+     pair_table and force_pair_table, and the dot-paren strings are kept for display.
     '''
     def __init__( self, name, sequence, structure, force_base_pairs = None ):
         self.name = name
         self.sequence = sequence
         self.structure = structure
         self.force_base_pairs = force_base_pairs
+        self.pair_table = get_pair_table( structure )
+        self.force_pair_table = get_pair_table( force_base_pairs )
 
-all_training_examples = {}
+class TrainingExampleIndex:
+    '''
+    Looks up TrainingExamples by name, like a dict, but only reads an example from
+     its *.examples.txt file when it is asked for. Names and byte offsets of the examples
+     are kept in an index file next to each examples file (see get_example_offsets()).
+     If a name shows up in more than one file, the last file wins.
+    '''
+    def __init__( self, training_example_files = [] ):
+        self.training_example_files = list( training_example_files )
+        self.offsets = {}
+        self.examples = {}
+
+    def add_file( self, training_example_file ):
+        self.training_example_files.append( training_example_file )
+
+    def get_offsets( self, training_example_file ):
+        if not training_example_file in self.offsets:
+            self.offsets[ training_example_file ] = get_example_offsets( training_example_file )
+        return self.offsets[ training_example_file ]
+
+    def find( self, name ):
+        '''
+        ( training_example_file, offset ) for name, or None if it is not in any file.
+        '''
+        for training_example_file in reversed( self.training_example_files ):
+            ( names, offsets ) = self.get_offsets( training_example_file )
+            n = np.searchsorted( names, name )
+            if n < len( names ) and names[ n ] == name: return ( training_example_file, offsets[ n ] )
+        return None
+
+    def get_examples( self, names ):
+        '''
+        TrainingExamples for names, reading each examples file once, in order.
+        '''
+        missing = set()
+        for name in names:
+            if name in self.examples: continue
+            location = self.find( name )
+            if location == None: raise KeyError( name )
+            missing.add( location )
+        fid = None
+        for (training_example_file,offset) in sorted( missing ):
+            if fid == None or fid.name != training_example_file:
+                if fid: fid.close()
+                fid = open( training_example_file, 'rb' )
+            fid.seek( offset )
+            example = read_training_example( fid )
+            self.examples[ example.name ] = example
+        if fid: fid.close()
+        return [ self.examples[ name ] for name in names ]
+
+    def keys( self ):
+        names = set()
+        for training_example_file in self.training_example_files: names.update( self.get_offsets( training_example_file )[ 0 ] )
+        return list( names )
+
+    def __getitem__( self, name ): return self.get_examples( [ name ] )[ 0 ]
+    def __contains__( self, name ): return name in self.examples or self.find( name ) != None
+    def __iter__( self ): return iter( self.keys() )
+    def __len__( self ): return len( self.keys() )
+
+all_training_examples = TrainingExampleIndex()
 training_sets = {}
 training_set_names = []
 
-def read_in_training_examples( training_example_file ):
-    fid = open( training_example_file, 'r' )
+def read_training_example( fid ):
+    '''
+    Read one example (name, sequence, structure, optional force_base_pairs, blank line) from fid.
+    None at the end of the file.
+    '''
     line = fid.readline()
-    while line:
-        name = line[:-1]
-        line = fid.readline()
-        sequence  = line[:-1]
-        line = fid.readline()
-        structure = line[:-1]
-        line = fid.readline()
-        if line and len(line[:-1].replace(' ','')) > 0:
-            force_base_pairs = line[:-1]
-            line = fid.readline()
-        else:
-            force_base_pairs = None
-        all_training_examples[ name ] = TrainingExample( name, sequence, structure, force_base_pairs )
+    if not line: return None
+    name = line[:-1]
+    line = fid.readline()
+    sequence  = line[:-1]
+    line = fid.readline()
+    structure = line[:-1]
+    line = fid.readline()
+    if line and len(line[:-1].replace(' ','')) > 0:
+        force_base_pairs = line[:-1]
         line = fid.readline()
+    else:
+        force_base_pairs = None
+    return TrainingExample( name, sequence, structure, force_base_pairs )
+
+def get_example_offsets( training_example_file ):
+    '''
+    ( names, offsets ) for the examples in training_example_file, as numpy arrays sorted by name.
+    Cached in training_example_file + '.index', which is rebuilt whenever the examples file changes
+     (or not saved at all if the data directory is not writeable).
+    '''
+    index_file = training_example_file + '.index'
+    stat = os.stat( training_example_file )
+    file_key = ( stat.st_size, stat.st_mtime )
+    if os.path.exists( index_file ):
+        try:
+            ( index_key, names, offsets ) = pickle.load( open( index_file, 'rb' ) )
+            if index_key == file_key: return ( names, offsets )
+        except ( IOError, EOFError, ValueError, pickle.UnpicklingError ):
+            pass
+
+    offset_for_name = {}
+    fid = open( training_example_file, 'rb' )
+    while True:
+        offset = fid.tell()
+        example = read_training_example( fid )
+        if example == None: break
+        offset_for_name[ example.name ] = offset # last one wins, as in a dict
     fid.close()
+    names = np.array( sorted( offset_for_name.keys() ), dtype = str )
+    offsets = np.array( [ offset_for_name[ name ] for name in names ], dtype = np.int64 )
 
-def read_in_training_sets( training_set_file ):
+    try:
+        tmp_file = '%s.%d.tmp' % ( index_file, os.getpid() )
+        with open( tmp_file, 'wb' ) as f: pickle.dump( ( file_key, names, offsets ), f, pickle.HIGHEST_PROTOCOL )
+        os.rename( tmp_file, index_file )
+    except ( IOError, OSError ):
+        pass
+    return ( names, offsets )
+
+def read_in_training_examples( training_example_file ):
+    all_training_examples.add_file( training_example_file )
+
+def read_training_sets( training_set_file ):
+    '''
+    [ ( training_set_name, [ example names ] ), ... ] from training_set_file
+    '''
+    sets = []
     fid = open( training_set_file, 'r' )
     line = fid.readline()
     while line:
@@ -42,10 +152,18 @@ def read_in_training_sets( training_set_file ):
         line = fid.readline()
         training_examples  = line[:-1].split(' ')
         line = fid.readline()
-        training_set_names.append( training_set_name )
-        training_sets[ training_set_name ] = training_examples
+        sets.append( ( training_set_name, training_examples ) )
         line = fid.readline()
     fid.close()
+    return sets
+
+def read_in_training_sets( training_set_file ):
+    for ( training_set_name, training_examples ) in read_training_sets( training_set_file ):
+        training_set_names.append( training_set_name )
+        training_sets[ training_set_name ] = training_examples
+
+def get_training_examples( training_set_name ):
+    return all_training_examples.get_examples( training_sets[ training_set_name ] )
 
 data_dir = os.path.dirname( os.path.abspath(__file__) )
 
@@ -0,0 +1,109 @@
+from __future__ import print_function
+from math import log, exp
+from multiprocessing import Pool
+from .partition import partition
+
+##################################################################################################
+# Numerical derivatives for deriv checks, by finite differences in log parameter space.
+#
+# Each shifted evaluation is independent of the others, so they all go out at once to a process
+#  pool whose workers hold their own copy of the parameters. One-sided differences
+#
+#      ( f( x + epsilon ) - f( x ) ) / epsilon
+#
+#  take one evaluation per parameter; central differences
+#
+#      ( f( x + epsilon ) - f( x - epsilon ) ) / ( 2 epsilon )
+#
+#  take two, but have O(epsilon^2) rather than O(epsilon) error, so epsilon can be larger and
+#  roundoff matters much less.
+##################################################################################################
+def get_epsilon( central = False ): return 1.0e-5 if central else 1.0e-8
+
+def get_numerical_derivs( evaluate, num_params, f0, central = False, epsilon = None, skip = [] ):
+    '''
+    Finite difference derivatives of f with respect to each of num_params parameters, where
+     evaluate( [ (n, shift), ... ] ) gives f with parameter n shifted by shift, for all of them
+     in one go, and f0 is f without any shift. Parameters in skip get zero.
+    '''
+    if epsilon == None: epsilon = get_epsilon( central )
+    shifts = [ ( n, epsilon ) for n in range( num_params ) if not n in skip ]
+    if central: shifts += [ ( n, -epsilon ) for n in range( num_params ) if not n in skip ]
+    values = dict( zip( shifts, evaluate( shifts ) ) )
+    derivs = []
+    for n in range( num_params ):
+        if n in skip:  derivs.append( 0.0 )
+        elif central:  derivs.append( ( values[ (n,epsilon) ] - values[ (n,-epsilon) ] ) / ( 2 * epsilon ) )
+        else:          derivs.append( ( values[ (n,epsilon) ] - f0 ) / epsilon )
+    return derivs
+
+def map_tasks( func, tasks, initializer, initargs, jobs = 1 ):
+    '''
+    [ func( task ) for task in tasks ], on up to jobs processes set up by initializer( *initargs ).
+    '''
+    if jobs <= 1 or len( tasks ) <= 1:
+        initializer( *initargs )
+        return map( func, tasks )
+    pool = Pool( min( jobs, len( tasks ) ), initializer = initializer, initargs = initargs )
+    results = pool.map( func, tasks )
+    pool.close()
+    pool.join()
+    return results
+
+##################################################################################################
+_worker = {} # partition() inputs for this process
+
+def init_log_Z_worker( sequences, circle, params, structure, allow_extra_base_pairs ):
+    _worker[ 'sequences' ] = sequences
+    _worker[ 'circle' ] = circle
+    _worker[ 'params' ] = params
+    _worker[ 'structure' ] = structure
+    _worker[ 'allow_extra_base_pairs' ] = allow_extra_base_pairs
+
+def get_shifted_log_Z( task ):
+    '''
+    log Z with log of parameter shifted by shift, for task ( parameter, shift ).
+    '''
+    ( parameter, shift ) = task
+    params = _worker[ 'params' ]
+    save_val = params.get_parameter_value( parameter )
+    params.set_parameter( parameter, exp( log( save_val ) + shift ) )
+    p = partition( _worker[ 'sequences' ], circle = _worker[ 'circle' ], params = params, suppress_all_output = True,
+                   structure = _worker[ 'structure' ], allow_extra_base_pairs = _worker[ 'allow_extra_base_pairs' ], production = True )
+    params.set_parameter( parameter, save_val )
+    return log( p.Z )
+
+def get_numerical_log_derivs( p, deriv_params, jobs = 1, central = False, epsilon = None ):
+    '''
+    d(log Z)/d(log parameter) for deriv_params by finite differences, rerunning partition() with the inputs of
+     Partition p for each shifted parameter, on jobs processes. Parameters that are zero get zero.
+    '''
+    skip = [ n for (n,parameter) in enumerate( deriv_params ) if p.params.get_parameter_value( parameter ) == 0.0 ]
+    worker_args = ( p.sequences, p.circle, p.params, p.structure_pair_table, p.allow_extra_base_pairs )
+    def evaluate( shifts ):
+        tasks = [ ( deriv_params[ n ], shift ) for ( n, shift ) in shifts ]
+        return map_tasks( get_shifted_log_Z, tasks, init_log_Z_worker, worker_args, jobs )
+    return get_numerical_derivs( evaluate, len( deriv_params ), log( p.Z ), central, epsilon, skip )
+
+##################################################################################################
+def get_relative_error( analytic, numerical ):
+    scale = max( abs( analytic ), abs( numerical ) )
+    if scale == 0.0: return 0.0
+    return abs( analytic - numerical ) / scale
+
+def show_deriv_check( parameters, analytic_derivs, numerical_derivs, title ):
+    '''
+    Table of analytic vs. numerical derivatives, with differences and relative errors.
+    Returns the relative errors.
+    '''
+    relative_errors = [ get_relative_error( analytic, numerical ) for ( analytic, numerical ) in zip( analytic_derivs, numerical_derivs ) ]
+    print()
+    print( '%20s %25s %25s' % ('','',title ) )
+    print( '%20s %25s %25s %25s %12s' % ('parameter','analytic','numerical','diff','rel. error' ) )
+    for ( parameter, analytic, numerical, relative_error ) in zip( parameters, analytic_derivs, numerical_derivs, relative_errors ):
+        print( '%20s %25.12f %25.12f %25.12f %12.3e' % ( parameter, analytic, numerical, analytic - numerical, relative_error ) )
+    if relative_errors:
+        n = max( range( len( relative_errors ) ), key = lambda n: relative_errors[ n ] )
+        print( 'Largest relative error: %.3e [%s]' % ( relative_errors[ n ], parameters[ n ] ) )
+    print()
+    return relative_errors
@@ -36,13 +36,13 @@ def _get_log_derivs( self, deriv_parameters = [] ):
                 for j in range( i+2, N ):
                     if not self.ligated[i]: continue
                     if not self.ligated[j-1]: continue
-                    num_loops += self.params.l**2 * self.params.l_BP * C_eff_for_BP.val(i+1,j-1) * self.Z_BP.val(j,i) / self.Z_final.val(0)
+                    num_loops += self.compiled.l2_l_BP * C_eff_for_BP.val(i+1,j-1) * self.Z_BP.val(j,i) / self.Z_final.val(0)
                     if self.params.K_coax > 0.0:
                         offset = j - i
                         for k in range( i+2, i+offset-1 ):
-                            if self.ligated[k]  : num_loops += self.Z_BP.val(i+1,k) * C_eff_for_coax.val(k+1,j-1) * self.params.l**2 * self.params.l_coax * self.params.K_coax * self.Z_BP.val(j,i) / self.Z_final.val(0)
+                            if self.ligated[k]  : num_loops += self.Z_BP.val(i+1,k) * C_eff_for_coax.val(k+1,j-1) * self.compiled.l2_l_coax_K_coax * self.Z_BP.val(j,i) / self.Z_final.val(0)
                         for k in range( i+2, i+offset-1 ):
-                            if self.ligated[k-1]: num_loops += C_eff_for_coax.val(i+1,k-1) * self.Z_BP.val(k,j-1) * self.params.l**2 * self.params.l_coax * self.params.K_coax * self.Z_BP.val(j,i) / self.Z_final.val(0)
+                            if self.ligated[k-1]: num_loops += C_eff_for_coax.val(i+1,k-1) * self.Z_BP.val(k,j-1) * self.compiled.l2_l_coax_K_coax * self.Z_BP.val(j,i) / self.Z_final.val(0)
 
             # one more loop if RNA is a circle.
             if self.ligated[ N-1 ]: num_loops += 1
@@ -128,7 +128,7 @@ def get_num_base_pairs_closed_by_loops( self ):
             if ( j - i ) % N < 2: continue
             if not self.ligated[i]: continue
             if not self.ligated[(j-1)%N]: continue
-            num_base_pairs_closed_by_loops += self.params.l**2 * self.params.l_BP * self.C_eff.val(i+1,j-1) * self.Z_BP.val(j,i) / self.Z_final.val(0)
+            num_base_pairs_closed_by_loops += self.compiled.l2_l_BP * self.C_eff.val(i+1,j-1) * self.Z_BP.val(j,i) / self.Z_final.val(0)
     return num_base_pairs_closed_by_loops
 
 def get_motif_prob( self, base_pair_type, base_pair_type2 ):
@@ -143,6 +143,7 @@ def get_motif_prob( self, base_pair_type, base_pair_type2 ):
     motif_prob = 0.0
     Z_BPq1 = self.Z_BPq[base_pair_type.flipped]
     Z_BPq2 = self.Z_BPq[base_pair_type2]
+    C_eff_stack = self.compiled.C_eff_stack[ self.compiled.base_pair_type_index[ base_pair_type ] ][ self.compiled.base_pair_type_index[ base_pair_type2 ] ]
     N = self.N
     for i in range( N ):
         for j in range( N ):
@@ -151,7 +152,7 @@ def get_motif_prob( self, base_pair_type, base_pair_type2 ):
             if not self.ligated[(j-1)%N]: continue
             if not base_pair_type.flipped.is_match( self.sequence[j],self.sequence[i] ): continue
             if not base_pair_type2       .is_match( self.sequence[(i+1)%N],self.sequence[(j-1)%N] ): continue
-            motif_prob += self.params.C_eff_stack[base_pair_type][base_pair_type2] * Z_BPq1.val(j,i) * Z_BPq2.val(i+1,j-1) / self.Z_final.val(0)
+            motif_prob += C_eff_stack * Z_BPq1.val(j,i) * Z_BPq2.val(i+1,j-1) / self.Z_final.val(0)
     if base_pair_type == base_pair_type2.flipped: motif_prob /= 2.0 # symmetry correction
     return motif_prob
 
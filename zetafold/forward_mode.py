@@ -0,0 +1,198 @@
+from __future__ import print_function
+import numpy as np
+from .derivatives import _get_log_derivs
+from .parameters import CompiledParams
+from .adjoint import ParameterMonomial, get_parameter_slots, get_slots_for_parameter, get_diagonal_values, _combined_powers
+
+##################################################################################################
+# Forward-mode derivatives carried along with the dynamic programming.
+#
+# Each DP cell holds dQ, a vector with
+#
+#      dQ[ n ] = d( Q )/d( log parameter_n )
+#
+#  for a chosen set of parameters. The recursions propagate dQ through each term by the product
+#  rule. The explicit dependence of a term on the parameters comes from evaluating the term
+#  with ParameterMonomials (see adjoint.py) in place of the parameters, so that the term value
+#  remembers which parameters went into it:
+#
+#      d( term )/d( log parameter_n ) = term * power of parameter_n
+#
+#  explicit_recursions.py does this for nonzero terms with forward_derivs.tagged, and leaves
+#  the parameters alone otherwise. The simple recursions read the parameters directly, so
+#  there the parameters are replaced by their tagged versions during the dynamic programming.
+#
+#  All the derivatives come out of the same sweep that computes Z.
+##################################################################################################
+def initialize_forward_derivs( self ):
+    '''
+    Figure out which parameters to carry along in dQ:
+       'Kd' (all base pair Kd's together) if calc_Kd_deriv_DP, and deriv_params if deriv_method is 'forward'.
+    If hessian_vector is given, dQ also carries the derivative along that direction in log-parameter space,
+     or along each direction if it is a list of vectors (see hessian.py).
+    '''
+    deriv_DP_params = []
+    if self.calc_Kd_deriv_DP: deriv_DP_params.append( 'Kd' )
+    if self.deriv_method == 'forward' and self.deriv_params != None:
+        if self.deriv_params == []:
+            for tag in self.params.parameter_tags: self.deriv_params.append( tag )
+        for parameter in self.deriv_params:
+            if can_carry_forward_deriv( self.params, parameter ) and not parameter in deriv_DP_params: deriv_DP_params.append( parameter )
+
+    directions = None
+    if self.hessian_vector is not None: directions = [ zip( self.deriv_params, vector ) for vector in np.atleast_2d( self.hessian_vector ) ]
+
+    self.options.forward_derivs = None
+    self.options.calc_deriv_DP = ( len( deriv_DP_params ) > 0 or directions != None )
+    if self.options.calc_deriv_DP: self.options.forward_derivs = ForwardDerivs( self.params, deriv_DP_params, directions )
+
+def can_carry_forward_deriv( params, parameter ):
+    return ( parameter in params.parameter_tags ) or parameter == 'Kd'
+
+def _get_log_derivs_forward( self, deriv_parameters = [] ):
+    '''
+    Output
+
+       d( log Z )/ d( log parameter )
+
+    read off from Z_final.deriv(0), which was filled in along with Z. Any other requested
+    derivatives (e.g., 'C_eff_stacked_pair' when it is not a parameter in the file)
+    fall back to the expressions in derivatives.py.
+    '''
+    if deriv_parameters == None: return None
+    if deriv_parameters == []:
+        for tag in self.params.parameter_tags: deriv_parameters.append( tag )
+
+    Z = self.Z_final.val( 0 )
+    forward_derivs = self.options.forward_derivs
+    derivs = [None]*len(deriv_parameters)
+    for n,parameter in enumerate( deriv_parameters ):
+        if forward_derivs and parameter in forward_derivs.deriv_params:
+            derivs[ n ] = 0.0
+            if Z > 0.0: derivs[ n ] = self.Z_final.deriv( 0 )[ forward_derivs.deriv_params.index( parameter ) ] / Z
+        else:
+            derivs[ n ] = _get_log_derivs( self, [ parameter ] )[ 0 ]
+    return derivs
+
+##################################################################################################
+class ForwardDerivs:
+    '''
+    Bookkeeping for the parameters carried in dQ: which parameter slots (see get_parameter_slots())
+     each one controls, and the vector d( log X )/d( log parameter ) for products X of parameters.
+
+    directions is an optional list of directions, each a list of (parameter, weight); their directional
+     derivatives are carried in further entries of dQ, at direction_lanes (a slice), after the entries for deriv_params.
+    '''
+    def __init__( self, params, deriv_params, directions = None ):
+        self.deriv_params = deriv_params
+        self.size = len( deriv_params )
+        self.direction_lanes = None
+        if directions != None:
+            self.direction_lanes = slice( self.size, self.size + len( directions ) )
+            self.size += len( directions )
+        self.slots = get_parameter_slots( params )
+        self.slot_vectors = {}
+        for n,parameter in enumerate( deriv_params ):
+            for m in self.get_slots( params, parameter ): self.add_to_slot_vector( m, n, 1.0 )
+        if directions != None:
+            for k,direction in enumerate( directions ):
+                for (parameter,weight) in direction:
+                    for m in self.get_slots( params, parameter ): self.add_to_slot_vector( m, self.direction_lanes.start + k, weight )
+        self.tagged_vals = {}
+        for m in self.slot_vectors:
+            (d,key) = self.slots[ m ]
+            self.tagged_vals[ m ] = ParameterMonomial( d[ key ], { m:1 } )
+        self.tagged = TaggedParameters( params, self.slots, self.tagged_vals )
+        self.vectors = {}
+        self.save_vals = None
+
+    def get_slots( self, params, parameter ):
+        if parameter in params.parameter_tags: return get_slots_for_parameter( params, self.slots, parameter )
+        assert( parameter == 'Kd' ) # all base pair types together
+        Kd_dicts = [ vars( base_pair_type ) for base_pair_type in params.base_pair_types ]
+        return [ m for m,(d,key) in enumerate( self.slots ) if key == 'Kd' and any( d is Kd_dict for Kd_dict in Kd_dicts ) ]
+
+    def add_to_slot_vector( self, m, lane, weight ):
+        if not m in self.slot_vectors: self.slot_vectors[ m ] = np.zeros( self.size )
+        self.slot_vectors[ m ][ lane ] += weight
+
+    def zeros( self ): return np.zeros( self.size )
+
+    def tag_parameters( self ):
+        '''
+        Swap in tagged parameters, for the simple recursions. Only the slots that matter for
+         deriv_params get tagged -- the rest of the parameters stay plain floats.
+        '''
+        self.save_vals = {}
+        for m,val in self.tagged_vals.items():
+            (d,key) = self.slots[ m ]
+            self.save_vals[ m ] = d[ key ]
+            d[ key ] = val
+
+    def restore_parameters( self ):
+        for m,val in self.save_vals.items():
+            (d,key) = self.slots[ m ]
+            d[ key ] = val
+        self.save_vals = None
+
+    def clear( self ):
+        self.vectors.clear()
+        _combined_powers.clear()
+
+    def vector( self, val ):
+        '''
+        d( log val )/d( log parameter ) for each parameter in deriv_params, where val is a tagged parameter
+         or product of parameters. Zero for plain floats.
+        '''
+        if not isinstance( val, ParameterMonomial ): return 0.0
+        key = id( val.powers )
+        if not key in self.vectors:
+            vector = self.zeros()
+            for m,power in val.powers.items():
+                if m in self.slot_vectors: vector += power * self.slot_vectors[ m ]
+            self.vectors[ key ] = ( vector, val.powers ) # hold on to powers so its id stays unique
+        return self.vectors[ key ][ 0 ]
+
+    def log_derivs( self, val ):
+        '''
+        d( val )/d( log parameter ) due to the explicit dependence of a term val on the parameters.
+        '''
+        if not isinstance( val, ParameterMonomial ): return 0.0
+        return self.vector( val ) * val
+
+class TaggedParameters:
+    '''
+    Copies of the parameters the recursions read, with tagged values for slots in tagged_vals:
+      tagged.C_init, tagged.l, ...,  tagged.Kd[ base_pair_type ], tagged.C_eff[ motif_type ],
+      and tagged.C_eff_stack[ base_pair_type1 ][ base_pair_type2 ] -- as well as tagged.compiled, the
+      CompiledParams made from those values.
+    '''
+    def __init__( self, params, slots, tagged_vals ):
+        slot_idx = {}
+        for m,(d,key) in enumerate( slots ): slot_idx[ (id( d ), key) ] = m
+        def get_val( d, key ):
+            m = slot_idx[ (id( d ), key) ]
+            return tagged_vals[ m ] if m in tagged_vals else d[ key ]
+
+        for attr in vars( params ):
+            if (id( vars( params ) ), attr) in slot_idx: setattr( self, attr, get_val( vars( params ), attr ) )
+        self.Kd = {}
+        for base_pair_type in params.base_pair_types: self.Kd[ base_pair_type ] = get_val( vars( base_pair_type ), 'Kd' )
+        self.C_eff = {}
+        for motif_type in params.motif_types: self.C_eff[ motif_type ] = get_val( vars( motif_type ), 'C_eff' )
+        self.C_eff_stack = {}
+        for bpt1 in params.base_pair_types:
+            self.C_eff_stack[ bpt1 ] = {}
+            for bpt2 in params.base_pair_types: self.C_eff_stack[ bpt1 ][ bpt2 ] = get_val( params.C_eff_stack[ bpt1 ], bpt2 )
+        self.compiled = CompiledParams( params.base_pair_types, self.Kd, self.C_eff_stack, self.l, self.l_BP, self.l_coax, self.K_coax, self.C_std )
+
+def initialize_diagonal_derivs( self ):
+    '''
+    The diagonal values set in initialize_dynamic_programming_matrices() depend on parameters too.
+    '''
+    forward_derivs = self.options.forward_derivs
+    for X,diag_val in get_diagonal_values( self ):
+        assert( diag_val == self.params.C_init )
+        for i in range( self.N ):
+            if X.val( i, i ) == 0.0: continue # e.g., forced base pairs
+            X.set_deriv( i, i, forward_derivs.log_derivs( forward_derivs.tagged.C_init ) )
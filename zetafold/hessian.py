@@ -0,0 +1,144 @@
+from __future__ import print_function
+import numpy as np
+from .parameters import compile_params
+from .adjoint import ParameterMonomial, get_parameter_slots, get_slots_for_parameter, get_diagonal_values, tag_parameter_slots, restore_parameter_slots, _combined_powers
+
+##################################################################################################
+# Hessian-vector products of log Z, by 'forward-over-reverse' differentiation.
+#
+# The reverse sweep in adjoint.py gives the gradient
+#
+#      g = d(log Z)/d(log parameter)
+#
+#  as a sum over terms of Z_bar(cell) * term * power. Differentiating every quantity in that
+#  sweep along a direction v in log-parameter space gives the Hessian-vector product
+#
+#      H v = d( g )/d( log parameter ) . v
+#
+#  The only new ingredients are the derivatives of the DP cells along v, which forward mode
+#  (see forward_mode.py) carries in one extra entry of dQ during the dynamic programming. So
+#  H v costs one forward-mode fill plus one reverse sweep, independent of the number of parameters.
+#
+#  Several directions can go through the same fill and sweep, each in its own entry of dQ -- all the
+#  quantities along the directions below are then numpy vectors with one entry per direction.
+##################################################################################################
+def _get_log_derivs_hessian_vector( self, deriv_parameters, hessian_vector ):
+    '''
+    Output
+
+       d( log Z )/ d( log parameter ),
+       sum_k d^2( log Z )/ d( log parameter ) d( log parameter_k ) * hessian_vector[ k ]
+
+    for parameters in params.parameter_tags -- or, if hessian_vector is a list of vectors, a list
+    with that sum for each of them. Requires that partition() carried the derivatives along
+    hessian_vector in dQ.
+    '''
+    for parameter in deriv_parameters: assert( parameter in self.params.parameter_tags )
+    forward_derivs = self.options.forward_derivs
+    lanes = forward_derivs.direction_lanes
+
+    slots = get_parameter_slots( self.params )
+    slot_tangents = [0.0]*len( slots )
+    for m,vector in forward_derivs.slot_vectors.items(): slot_tangents[ m ] = vector[ lanes ]
+    ( slot_log_derivs, slot_log_derivs_dot ) = get_slot_log_derivs_and_tangents( self, slots, slot_tangents, lanes )
+
+    derivs = [None]*len(deriv_parameters)
+    hessian_vector_products = np.zeros( ( lanes.stop - lanes.start, len( deriv_parameters ) ) )
+    for n,parameter in enumerate( deriv_parameters ):
+        slot_idxs = get_slots_for_parameter( self.params, slots, parameter )
+        derivs[ n ] = sum( slot_log_derivs[ m ] for m in slot_idxs )
+        for m in slot_idxs: hessian_vector_products[ :, n ] += slot_log_derivs_dot[ m ]
+    if np.ndim( hessian_vector ) == 1: return ( derivs, list( hessian_vector_products[ 0 ] ) )
+    return ( derivs, [ list( product ) for product in hessian_vector_products ] )
+
+##################################################################################################
+def get_slot_log_derivs_and_tangents( self, slots, slot_tangents, lanes ):
+    '''
+    Same sweep as get_slot_log_derivs_from_contribs() in adjoint.py, but also carrying the derivative of each
+     quantity along the directions whose slot log-derivatives are slot_tangents. Derivatives of the
+     DP cells along those directions are read off from entries lanes (a slice) of X.deriv( i, j ).
+    '''
+    N = self.N
+    Z = self.Z_final.val( 0 )
+    num_lanes = lanes.stop - lanes.start
+    slot_log_derivs     = [0.0]*len( slots )
+    slot_log_derivs_dot = [ np.zeros( num_lanes ) for m in range( len( slots ) ) ]
+    if Z == 0.0: return ( slot_log_derivs, slot_log_derivs_dot )
+    Z_dot = self.Z_final.deriv( 0 )[ lanes ]
+
+    # Z_bar = d( log Z )/d( cell ), and Z_bar_dot is its derivative along the directions.
+    Z_bar = {}
+    Z_bar_dot = {}
+    for X in self.Z_all:
+        Z_bar[ X ]     = [ [0.0]*N for i in range( N ) ]
+        Z_bar_dot[ X ] = np.zeros( ( N, N, num_lanes ) )
+    sweep = TangentSweep( Z_bar, Z_bar_dot, slot_log_derivs, slot_log_derivs_dot, slot_tangents, lanes )
+
+    save_vals = tag_parameter_slots( slots )
+    try:
+        self.compiled = compile_params( self.params )
+        self.Z_final.contribs_updated[ 0 ] = False
+        sweep.backpropagate( self.Z_final.get_contribs( self, 0 ), 1.0/Z, -Z_dot/Z**2 )
+
+        for offset in range( N-1, 0, -1 ):
+            for i in range( N-1, -1, -1 ):
+                if (not self.calc_all_elements) and ( i + offset ) >= self.N: continue
+                j = (i + offset) % N
+                for X in reversed( self.Z_all ):
+                    if Z_bar[ X ][ i ][ j ] == 0.0 and not Z_bar_dot[ X ][ i ][ j ].any(): continue
+                    X.contribs_updated[ i ][ j ] = False
+                    sweep.backpropagate( X.get_contribs( self, i, j ), Z_bar[ X ][ i ][ j ], Z_bar_dot[ X ][ i ][ j ] )
+
+        for X,diag_val in get_diagonal_values( self ):
+            for i in range( N ):
+                if X.val( i, i ) == 0.0: continue # e.g., forced base pairs
+                sweep.backpropagate( [ (diag_val, []) ], Z_bar[ X ][ i ][ i ], Z_bar_dot[ X ][ i ][ i ] )
+    finally:
+        restore_parameter_slots( slots, save_vals )
+        self.compiled = self.params.get_compiled()
+        _combined_powers.clear()
+
+    return ( slot_log_derivs, slot_log_derivs_dot )
+
+class TangentSweep:
+    '''
+    Accumulators for get_slot_log_derivs_and_tangents(), with the tangent version of backpropagate() in adjoint.py.
+    '''
+    def __init__( self, Z_bar, Z_bar_dot, slot_log_derivs, slot_log_derivs_dot, slot_tangents, lanes ):
+        self.Z_bar = Z_bar
+        self.Z_bar_dot = Z_bar_dot
+        self.slot_log_derivs = slot_log_derivs
+        self.slot_log_derivs_dot = slot_log_derivs_dot
+        self.slot_tangents = slot_tangents
+        self.lanes = lanes
+
+    def backpropagate( self, contribs, weight, weight_dot ):
+        '''
+        contribs are the terms [ value, [ (DP matrix, i, j), ... ] ] that were summed into one cell, weight is
+        d( log Z )/ d( that cell ), and weight_dot is the derivative of weight along the directions.
+        '''
+        for contrib in contribs:
+            val = contrib[ 0 ]
+            if val == 0.0: continue
+            powers = val.powers if isinstance( val, ParameterMonomial ) else {}
+            val = float( val )
+            w = weight * val
+
+            # derivative of log( term ) along the directions -- from parameters, and from DP cells.
+            log_val_dot = 0.0
+            for n,power in powers.items(): log_val_dot += power * self.slot_tangents[ n ]
+            cell_log_dots = []
+            for (X,i,j) in contrib[ 1 ]:
+                cell_log_dot = X.deriv( i, j )[ self.lanes ] / X.val( i, j )
+                cell_log_dots.append( cell_log_dot )
+                log_val_dot += cell_log_dot
+            w_dot = weight_dot * val + w * log_val_dot
+            if w == 0.0 and not w_dot.any(): continue
+
+            for n,power in powers.items():
+                self.slot_log_derivs[ n ]     += power * w
+                self.slot_log_derivs_dot[ n ] += power * w_dot
+            for (X,i,j),cell_log_dot in zip( contrib[ 1 ], cell_log_dots ):
+                Y = X.val( i, j )
+                self.Z_bar[ X ][ i ][ j ]     += w / Y
+                self.Z_bar_dot[ X ][ i ][ j ] += ( w_dot - w * cell_log_dot ) / Y
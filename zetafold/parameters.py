@@ -5,6 +5,8 @@ from .util.constants import KT_IN_KCAL
 from .motif_types import MotifType, get_motif_type_for_tag
 import glob
 import os.path
+import copy
+import hashlib
 
 class AlphaFoldParams:
     '''
@@ -16,8 +18,10 @@ class AlphaFoldParams:
         self.motif_types = []
         self.parameter_tags   = [] # K_CG, etc.
         self.parameter_values = [] # floats
+        self.parameter_index  = {} # tag -> position in parameter_tags
         self.string_tags   = [] # name, version, etc.
         self.string_values = [] # strings
+        self.compiled = None # CompiledParams, built when needed
 
     def get_variables( self ):
         if self.C_init == 0.0 and self.name == 'empty': print('WARNING! C_init not defined, and params appear empty. Look at get_params() for examples')
@@ -27,8 +31,29 @@ class AlphaFoldParams:
         val = _set_parameter( self, tag, val )
 
     def get_parameter_value( self, param_tag ):
-        if self.parameter_tags.count( param_tag ) == 0: return None
-        return self.parameter_values[ self.parameter_tags.index( param_tag ) ]
+        if not param_tag in self.parameter_index: return None
+        return self.parameter_values[ self.parameter_index[ param_tag ] ]
+
+    def get_compiled( self ):
+        '''
+        CompiledParams for the current parameter values -- rebuilt after any set_parameter().
+        '''
+        if self.compiled == None: self.compiled = compile_params( self )
+        return self.compiled
+
+    def get_fingerprint( self ):
+        '''
+        Hex digest of the settings and parameter values (but not name or version), in the order they were set.
+        Two parameter sets with the same fingerprint give the same partition functions.
+        '''
+        fingerprint = hashlib.sha1()
+        for tag,val in zip( self.string_tags, self.string_values ):
+            if tag in ('name','version'): continue
+            fingerprint.update( '%s %s\n' % (tag,val) )
+        for tag,val in zip( self.parameter_tags, self.parameter_values ): fingerprint.update( '%s %r\n' % (tag,val) )
+        return fingerprint.hexdigest()
+
+    def copy( self ): return copy_params( self )
 
     def check_C_eff_stack( self ): _check_C_eff_stack( self )
 
@@ -40,7 +65,8 @@ class AlphaFoldParams:
 
 def get_params( params = None, suppress_all_output = False ):
     '''
-    master function to get parameters
+    master function to get parameters. An AlphaFoldParams object is passed through as is;
+     parameters named by file come back as a fresh copy, which the caller is free to change.
     '''
     params_object = None
     if isinstance(params,AlphaFoldParams): return params
@@ -71,36 +97,90 @@ def read_params_fields( params_file ):
             if len( cols ) > 2: assert( cols[2][0] == '#' ) # better be a comment
     return zip( tags, vals )
 
-def get_params_from_file( params_file_tag ):
+def find_params_file( params_file_tag ):
     '''
-    find the file (if it exists) and then load up into params variables.
+    path to the file for params_file_tag (e.g., 'v0.20', 'minimal', or an actual file), or None
     '''
-    params = AlphaFoldParams()
     params_file = params_file_tag
     if not os.path.exists( params_file ): params_file = params_file_tag +'.params'
     if not os.path.exists( params_file ): params_file = os.path.dirname( os.path.abspath(__file__) ) + '/parameters/'+params_file_tag +'.params'
     if not os.path.exists( params_file ): params_file = os.path.dirname( os.path.abspath(__file__) ) + '/parameters/zetafold_'+params_file_tag +'.params'
-    if not os.path.exists( params_file ):
+    if not os.path.exists( params_file ): return None
+    return os.path.abspath( params_file )
+
+def get_params_from_file( params_file_tag ):
+    '''
+    find the file (if it exists) and then load up into params variables.
+    Each file is only read once (or again if it changes); callers get their own copy.
+    '''
+    params_file = find_params_file( params_file_tag )
+    if params_file == None:
         print()
         print( 'Could not find requested parameters:', params_file_tag )
         print( 'Options are: ' )
         for params_file in get_all_params_files(): print('  ',params_file)
         print()
         return None
+    return copy_params( load_params_file( params_file ) )
+
+_params_file_cache = {}
+
+def load_params_file( params_file ):
+    '''
+    AlphaFoldParams read from params_file, cached by path and modification time -- don't change it!
+    '''
+    stat = os.stat( params_file )
+    file_key = ( stat.st_size, stat.st_mtime )
+    if params_file in _params_file_cache and _params_file_cache[ params_file ][ 0 ] == file_key:
+        return _params_file_cache[ params_file ][ 1 ]
+    params = AlphaFoldParams()
     params_fields = read_params_fields( params_file );
     for param_tag,param_val in params_fields:
         val = _set_parameter( params, param_tag, param_val )
-
+    _params_file_cache[ params_file ] = ( file_key, params )
     return params
 
+_latest_params_file = {}
+
 def get_latest_params():
     '''
     look for parameters/zetafold_v*.*.params and choose latest
     '''
     params_dir =  os.path.dirname( os.path.abspath(__file__) ) + '/parameters/'
-    params_files = glob.glob( params_dir+'zetafold*.params' )
-    params_files.sort()
-    return get_params_from_file( params_files[-1] )
+    # only need to look again if a file was added to or removed from the directory.
+    dir_mtime = os.stat( params_dir ).st_mtime
+    if _latest_params_file.get( params_dir, (None,None) )[ 0 ] != dir_mtime:
+        params_files = glob.glob( params_dir+'zetafold*.params' )
+        params_files.sort()
+        _latest_params_file[ params_dir ] = ( dir_mtime, params_files[-1] )
+    return get_params_from_file( _latest_params_file[ params_dir ][ 1 ] )
+
+def copy_params( params ):
+    '''
+    Copy of params that can be changed (e.g., with set_parameter) without affecting the original.
+    Base pair types and motif types are copied too, and C_eff_stack is keyed by the copies.
+    '''
+    new_params = copy.copy( params )
+    bpt_copies = dict( (bpt, copy.copy( bpt )) for bpt in params.base_pair_types )
+    for bpt in bpt_copies.values(): bpt.flipped = bpt_copies[ bpt.flipped ]
+    new_params.base_pair_types = [ bpt_copies[ bpt ] for bpt in params.base_pair_types ]
+    motif_copies = dict( (motif_type, copy.copy( motif_type )) for motif_type in params.motif_types )
+    for motif_type in motif_copies.values():
+        motif_type.start_base_pair_type = bpt_copies[ motif_type.start_base_pair_type ]
+        motif_type.base_pair_types = [ bpt_copies[ bpt ] for bpt in motif_type.base_pair_types ]
+        motif_type.strands = list( motif_type.strands )
+        motif_type.permuted = motif_copies.get( motif_type.permuted )
+    new_params.motif_types = [ motif_copies[ motif_type ] for motif_type in params.motif_types ]
+    if hasattr( params, 'C_eff_stack' ):
+        new_params.C_eff_stack = dict( (bpt_copies[ bpt1 ], dict( (bpt_copies[ bpt2 ], val) for (bpt2,val) in C_eff_stack_bpt1.items() ) )
+                                       for (bpt1,C_eff_stack_bpt1) in params.C_eff_stack.items() )
+    new_params.parameter_tags   = list( params.parameter_tags )
+    new_params.parameter_values = list( params.parameter_values )
+    new_params.parameter_index  = dict( params.parameter_index )
+    new_params.string_tags   = list( params.string_tags )
+    new_params.string_values = list( params.string_values )
+    new_params.compiled = None
+    return new_params
 
 def get_all_params_files():
     '''
@@ -162,17 +242,54 @@ def _set_parameter( self, tag, val ):
             exit()
         setattr( self, tag, float( val ) )
         float_parameter = True
+    self.compiled = None
     if float_parameter:
-        if self.parameter_tags.count( tag ) == 0:
+        if not tag in self.parameter_index:
+            self.parameter_index[ tag ] = len( self.parameter_tags )
             self.parameter_tags.append( tag )
             self.parameter_values.append( None )
-        self.parameter_values[ self.parameter_tags.index( tag ) ] = float(val)
+        self.parameter_values[ self.parameter_index[ tag ] ] = float(val)
     else:
         if self.string_tags.count( tag ) == 0:
             self.string_tags.append( tag )
             self.string_values.append( None )
         self.string_values[ self.string_tags.index( tag ) ] = val
 
+class CompiledParams:
+    '''
+    Flat view of the parameters for the recursions, with base pair types numbered q in the
+     order of base_pair_types ( base_pair_type_index[ base_pair_type ] = q ):
+
+       Kd[ q ], C_eff_stack[ q ][ q2 ]
+
+     and the products that go with each base pair:
+
+       loop_weight[ q ]        = l^2 l_BP / Kd          (base pair closes a loop)
+       stack_weight[ q ][ q2 ] = C_eff_stack / Kd       (stacked pair)
+       cut_weight[ q ]         = C_std / Kd             (base pair connects strands)
+       coax_loop_weight[ q ]   = l^2 l_coax K_coax / Kd (coaxial stack, closing a loop)
+       coax_cut_weight[ q ]    = C_std K_coax / Kd      (coaxial stack, connecting strands)
+
+     and l2_l_BP = l^2 l_BP, l2_l_coax_K_coax = l^2 l_coax K_coax.
+    Kd and C_eff_stack come in as dicts keyed by base pair type. Values may be ParameterMonomials
+     (see adjoint.py), so everything is kept in plain lists.
+    '''
+    def __init__( self, base_pair_types, Kd, C_eff_stack, l, l_BP, l_coax, K_coax, C_std ):
+        self.base_pair_type_index = dict( (base_pair_type,q) for (q,base_pair_type) in enumerate( base_pair_types ) )
+        self.Kd = [ Kd[ base_pair_type ] for base_pair_type in base_pair_types ]
+        self.C_eff_stack = [ [ C_eff_stack[ bpt1 ][ bpt2 ] for bpt2 in base_pair_types ] for bpt1 in base_pair_types ]
+        self.l2_l_BP = l * l * l_BP
+        self.l2_l_coax_K_coax = l * l * l_coax * K_coax
+        self.loop_weight      = [ ( 1.0/Kdq ) * self.l2_l_BP for Kdq in self.Kd ]
+        self.stack_weight     = [ [ ( 1.0/Kdq ) * C_eff_stack_q2 for C_eff_stack_q2 in C_eff_stack_q ] for (Kdq, C_eff_stack_q) in zip( self.Kd, self.C_eff_stack ) ]
+        self.cut_weight       = [ C_std / Kdq for Kdq in self.Kd ]
+        self.coax_loop_weight = [ self.l2_l_coax_K_coax / Kdq for Kdq in self.Kd ]
+        self.coax_cut_weight  = [ C_std * K_coax / Kdq for Kdq in self.Kd ]
+
+def compile_params( params ):
+    Kd = dict( (base_pair_type, base_pair_type.Kd) for base_pair_type in params.base_pair_types )
+    return CompiledParams( params.base_pair_types, Kd, params.C_eff_stack, params.l, params.l_BP, params.l_coax, params.K_coax, params.C_std )
+
 def update_C_eff_stack( params, val = None ):
     if not hasattr( params, 'C_eff_stack' ): params.C_eff_stack = {}
     for bpt1 in params.base_pair_types:
@@ -242,9 +359,9 @@ def setup_motif_type_by_tag( params, motif_type_tag, val ):
 
     motif_type = get_motif_type_for_tag( params, motif_type_tag )
     if motif_type:
-        motif_type.Kd = val
+        motif_type.C_eff = val
         # actually should generalize to all 'permutations' of N-way junction
-        motif_type.permuted.Kd = val
+        motif_type.permuted.C_eff = val
     else:
         motif_type1 = MotifType( start_base_pair_type, strands, base_pair_types, val )
         params.motif_types.append( motif_type1 )
@@ -2,16 +2,19 @@ from __future__ import print_function
 import sys,os
 if __package__ == None: sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from zetafold.backtrack  import mfe, boltzmann_sample, enumerative_backtrack
-from zetafold.parameters import get_params
-from zetafold.util.wrapped_array  import WrappedArray, initialize_matrix
+from zetafold.parameters import get_params, compile_params
+from zetafold.util.wrapped_array  import WrappedArray
 from zetafold.util.secstruct_util import *
 from zetafold.util.output_util    import _show_results, _show_matrices
 from zetafold.util.sequence_util  import initialize_sequence_and_ligated, initialize_all_ligated, get_num_strand_connections
 from zetafold.util.constants import KT_IN_KCAL
 from zetafold.util.assert_equal import assert_equal
 from zetafold.derivatives import _get_log_derivs
-import score_structure
+from zetafold.adjoint import _get_log_derivs_adjoint
+from zetafold.forward_mode import _get_log_derivs_forward, initialize_forward_derivs, initialize_diagonal_derivs
 from math import log, exp
+import numpy as np
+import random
 
 ##################################################################################################
 def partition( sequences, circle = False, params = '', mfe = False, calc_bpp = False,
@@ -19,8 +22,11 @@ def partition( sequences, circle = False, params = '', mfe = False, calc_bpp = F
                calc_gap_structure = None,
                no_coax = False,
                verbose = False,  suppress_all_output = False, suppress_bpp_output = False,
-               deriv_params = None,
-               calc_Kd_deriv_DP = False, use_simple_recursions = False, deriv_check = False  ):
+               deriv_params = None, deriv_method = 'analytic', hessian_vector = None,
+               calc_Kd_deriv_DP = False, use_simple_recursions = False, deriv_check = False,
+               bpp_file = 'bpp.txt', bpp_format = None, bpp_cutoff = 0.0, bpp_plot = True,
+               production = False, n_spot_check = 0, deriv_check_jobs = 1, central_differences = False,
+               calc_stats = False ):
     '''
     Wrapper function into Partition() class
     Returns Partition object p which holds results like:
@@ -30,24 +36,65 @@ def partition( sequences, circle = False, params = '', mfe = False, calc_bpp = F
       p.struct_MFE = minimum free energy secondary structure in dot-parens notation
       p.bps_MFE  = minimum free energy secondary structure as sorted list of base pairs
       p.dZ_dKd_DP = derivative of Z w.r.t. Kd computed in-line with dynamic programming (if requested by user with calc_Kd_deriv_DP = True)
+      p.log_derivs = d(log Z)/d(log parameter) for deriv_params, computed with deriv_method:
+                      'analytic' (expressions in derivatives.py), 'adjoint' (reverse sweep in adjoint.py),
+                      or 'forward' (carried along with dynamic programming, see forward_mode.py)
+      p.log_derivs_hessian_vector = Hessian of log Z w.r.t. log deriv_params, times hessian_vector (if requested by user
+                      with hessian_vector, one entry per deriv_param; see hessian.py). hessian_vector can also be
+                      a list of such vectors, to get all their products from one fold.
+
+    structure (base pairs to force) can be dot-parens or a pair table (see secstruct_util.py); a pair table
+     skips parsing, e.g., in training, where the same structures are forced over and over.
+
+    Unless output is suppressed, base pair probabilities go to bpp_file, in bpp_format ('matrix', 'sparse', 'npy',
+     or 'npz'; default from the file extension, see output_util.py), leaving out pairs below bpp_cutoff in the
+     sparse formats. The heatmap goes next to it as .png, unless bpp_plot = False.
+
+    By default (validation), Z_final is computed from all N starting positions and checked to agree, and the MFE
+     is backtracked from each of them. With production = True, only one Z_final and one backtrack are computed,
+     plus n_spot_check randomly chosen other starting positions to check. Outputs are the same either way.
+
+    deriv_check compares log_derivs to finite differences (see deriv_check.py), rerunning partition() for each
+     parameter on deriv_check_jobs processes, with one-sided differences or, if central_differences, central ones.
+
+    With calc_stats = True, p.stats holds call counts and times for each update function in the recursions,
+     and update counts, inner-loop iterations and times for each diagrammed term (see recursion_stats.py).
+     Shown with p.show_stats(). Otherwise p.stats = None and the recursions run without any instrumentation.
 
     '''
     if isinstance(params,str): params = get_params( params, suppress_all_output )
-    if no_coax:                params.K_coax = 0.0
+    if no_coax:                params.set_parameter( 'K_coax', 0.0 )
 
     p = Partition( sequences, params )
     p.use_simple_recursions = use_simple_recursions
     p.circle    = circle
-    p.structure = get_structure_string( structure )
+    p.structure_pair_table = get_pair_table( structure )
+    p.structure = None if isinstance( structure, np.ndarray ) else get_structure_string( structure ) # for display
     p.allow_extra_base_pairs = allow_extra_base_pairs
     p.calc_gap_structure = get_structure_string( calc_gap_structure )
     p.suppress_all_output = suppress_all_output
     p.suppress_bpp_output = suppress_bpp_output
-    p.options.calc_deriv_DP = calc_Kd_deriv_DP
+    p.bpp_file   = bpp_file
+    p.bpp_format = bpp_format
+    p.bpp_cutoff = bpp_cutoff
+    p.bpp_plot   = bpp_plot
+    p.production   = production
+    p.n_spot_check = n_spot_check
+    p.calc_Kd_deriv_DP = calc_Kd_deriv_DP
     if deriv_check and deriv_params == None: deriv_params = []
-    p.calc_all_elements = calc_bpp or (deriv_params != None)
+    p.calc_all_elements = calc_bpp or (deriv_params != None and deriv_method == 'analytic' and hessian_vector is None)
+    if deriv_params and deriv_method in ('adjoint','forward'):
+        # parameters that are not in the params file fall back to analytic expressions, which need all elements
+        for param in deriv_params:
+            if not param in params.parameter_tags: p.calc_all_elements = True
     p.deriv_params = deriv_params
+    p.deriv_method = deriv_method
+    if hessian_vector is not None: assert( deriv_params and np.shape( hessian_vector )[ -1 ] == len( deriv_params ) )
+    p.hessian_vector = hessian_vector
     p.deriv_check  = deriv_check
+    p.deriv_check_jobs = deriv_check_jobs
+    p.central_differences = central_differences
+    p.calc_stats = calc_stats
     p.run()
     if calc_bpp:         p.get_bpp_matrix()
     if mfe:              p.calc_mfe()
@@ -80,9 +127,21 @@ class Partition:
         self.calc_bpp = False
         self.base_pair_types = params.base_pair_types
         self.suppress_all_output = False
+        self.suppress_bpp_output = False
+        self.bpp_file   = 'bpp.txt'
+        self.bpp_format = None
+        self.bpp_cutoff = 0.0
+        self.bpp_plot   = True
+        self.production   = False
+        self.n_spot_check = 0
         self.structure = None
+        self.structure_pair_table = None
         self.allow_extra_base_pairs = None
         self.deriv_params = None
+        self.deriv_method = 'analytic'
+        self.calc_Kd_deriv_DP = False
+        self.hessian_vector = None
+        self.calc_stats = False
         self.options = PartitionOptions()
 
         # for output:
@@ -96,6 +155,8 @@ class Partition:
         self.struct_enumerate  = []
         self.log_derivs = []
         self.derivs     = []
+        self.log_derivs_hessian_vector = None
+        self.stats = None
         return
 
     ##############################################################################################
@@ -104,8 +165,17 @@ class Partition:
         Do the dynamic programming to fill partition function matrices
         '''
         initialize_sequence_information( self ) # N, sequence, ligated, all_ligated
+        initialize_forward_derivs( self ) # which parameters to carry along in dQ, if any
         initialize_dynamic_programming_matrices( self ) # ( Z_BP, C_eff, Z_linear, Z_cut, Z_coax, etc. )
         initialize_force_base_pair( self )
+        self.compiled = self.params.get_compiled() # parameter products, by base pair type index
+
+        forward_derivs = self.options.forward_derivs
+        if forward_derivs:
+            initialize_diagonal_derivs( self )
+            if self.use_simple_recursions:
+                forward_derivs.tag_parameters()
+                self.compiled = compile_params( self.params )
 
         # do the dynamic programming
         for offset in range( 1, self.N ): #length of subfragment
@@ -114,9 +184,23 @@ class Partition:
                 j = (i + offset) % self.N;  # N cyclizes
                 for Z in self.Z_all: Z.update( self, i, j )
 
-        for i in range( self.N): self.Z_final.update( self, i )
-
-        self.log_derivs = self.get_log_derivs( self.deriv_params )
+        self.check_positions = get_check_positions( self )
+        for i in self.check_positions: self.Z_final.update( self, i )
+
+        if forward_derivs:
+            if self.use_simple_recursions:
+                forward_derivs.restore_parameters()
+                self.compiled = self.params.get_compiled()
+            forward_derivs.clear()
+            # derivatives are all filled in -- later updates (e.g., to get contribs for backtracking) leave them alone.
+            self.options.calc_deriv_DP = False
+
+        if self.hessian_vector is not None:
+            # gradient comes out of the same reverse sweep
+            ( self.log_derivs, self.log_derivs_hessian_vector ) = self.get_log_derivs_hessian_vector( self.deriv_params, self.hessian_vector )
+        elif self.deriv_method == 'adjoint': self.log_derivs = self.get_log_derivs_adjoint( self.deriv_params )
+        elif self.deriv_method == 'forward': self.log_derivs = self.get_log_derivs_forward( self.deriv_params )
+        else:                                self.log_derivs = self.get_log_derivs( self.deriv_params )
         fill_in_outputs( self )
 
     # boring member functions -- defined later.
@@ -126,7 +210,13 @@ class Partition:
     def enumerative_backtrack( self ): _enumerative_backtrack( self )
     def show_results( self ): _show_results( self )
     def show_matrices( self ): _show_matrices( self )
+    def show_stats( self ): self.stats.show()
     def get_log_derivs( self, deriv_params ): return _get_log_derivs( self, deriv_params )
+    def get_log_derivs_adjoint( self, deriv_params ): return _get_log_derivs_adjoint( self, deriv_params )
+    def get_log_derivs_forward( self, deriv_params ): return _get_log_derivs_forward( self, deriv_params )
+    def get_log_derivs_hessian_vector( self, deriv_params, hessian_vector ):
+        from zetafold.hessian import _get_log_derivs_hessian_vector
+        return _get_log_derivs_hessian_vector( self, deriv_params, hessian_vector )
     def run_cross_checks( self ): _run_cross_checks( self )
     def calculate_energy_gap( self ): _calculate_energy_gap( self )
     def num_strand_connections( self ):  return get_num_strand_connections( self.sequences, self.circle)
@@ -135,7 +225,11 @@ class Partition:
 def fill_in_outputs( self ):
     self.Z  = self.Z_final.val(0)
     if self.Z > 0.0: self.dG = -KT_IN_KCAL * log( self.Z )
-    self.dZ_dKd_DP = self.Z_final.deriv(0)
+    self.dZ_dKd_DP = 0.0
+    if self.calc_Kd_deriv_DP:
+        # uh this is a hack -- only works for minimal model where all the Kd are the same
+        Kd = self.params.base_pair_types[0].Kd
+        self.dZ_dKd_DP = self.Z_final.deriv(0)[ self.options.forward_derivs.deriv_params.index( 'Kd' ) ] / Kd
     self.derivs = []
     if self.deriv_params:
         for n,log_deriv in enumerate(self.log_derivs):
@@ -162,11 +256,24 @@ def initialize_sequence_information( self ):
     self.N = len( self.sequence )
     self.all_ligated = initialize_all_ligated( self.ligated )
 
+##################################################################################################
+def get_check_positions( self ):
+    '''
+    Starting positions to compute Z_final from: all N for validation, or in production just 0, plus
+     n_spot_check random others if all elements are filled in (otherwise the others are not meaningful).
+    '''
+    if not self.production: return range( self.N )
+    if not self.calc_all_elements or self.n_spot_check <= 0: return [ 0 ]
+    return [ 0 ] + sorted( random.Random().sample( range( 1, self.N ), min( self.n_spot_check, self.N - 1 ) ) )
+
 ##################################################################################################
 class PartitionOptions:
     def __init__( self ):
         self.calc_deriv_DP = False
         self.calc_contrib  = False
+        self.calc_adjoint  = False
+        self.forward_derivs = None
+        self.adjoint_factors = None
 
 ##################################################################################################
 def initialize_dynamic_programming_matrices( self ):
@@ -185,6 +292,12 @@ def initialize_dynamic_programming_matrices( self ):
     if self.use_simple_recursions: # over-ride with simpler recursions that are easier for user to input.
         from zetafold.recursions.recursions import update_Z_BPq, update_Z_BP, update_Z_cut, update_Z_coax, update_C_eff_basic, update_C_eff_no_BP_singlet, update_C_eff_no_coax_singlet, update_C_eff, update_Z_final, update_Z_linear
         from zetafold.recursions.dynamic_programming import DynamicProgrammingMatrix, DynamicProgrammingList
+    if self.calc_stats: # same recursions, compiled again with counters and timers that fill in self.stats
+        from zetafold.recursions.recursion_stats import get_profiled_recursions, RecursionStats
+        recursions = get_profiled_recursions( self.use_simple_recursions )
+        ( update_Z_BPq, update_Z_BP, update_Z_cut, update_Z_coax, update_C_eff_basic, update_C_eff_no_BP_singlet, update_C_eff_no_coax_singlet, update_C_eff, update_Z_final, update_Z_linear ) = \
+            [ recursions[ name ] for name in ( 'update_Z_BPq', 'update_Z_BP', 'update_Z_cut', 'update_Z_coax', 'update_C_eff_basic', 'update_C_eff_no_BP_singlet', 'update_C_eff_no_coax_singlet', 'update_C_eff', 'update_Z_final', 'update_Z_linear' ) ]
+        self.stats = RecursionStats( recursions )
 
     N = self.N
 
@@ -223,9 +336,8 @@ def initialize_dynamic_programming_matrices( self ):
 def initialize_force_base_pair( self ):
     self.allow_base_pair     = None
     self.in_forced_base_pair = None
-    if self.structure != None:
-        bp_list = bps_from_secstruct( self.structure )
-    else: return
+    if self.structure_pair_table is None: return
+    bp_list = bps_from_pair_table( self.structure_pair_table )
 
     N = self.N
     self.in_forced_base_pair = [False] * N
@@ -239,32 +351,24 @@ def initialize_force_base_pair( self ):
         self.C_eff.set_val( i, i, 0.0 )
         self.C_eff.set_val( j, j, 0.0 )
 
-    if not self.allow_extra_base_pairs:
-        self.allow_base_pair = initialize_matrix( N, False )
-        # only allow base pairs specified in structure
-        for i,j in bp_list:
-            self.allow_base_pair[ i ][ j ] = True
-            self.allow_base_pair[ j ][ i ] = True
-    else:
-        assert( self.allow_extra_base_pairs )
-        # allow the specified base pairs (indeed, force them), but
-        #  also allow any base pairs that do not cross with them.
-        self.allow_base_pair = initialize_matrix( N, True )
-        for i,j in bp_list:
-            # no crossing pairs
-            for m in range( i+1, j ):
-                for n in range( j+1, i+N ):
-                    if (( m - n ) % N) == 0: continue
-                    self.allow_base_pair[ m ][ n ] = False
-                    self.allow_base_pair[ n ][ m ] = False
-            # no other partners
-            for m in range( N ):
-                if m != j:
-                    self.allow_base_pair[ i ][ m ] = False
-                    self.allow_base_pair[ m ][ i ] = False
-                if m != i:
-                    self.allow_base_pair[ j ][ m ] = False
-                    self.allow_base_pair[ m ][ j ] = False
+    self.allow_base_pair = get_allow_base_pair( self.structure_pair_table, self.allow_extra_base_pairs )
+
+_allow_base_pair_cache = {}
+max_allow_base_pair_cache_size = 10000
+
+def get_allow_base_pair( pair_table, allow_extra_base_pairs ):
+    '''
+    allow_base_pair[ i ][ j ] for forced structure pair_table (see get_allow_base_pair_mask() in secstruct_util),
+     as nested lists for fast lookup during the recursions. Masks are kept as bitsets between calls,
+     since training forces the same structures over and over.
+    '''
+    key = ( pair_table.tostring(), allow_extra_base_pairs )
+    N = len( pair_table )
+    if not key in _allow_base_pair_cache:
+        if len( _allow_base_pair_cache ) >= max_allow_base_pair_cache_size: _allow_base_pair_cache.clear()
+        mask = get_allow_base_pair_mask( pair_table, allow_extra_base_pairs )
+        _allow_base_pair_cache[ key ] = np.packbits( mask, axis = None )
+    return np.unpackbits( _allow_base_pair_cache[ key ] )[ : N*N ].reshape( N, N ).astype( bool ).tolist()
 
 ##################################################################################################
 def _get_bpp_matrix( self ):
@@ -299,13 +403,13 @@ def _calc_mfe( self ):
     p_MFE   = [0.0]*N
     bps_MFE = [[]]*N
 
-    # there are actually numerous ways to calculate MFE if we did all N^2 elements -- let's check.
-    n_test = N if self.calc_all_elements else 1
+    # there are actually numerous ways to calculate MFE if we did all N^2 elements -- let's check (unless in production).
+    test_positions = self.check_positions if self.calc_all_elements else [ 0 ]
     if not self.suppress_all_output:
         print('Doing backtrack to get minimum free energy structure...')
 
     all_bps_MFE = set()
-    for i in range( n_test ):
+    for i in test_positions:
         (bps_MFE[i], p_MFE[i] ) = mfe( self, self.Z_final.get_contribs(self,i) )
         if len(all_bps_MFE) > 0 and not ( tuple(bps_MFE[i]) in all_bps_MFE ):
             if not self.suppress_all_output:
@@ -348,17 +452,20 @@ def _enumerative_backtrack( self ):
 def _calculate_energy_gap( self ):
     # TODO: perhaps should also update derivs...
     assert( self.calc_gap_structure != None and len( self.calc_gap_structure ) > 0 )
-    dG = score_structure.score_structure( self.sequences, self.calc_gap_structure, circle = self.circle, params = self.params, allow_extra_base_pairs = self.allow_extra_base_pairs )
+    from zetafold.score_structure import score_structure # imports partition, so not at the top
+    dG = score_structure( self.sequences, self.calc_gap_structure, circle = self.circle, params = self.params, allow_extra_base_pairs = self.allow_extra_base_pairs )
     self.dG_gap = dG - self.dG
 
 ##################################################################################################
 def _run_cross_checks( self ):
-    # stringent test that partition function is correct -- all the Z(i,i) agree.
+    # stringent test that partition function is correct -- all the Z(i,i) agree (or the ones spot-checked in production).
     if self.calc_all_elements:
-        for i in range( self.N ): assert_equal( self.Z_final.val(0), self.Z_final.val(i) )
+        for i in self.check_positions: assert_equal( self.Z_final.val(0), self.Z_final.val(i) )
 
-        if self.options.calc_deriv_DP and self.Z_final.deriv(0) > 0:
-            for i in range( self.N ): assert_equal( self.Z_final.deriv(0), self.Z_final.deriv(i) )
+        if self.options.forward_derivs:
+            for n in range( self.options.forward_derivs.size ):
+                if self.Z_final.deriv(0)[n] == 0.0: continue
+                for i in self.check_positions: assert_equal( self.Z_final.deriv(0)[n], self.Z_final.deriv(i)[n] )
 
     # calculate bpp_tot = -dlog Z_final /dlog Kd in up to three ways! wow cool test
     if self.bpp:
@@ -369,37 +476,22 @@ def _run_cross_checks( self ):
 
         # uh this is a hack -- only works for minimal model where all the Kd are the same:
         Kd = self.params.base_pair_types[0].Kd
-        if self.options.calc_deriv_DP:
-            bpp_tot_based_on_deriv = -self.Z_final.deriv(0) * Kd / self.Z_final.val(0)
+        if self.calc_Kd_deriv_DP:
+            bpp_tot_based_on_deriv = -self.dZ_dKd_DP * Kd / self.Z_final.val(0)
             print('bpp_tot',bpp_tot,'bpp_tot_based_on_deriv',bpp_tot_based_on_deriv)
             if bpp_tot > 0: assert_equal( bpp_tot, bpp_tot_based_on_deriv )
 
 
     if self.deriv_check:
+        from zetafold.deriv_check import get_numerical_log_derivs, show_deriv_check # imports partition, so not at the top
         print('\nCHECKING LOG DERIVS:')
         logZ_val  = log( self.Z )
-        p_shift = partition( self.sequences, circle = self.circle, params = self.params, mfe = False, suppress_all_output = True, structure = self.structure, allow_extra_base_pairs = self.allow_extra_base_pairs )
+        p_shift = partition( self.sequences, circle = self.circle, params = self.params, mfe = False, suppress_all_output = True, structure = self.structure_pair_table, allow_extra_base_pairs = self.allow_extra_base_pairs )
         print( 'Check logZ value upon recomputation: ',logZ_val, 'vs', log(p_shift.Z) )
         assert_equal( logZ_val, log(p_shift.Z) )
         analytic_grad_val = self.log_derivs
-        epsilon = 1.0e-8
-        numerical_grad_val = []
-        for n,param in enumerate( self.deriv_params ):
-            save_val = self.params.get_parameter_value( param )
-            if save_val == 0.0:
-                numerical_grad_val.append( 0.0 )
-                continue
-            self.params.set_parameter( param,  exp( log(save_val) + epsilon ) )
-            p_shift = partition( self.sequences, circle = self.circle, params = self.params, mfe = False, suppress_all_output = True, structure = self.structure, allow_extra_base_pairs = self.allow_extra_base_pairs )
-            numerical_grad_val.append( ( log( p_shift.Z ) - logZ_val ) / epsilon )
-            self.params.set_parameter( param, save_val )
-
-        print()
-        print( '%20s %25s %25s' % ('','','d(logZ)/d(log parameter)' ) )
-        print( '%20s %25s %25s %25s' % ('parameter','analytic','numerical', 'diff' ) )
-        for i,parameter in enumerate(self.deriv_params):
-               print( '%20s %25.12f %25.12f %25.12f' % (parameter, analytic_grad_val[i], numerical_grad_val[i], analytic_grad_val[i] - numerical_grad_val[i] ) )
-        print()
+        numerical_grad_val = get_numerical_log_derivs( self, self.deriv_params, jobs = self.deriv_check_jobs, central = self.central_differences )
+        show_deriv_check( self.deriv_params, analytic_grad_val, numerical_grad_val, 'd(logZ)/d(log parameter)' )
         for val1,val2 in zip(analytic_grad_val,numerical_grad_val):
             if abs( val1 ) > 0.001:
                 if abs( val1 - val2 )/val2 > 1.0e-3: print( 'ISSUE!!', val1, val2 )
@@ -0,0 +1,202 @@
+from __future__ import print_function
+import os
+import hashlib
+import cPickle as pickle
+from collections import OrderedDict
+from .partition import partition
+from .parameters import get_params
+from .util.sequence_util import initialize_sequence_and_ligated
+from .util.secstruct_util import get_structure_string
+from .util.output_util import get_bpp_triplets
+
+##################################################################################################
+# Cache of partition() results.
+#
+# Results are keyed by a hash of everything that goes into the calculation: the strands (sequence
+#  and where the chain breaks are, including circle), forced structure, which outputs were asked
+#  for, deriv_params and deriv_method, and the fingerprint of the parameters. So the same key
+#  always means the same answer, and entries never need to be invalidated.
+#
+# A PartitionCache keeps the most recently used results in memory, and, if given a directory, also
+#  saves each result there as <key[:2]>/<key>.pkl. Files are written under a temporary name and then
+#  renamed into place, so several processes can share one directory: a reader either finds a
+#  complete file or none. Once the directory grows past max_disk_bytes, the least recently used
+#  files are removed.
+##################################################################################################
+def cached_partition( sequences, circle = False, params = '', mfe = False, calc_bpp = False,
+                      structure = None, allow_extra_base_pairs = None, no_coax = False,
+                      deriv_params = None, deriv_method = 'analytic', use_simple_recursions = False,
+                      cache = None, bpp_cutoff = 1.0e-5 ):
+    '''
+    Same inputs as partition() (minus the output and debugging options), but returns a PartitionResult,
+     from cache if the same calculation has been done before. cache defaults to get_partition_cache().
+    '''
+    if cache == None: cache = get_partition_cache()
+    params = get_params( params, suppress_all_output = True )
+    if no_coax:
+        params = params.copy()
+        params.set_parameter( 'K_coax', 0.0 )
+    if deriv_params == []: deriv_params = list( params.parameter_tags ) # [] means all parameters
+    key = get_partition_key( sequences, circle, params, mfe, calc_bpp, structure, allow_extra_base_pairs, deriv_params, deriv_method, bpp_cutoff )
+
+    result = cache.get( key )
+    if result != None: return result
+
+    p = partition( sequences, circle = circle, params = params, mfe = mfe, calc_bpp = calc_bpp,
+                   structure = structure, allow_extra_base_pairs = allow_extra_base_pairs,
+                   deriv_params = None if deriv_params == None else list( deriv_params ), deriv_method = deriv_method,
+                   use_simple_recursions = use_simple_recursions, suppress_all_output = True, production = True )
+    result = PartitionResult( p, bpp_cutoff )
+    cache.put( key, result )
+    return result
+
+def get_partition_key( sequences, circle, params, mfe, calc_bpp, structure, allow_extra_base_pairs, deriv_params, deriv_method, bpp_cutoff ):
+    ( sequence, ligated, strands ) = initialize_sequence_and_ligated( sequences, circle )
+    structure = get_structure_string( structure )
+    inputs = ( sequence, tuple( ligated ), structure, bool( allow_extra_base_pairs ),
+               bool( mfe ), ( bpp_cutoff if calc_bpp else None ),
+               ( None if deriv_params == None else tuple( deriv_params ) ), ( deriv_method if deriv_params != None else None ),
+               params.get_fingerprint() )
+    return hashlib.sha1( repr( inputs ) ).hexdigest()
+
+class PartitionResult:
+    '''
+    Outputs of partition() worth keeping:
+
+      Z, dG, struct_MFE, bps_MFE, deriv_params, log_derivs, derivs  -- as in Partition
+
+    and base pair probabilities above bpp_cutoff, as arrays bpp_i, bpp_j, bpp_p with i < j (see get_bpp_matrix()).
+    '''
+    def __init__( self, p, bpp_cutoff = 1.0e-5 ):
+        self.sequences = p.sequences
+        self.circle = p.circle
+        self.N = p.N
+        self.Z = p.Z
+        self.dG = p.dG
+        self.bps_MFE = p.bps_MFE
+        self.struct_MFE = p.struct_MFE
+        self.deriv_params = p.deriv_params
+        self.log_derivs = p.log_derivs
+        self.derivs = p.derivs
+        self.bpp_cutoff = bpp_cutoff
+        ( self.bpp_i, self.bpp_j, self.bpp_p ) = get_bpp_triplets( p.bpp, bpp_cutoff ) if p.bpp else ( None, None, None )
+
+    def get_bpp_matrix( self ):
+        '''
+        N x N base pair probability matrix like Partition.bpp (with zeros below bpp_cutoff), or None if bpp was not calculated.
+        '''
+        if self.bpp_p is None: return None
+        bpp = [ [0.0]*self.N for i in range( self.N ) ]
+        for (i,j,bpp_ij) in zip( self.bpp_i, self.bpp_j, self.bpp_p ):
+            bpp[ i ][ j ] = bpp[ j ][ i ] = float( bpp_ij )
+        return bpp
+
+_partition_caches = {}
+
+def get_partition_cache( cache_dir = None, max_entries = 10000, max_disk_bytes = 1<<30 ):
+    '''
+    PartitionCache for cache_dir (or in memory only, if None), shared by everything in this process that asks for it.
+    '''
+    if cache_dir != None: cache_dir = os.path.abspath( cache_dir )
+    if not cache_dir in _partition_caches: _partition_caches[ cache_dir ] = PartitionCache( cache_dir, max_entries, max_disk_bytes )
+    return _partition_caches[ cache_dir ]
+
+class PartitionCache:
+    '''
+    Results by key, with the max_entries most recently used ones in memory, and optionally
+     all of them (up to about max_disk_bytes) in cache_dir. See above.
+    '''
+    def __init__( self, cache_dir = None, max_entries = 10000, max_disk_bytes = 1<<30 ):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.disk_bytes = None # estimate -- other processes may be writing too. Checked in evict_disk().
+        self.hits = 0
+        self.misses = 0
+
+    def get_file( self, key ): return os.path.join( self.cache_dir, key[:2], key + '.pkl' )
+
+    def get( self, key ):
+        '''
+        Cached result for key, or None
+        '''
+        if key in self.memory:
+            result = self.memory.pop( key )
+            self.memory[ key ] = result # now most recently used
+            self.hits += 1
+            return result
+        if self.cache_dir != None:
+            cache_file = self.get_file( key )
+            try:
+                with open( cache_file, 'rb' ) as f: result = pickle.load( f )
+                os.utime( cache_file, None ) # for least-recently-used eviction
+                self.add_to_memory( key, result )
+                self.hits += 1
+                return result
+            except ( IOError, OSError, EOFError, ValueError, pickle.UnpicklingError ):
+                pass # not there, or removed by another process in the meantime
+        self.misses += 1
+        return None
+
+    def put( self, key, result ):
+        self.add_to_memory( key, result )
+        if self.cache_dir == None: return
+        cache_file = self.get_file( key )
+        tmp_file = '%s.%d.tmp' % ( cache_file, os.getpid() )
+        try:
+            if not os.path.isdir( os.path.dirname( cache_file ) ): os.makedirs( os.path.dirname( cache_file ) )
+        except OSError:
+            pass # another process made it first
+        try:
+            with open( tmp_file, 'wb' ) as f: pickle.dump( result, f, pickle.HIGHEST_PROTOCOL )
+            os.rename( tmp_file, cache_file )
+        except ( IOError, OSError ):
+            return # cache directory not writeable -- keep going with the in-memory cache
+        if self.disk_bytes == None: self.disk_bytes = self.get_disk_usage()[ 0 ]
+        else: self.disk_bytes += os.path.getsize( cache_file )
+        if self.disk_bytes > self.max_disk_bytes: self.evict_disk()
+
+    def add_to_memory( self, key, result ):
+        self.memory[ key ] = result
+        while len( self.memory ) > self.max_entries: self.memory.popitem( last = False )
+
+    def get_disk_usage( self ):
+        '''
+        ( total bytes, [ (modification time, bytes, file), ... ] ) for the files in cache_dir.
+        get() touches files it reads, so modification time is really last use.
+        '''
+        cache_files = []
+        for ( dirpath, dirnames, filenames ) in os.walk( self.cache_dir ):
+            for filename in filenames:
+                if not filename.endswith( '.pkl' ): continue
+                cache_file = os.path.join( dirpath, filename )
+                try:
+                    stat = os.stat( cache_file )
+                    cache_files.append( ( stat.st_mtime, stat.st_size, cache_file ) )
+                except OSError:
+                    pass
+        return ( sum( size for (mtime,size,cache_file) in cache_files ), cache_files )
+
+    def evict_disk( self ):
+        '''
+        Remove least recently used files until cache_dir is down to 80% of max_disk_bytes.
+        '''
+        ( self.disk_bytes, cache_files ) = self.get_disk_usage()
+        for ( mtime, size, cache_file ) in sorted( cache_files ):
+            if self.disk_bytes <= 0.8 * self.max_disk_bytes: break
+            try:
+                os.remove( cache_file )
+                self.disk_bytes -= size
+            except OSError:
+                pass # another process got there first
+
+    def clear( self ):
+        self.memory.clear()
+        if self.cache_dir == None: return
+        for ( mtime, size, cache_file ) in self.get_disk_usage()[ 1 ]:
+            try:
+                os.remove( cache_file )
+            except OSError:
+                pass
+        self.disk_bytes = 0
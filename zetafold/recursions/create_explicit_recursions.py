@@ -1,13 +1,48 @@
 #!/usr/bin/python
+import re
 with open('recursions.py') as f:
     lines = f.readlines()
 
 
-not_data_objects = ['self.Z_BPq','sequence','self.params.C_eff_stack', 'motif_type.strands' ]
-not_2D_dynamic_programming_objects = ['all_ligated','ligated','self.Z_BPq','sequence','self.allow_base_pair','self.in_forced_base_pair','self.params.C_eff_stack','motif_type.strands']
+compiled_params_objects = ['self.compiled.base_pair_type_index','self.compiled.loop_weight','self.compiled.stack_weight','self.compiled.cut_weight','self.compiled.coax_loop_weight','self.compiled.coax_cut_weight']
+not_data_objects = ['self.Z_BPq','sequence','self.params.C_eff_stack', 'motif_type.strands' ] + compiled_params_objects
+not_2D_dynamic_programming_objects = ['all_ligated','ligated','self.Z_BPq','sequence','self.allow_base_pair','self.in_forced_base_pair','self.params.C_eff_stack','motif_type.strands'] + compiled_params_objects
 dynamic_programming_lists = ['Z_final']
 dynamic_programming_data = ['Z_seg1','Z_seg2']
 
+# terms that include any of these depend explicitly on parameters, and get an extra deriv line that
+#  uses the tagged parameters in forward_derivs.tagged (see forward_mode.py). The adjoint lines
+#  read the same factors from adjoint_factors instead (see ParameterFactors in adjoint.py).
+tagged_parameters = [ (r'\b(C_init|l|l_BP|K_coax|l_coax|C_std)\b', r'tagged.\1'),
+                      (r'\bKdq\b', 'tagged.Kd[base_pair_type]'),
+                      (r'\bself\.params\.C_eff_stack\b', 'tagged.C_eff_stack'),
+                      (r'\bself\.compiled\b', 'tagged.compiled'),
+                      (r'\bmotif_type\.C_eff\b', 'tagged.C_eff[motif_type]') ]
+
+def get_parameter_factors( rhs ):
+    '''
+    Parameter factors in term rhs, as ( factor in adjoint_factors, power ) -- power is -1 for factors that divide.
+    '''
+    rhs_factors = rhs
+    for (pattern, tagged_parameter) in tagged_parameters: rhs_factors = re.sub( pattern, tagged_parameter.replace( 'tagged.', 'factors.' ), rhs_factors )
+    factors = []
+    for match in re.finditer( r'factors\.[\w.]+(\[[^\]]*\])*', rhs_factors ):
+        before = rhs_factors[ :match.start() ].rstrip( ' (' )
+        factors.append( ( match.group( 0 ), -1 if before.endswith( '/' ) else 1 ) )
+    return factors
+
+def get_body_start( lines, def_pos ):
+    '''
+    Position of the first line after the def and docstring of the function at def_pos in lines.
+    '''
+    pos = def_pos + 1
+    if lines[ pos ].strip().startswith( "'''" ):
+        if lines[ pos ].count( "'''" ) < 2:
+            pos += 1
+            while lines[ pos ].count( "'''" ) == 0: pos += 1
+        pos += 1
+    return pos
+
 def find_substring(substring, string):
     """
     From stackoverflow...
@@ -26,9 +61,24 @@ def find_substring(substring, string):
         indices.append(index)
     return indices
 
+def find_cell_span( line, Qpos ):
+    '''
+    For a dynamic programming cell like Z_BP.Q[(i+1)%N][k%N] with '.Q' at Qpos,
+     return where the cell starts and ends in line.
+    '''
+    start = Qpos
+    while start > 0 and ( line[start-1].isalnum() or line[start-1] == '_' ): start -= 1
+    end = Qpos + 2
+    for n in range( 2 ):
+        assert( line[end] == '[' )
+        end = line.find( ']', end ) + 1
+    return (start, end)
+
 lines_new = []
 lines_deriv = []
 lines_contrib = []
+lines_adjoint = []
+def_pos = None
 in_comment_block = False
 
 for line in lines:
@@ -36,8 +86,16 @@ for line in lines:
 
     # add blocks of deriv & contrib lines that may be accumulating.
     if len( line ) > 1 and line[0] != ' ':
+        if len( lines_adjoint ) > 0:
+            # the adjoint block runs instead of the updates, so it goes first.
+            body_start = get_body_start( lines_new, def_pos )
+            lines_new[ body_start:body_start ] = [ '    if self.options.calc_adjoint: # AUTOGENERATED ADJOINT BLOCK\n',
+                                                   '        (factor_bar, factors) = (self.options.adjoint_factors.bar, self.options.adjoint_factors)\n' ] + \
+                                                 lines_adjoint + [ '        return\n' ] + ( [ '\n' ] if lines_new[ body_start ].strip() else [] )
+            lines_adjoint = []
         if len(lines_deriv) > 0:
             lines_new.append('    if self.options.calc_deriv_DP: # AUTOGENERATED DERIV BLOCK\n')
+            lines_new.append('        (param_log_derivs, tagged) = (self.options.forward_derivs.log_derivs, self.options.forward_derivs.tagged)\n')
             lines_new     += lines_deriv
             lines_new += '\n'
             lines_deriv = []
@@ -46,6 +104,7 @@ for line in lines:
             lines_new += lines_contrib
             lines_contrib = []
             lines_new += '\n'
+        if line.startswith( 'def ' ): def_pos = len( lines_new )
 
 
     if line.count( '.dQ' ) or line.count( '.Q') :
@@ -134,6 +193,7 @@ for line in lines:
        not in_comment_block and not line.count( "'''" ) and first_char != '' and num_indent >= 4:
         lines_deriv.append( ' '*4 + line_new )
         lines_contrib.append( ' '*4 + line_new )
+        lines_adjoint.append( ' '*4 + line_new )
 
     if line == line_new: continue
     print line,
@@ -146,16 +206,30 @@ for line in lines:
 
             #lines_new.append( ' '*num_indent + 'if self.options.calc_deriv_DP:\n' )
             #print lines_new[-1],
-            line_beginning = ' '*4 + line_new[:Qpos[0]] + '.dQ' # extra indent
-            # deriv line
+            # deriv lines only needed if term is nonzero
+            rhs = line_new[assign_pos+3:-1]
+            line_deriv = ' '*num_indent
+            line_deriv += ' '*4
+            line_deriv += 'if %s > 0:\n' % rhs
+            print line_deriv,
+            lines_deriv.append( line_deriv )
+            line_beginning = ' '*8 + line_new[:Qpos[0]] + '.dQ' + line_new[Qpos[0]+2:assign_pos+3] # extra indent
+            # deriv lines -- product rule. dQ are vectors, so first multiply out all the scalars,
+            #  which are obtained by replacing the cell by 1.0
             for i in range( 1, len( Qpos ) ):
-                line_deriv = line_beginning
                 assert( Qpos[i] > assign_pos )
-                for j in range(1, len( Qpos) ):
-                    line_deriv += line_new[Qpos[j-1]+2 : Qpos[j]]
-                    if i == j: line_deriv += '.dQ'
-                    else: line_deriv += '.Q'
-                line_deriv += line_new[ Qpos[-1]+2:]
+                (start, end) = find_cell_span( line_new, Qpos[i] )
+                scalar = line_new[assign_pos+3:start] + '1.0' + line_new[end:-1]
+                cell_deriv = line_new[start:Qpos[i]] + '.dQ' + line_new[Qpos[i]+2:end]
+                if scalar.strip() == '1.0': line_deriv = line_beginning + cell_deriv + '\n'
+                else:                       line_deriv = line_beginning + '(' + scalar + ') * ' + cell_deriv + '\n'
+                print line_deriv,
+                lines_deriv.append(line_deriv)
+            # deriv line -- explicit dependence on parameters
+            rhs_tagged = rhs
+            for (pattern, tagged_parameter) in tagged_parameters: rhs_tagged = re.sub( pattern, tagged_parameter, rhs_tagged )
+            if rhs_tagged != rhs:
+                line_deriv = line_beginning + 'param_log_derivs( ' + rhs_tagged.strip() + ' )\n'
                 print line_deriv,
                 lines_deriv.append(line_deriv)
 
@@ -182,6 +256,27 @@ for line in lines:
             line_contrib += '] ) ]\n'
             print line_contrib,
             lines_contrib.append( line_contrib)
+
+            # adjoint lines -- reverse of the update: w = d( log Z )/d( log term ) goes back to each cell
+            #  in the term (divided by its value) and to each parameter factor (times its power).
+            lhs_start = Qpos[0]
+            while lhs_start > 0 and ( line_new[lhs_start-1].isalnum() or line_new[lhs_start-1] == '_' ): lhs_start -= 1
+            lhs_bar = line_new[lhs_start:Qpos[0]] + '.Q_bar' + line_new[Qpos[0]+2:assign_pos].rstrip()
+            condition = line_new[:lhs_start].strip()
+            indent = ' '*( num_indent + 4 )
+            if len( condition ) > 0:
+                lines_adjoint.append( indent + condition + '\n' )
+                indent += ' '*4
+            lines_adjoint.append( indent + 'w = %s * %s\n' % ( lhs_bar, rhs.strip() ) )
+            updates = []
+            for i in range( 1, len( Qpos ) ):
+                (start, end) = find_cell_span( line_new, Qpos[i] )
+                updates.append( '%s += w / %s' % ( line_new[start:Qpos[i]] + '.Q_bar' + line_new[Qpos[i]+2:end], line_new[start:end] ) )
+            for (factor, power) in get_parameter_factors( rhs ):
+                updates.append( 'factor_bar[ %s ] %s= w' % ( factor, '+' if power > 0 else '-' ) )
+            line_adjoint = indent + 'if w > 0: ' + '; '.join( updates ) + '\n'
+            print line_adjoint,
+            lines_adjoint.append( line_adjoint )
     print
 
 
@@ -32,6 +32,7 @@ class DynamicProgrammingMatrix:
     def val( self, i, j ): return self.data[i][j].Q
     def set_val( self, i, j, val ): self.data[i][j].Q = val
     def deriv( self, i, j ): return self.data[i][j].dQ
+    def set_deriv( self, i, j, deriv ): self.data[i][j].dQ = deriv
 
     def update( self, partition, i, j ):
         self.data[ i ][ j ].zero()
@@ -89,19 +90,21 @@ class DynamicProgrammingData:
     '''
     Dynamic programming object, with derivs and contribution accumulation.
      Q   = value
-     dQ  = derivative (later will generalize to gradient w.r.t. all parameters)
+     dQ  = derivatives d(Q)/d(log parameter) for parameters in options.forward_derivs
+            (numpy array; intermediate products may just have 0.0)
      contrib = contributions
     '''
     def __init__( self, val = 0.0, options = None ):
         self.Q = val
         self.dQ = 0.0
+        if options and options.calc_deriv_DP: self.dQ = options.forward_derivs.zeros()
         self.contribs = []
         self.info = []
         self.options = options
 
     def zero( self ):
         self.Q = 0.0
-        self.dQ = 0.0
+        if self.options and self.options.calc_deriv_DP: self.dQ = self.options.forward_derivs.zeros()
         self.contribs = []
 
     def __iadd__(self, other):
@@ -129,7 +132,8 @@ class DynamicProgrammingData:
         else:
             prod.Q  = self.Q * other
             if self.options and self.options.calc_deriv_DP:
-                prod.dQ = self.dQ * other
+                # other may be a (tagged) parameter -- see forward_mode.py
+                prod.dQ = self.dQ * other + prod.Q * self.options.forward_derivs.vector( other )
             if self.options and self.options.calc_contrib:
                 for contrib in self.contribs:
                     prod.contribs.append( [contrib[0]*other, contrib[1] ] )
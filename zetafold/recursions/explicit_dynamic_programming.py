@@ -1,3 +1,5 @@
+import numpy as np
+
 #
 # Much simpler (less intelligent) object for dynamic programming than in dynamic_programming.py --
 #  forces code to explicitly figure out updates to values, derivatives, and contributions
@@ -14,8 +16,8 @@ class DynamicProgrammingMatrix:
         for i in range( N ): self.Q[i] = [val]*N
         for i in range( N ): self.Q[i][i] = diag_val
 
-        self.dQ = [None]*N
-        for i in range( N ): self.dQ[i] = [0.0]*N
+        # derivatives w.r.t. each parameter in options.forward_derivs
+        self.dQ = np.zeros( ( N, N, get_num_derivs( options ) ) )
 
         self.contribs = [None]*N
         for i in range( N ):
@@ -33,10 +35,11 @@ class DynamicProgrammingMatrix:
     def val( self, i, j ): return self.Q[i%self.N][j%self.N]
     def set_val( self, i, j, val ): self.Q[i%self.N][j%self.N] = val
     def deriv( self, i, j ): return self.dQ[i%self.N][j%self.N]
+    def set_deriv( self, i, j, deriv ): self.dQ[i%self.N][j%self.N] = deriv
 
     def update( self, partition, i, j ):
         self.Q[ i ][ j ] = 0
-        self.dQ[ i ][ j ] = 0
+        if partition.options.calc_deriv_DP: self.dQ[ i ][ j ] = 0
         self.contribs[ i ][ j ] = []
         self.update_func( partition, i, j )
 
@@ -61,7 +64,7 @@ class DynamicProgrammingList:
     def __init__( self, N, val = 0.0, update_func = None, options = None, name = None ):
         self.N = N
         self.Q = [ val ]*N
-        self.dQ = [ 0.0 ]*N
+        self.dQ = np.zeros( ( N, get_num_derivs( options ) ) )
         self.contribs = [None] * N
         for i in range( N ): self.contribs[i] = []
         self.contribs_updated = [False]*N
@@ -75,7 +78,7 @@ class DynamicProgrammingList:
 
     def update( self, partition, i ):
         self.Q[ i ] = 0.0
-        self.dQ[ i ] = 0.0
+        if partition.options.calc_deriv_DP: self.dQ[ i ] = 0.0
         self.contribs[ i ] = []
         self.update_func( partition, i )
 
@@ -86,3 +89,7 @@ class DynamicProgrammingList:
             partition.options.calc_contrib = False
             self.contribs_updated[i] = True
         return self.contribs[i]
+
+def get_num_derivs( options ):
+    if options == None or options.forward_derivs == None: return 0
+    return options.forward_derivs.size
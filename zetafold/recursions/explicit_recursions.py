@@ -11,6 +11,24 @@ def update_Z_cut( self, i, j ):
     Useful for Z_BP and Z_final calcs below.
     Analogous to 'exterior' Z in Mathews calc & Dirks multistrand calc.
     '''
+    if self.options.calc_adjoint: # AUTOGENERATED ADJOINT BLOCK
+        (factor_bar, factors) = (self.options.adjoint_factors.bar, self.options.adjoint_factors)
+        (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
+         sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
+        offset = ( j - i ) % N
+        for c in range( i, i+offset ):
+            if not ligated[c%N]:
+                if c == i and (c+1)%N != j and ligated[(j-1)%N]:
+                    w = Z_cut.Q_bar[i%N][j%N] * Z_linear.Q[(c+1)%N][(j-1)%N]
+                    if w > 0: Z_linear.Q_bar[(c+1)%N][(j-1)%N] += w / Z_linear.Q[(c+1)%N][(j-1)%N]
+                if c != i and (c+1)%N == j and ligated[i%N]:
+                    w = Z_cut.Q_bar[i%N][j%N] * Z_linear.Q[(i+1)%N][c%N]
+                    if w > 0: Z_linear.Q_bar[(i+1)%N][c%N] += w / Z_linear.Q[(i+1)%N][c%N]
+                if c != i and (c+1)%N != j and ligated[i%N] and ligated[(j-1)%N]:
+                    w = Z_cut.Q_bar[i%N][j%N] * Z_linear.Q[(i+1)%N][c%N] * Z_linear.Q[(c+1)%N][(j-1)%N]
+                    if w > 0: Z_linear.Q_bar[(i+1)%N][c%N] += w / Z_linear.Q[(i+1)%N][c%N]; Z_linear.Q_bar[(c+1)%N][(j-1)%N] += w / Z_linear.Q[(c+1)%N][(j-1)%N]
+        return
+
     (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
      sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
     offset = ( j - i ) % N
@@ -23,15 +41,19 @@ def update_Z_cut( self, i, j ):
             if c != i and (c+1)%N != j and ligated[i%N] and ligated[(j-1)%N]: Z_cut.Q[i%N][j%N] += Z_linear.Q[(i+1)%N][c%N] * Z_linear.Q[(c+1)%N][(j-1)%N]
 
     if self.options.calc_deriv_DP: # AUTOGENERATED DERIV BLOCK
+        (param_log_derivs, tagged) = (self.options.forward_derivs.log_derivs, self.options.forward_derivs.tagged)
         (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
          sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
         offset = ( j - i ) % N
         for c in range( i, i+offset ):
             if not ligated[c%N]:
-                if c == i and (c+1)%N != j and ligated[(j-1)%N]:                Z_cut.dQ[i%N][j%N] += Z_linear.dQ[(c+1)%N][(j-1)%N]
-                if c != i and (c+1)%N == j and ligated[i%N]:                  Z_cut.dQ[i%N][j%N] += Z_linear.dQ[(i+1)%N][c%N]
-                if c != i and (c+1)%N != j and ligated[i%N] and ligated[(j-1)%N]: Z_cut.dQ[i%N][j%N] += Z_linear.dQ[(i+1)%N][c%N] * Z_linear.Q[(c+1)%N][(j-1)%N]
-                if c != i and (c+1)%N != j and ligated[i%N] and ligated[(j-1)%N]: Z_cut.dQ[i%N][j%N] += Z_linear.Q[(i+1)%N][c%N] * Z_linear.dQ[(c+1)%N][(j-1)%N]
+                if Z_linear.Q[(c+1)%N][(j-1)%N] > 0:
+                    if c == i and (c+1)%N != j and ligated[(j-1)%N]:                Z_cut.dQ[i%N][j%N] += Z_linear.dQ[(c+1)%N][(j-1)%N]
+                if Z_linear.Q[(i+1)%N][c%N] > 0:
+                    if c != i and (c+1)%N == j and ligated[i%N]:                  Z_cut.dQ[i%N][j%N] += Z_linear.dQ[(i+1)%N][c%N]
+                if Z_linear.Q[(i+1)%N][c%N] * Z_linear.Q[(c+1)%N][(j-1)%N] > 0:
+                    if c != i and (c+1)%N != j and ligated[i%N] and ligated[(j-1)%N]: Z_cut.dQ[i%N][j%N] += (1.0 * Z_linear.Q[(c+1)%N][(j-1)%N]) * Z_linear.dQ[(i+1)%N][c%N]
+                    if c != i and (c+1)%N != j and ligated[i%N] and ligated[(j-1)%N]: Z_cut.dQ[i%N][j%N] += (Z_linear.Q[(i+1)%N][c%N] * 1.0) * Z_linear.dQ[(c+1)%N][(j-1)%N]
 
     if self.options.calc_contrib: # AUTOGENERATED CONTRIBS BLOCK
         (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
@@ -52,6 +74,54 @@ def update_Z_BPq( self, i, j, base_pair_type ):
     Z_BPq is the partition function for all structures that base pair i and j with base_pair_type
     Relies on previous Z contributions available for subfragments, and Z_cut for this fragment i,j
     '''
+    if self.options.calc_adjoint: # AUTOGENERATED ADJOINT BLOCK
+        (factor_bar, factors) = (self.options.adjoint_factors.bar, self.options.adjoint_factors)
+        (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
+         sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
+        offset = ( j - i ) % N
+        ( C_eff_for_coax, C_eff_for_BP ) = (C_eff, C_eff ) if allow_strained_3WJ else (C_eff_no_BP_singlet, C_eff_no_coax_singlet )
+        if self.allow_base_pair and not self.allow_base_pair[i%N][j%N]: return
+        if ( all_ligated[i%N][j%N] and ( ((j-i-1) % N)) < min_loop_length ): return
+        if ( all_ligated[j%N][i%N] and ( ((i-j-1) % N)) < min_loop_length ): return
+        if not base_pair_type.is_match( sequence[i], sequence[j] ): return
+        (Z_BPq, Kdq)  = ( self.Z_BPq[ base_pair_type ], base_pair_type.Kd )
+        q = self.compiled.base_pair_type_index[ base_pair_type ] # parameter products for this base pair type are precomputed in self.compiled
+        if ligated[i%N] and ligated[(j-1)%N]:
+            w = Z_BPq.Q_bar[i%N][j%N] * self.compiled.loop_weight[ q ] * C_eff_for_BP.Q[(i+1)%N][(j-1)%N]
+            if w > 0: C_eff_for_BP.Q_bar[(i+1)%N][(j-1)%N] += w / C_eff_for_BP.Q[(i+1)%N][(j-1)%N]; factor_bar[ factors.compiled.loop_weight[ q ] ] += w
+            for (q2, base_pair_type2) in enumerate( self.params.base_pair_types ):
+                if base_pair_type2.is_match( sequence[(i+1)%N], sequence[(j-1)%N] ):
+                    Z_BPq2 = self.Z_BPq[base_pair_type2]
+                    w = Z_BPq.Q_bar[i%N][j%N] * self.compiled.stack_weight[ q ][ q2 ] * Z_BPq2.Q[(i+1)%N][(j-1)%N]
+                    if w > 0: Z_BPq2.Q_bar[(i+1)%N][(j-1)%N] += w / Z_BPq2.Q[(i+1)%N][(j-1)%N]; factor_bar[ factors.compiled.stack_weight[ q ][ q2 ] ] += w
+        for motif_type in self.params.motif_types:
+            if motif_type.start_base_pair_type != base_pair_type: continue
+            if motif_type.is_match( sequence, ligated, i, j ):
+                (base_pair_type2, i_next, j_next) = motif_type.get_other_base_pair( i, j )
+                Z_BPq2 = self.Z_BPq[base_pair_type2]
+                w = Z_BPq.Q_bar[i%N][j%N] * (1.0/Kdq ) * motif_type.C_eff * Z_BPq2.Q[(i_next)%N][(j_next)%N]
+                if w > 0: Z_BPq2.Q_bar[(i_next)%N][(j_next)%N] += w / Z_BPq2.Q[(i_next)%N][(j_next)%N]; factor_bar[ factors.Kd[base_pair_type] ] -= w; factor_bar[ factors.C_eff[motif_type] ] += w
+        w = Z_BPq.Q_bar[i%N][j%N] * self.compiled.cut_weight[ q ] * Z_cut.Q[i%N][j%N]
+        if w > 0: Z_cut.Q_bar[i%N][j%N] += w / Z_cut.Q[i%N][j%N]; factor_bar[ factors.compiled.cut_weight[ q ] ] += w
+        if K_coax > 0.0:
+            if ligated[i%N] and ligated[(j-1)%N]:
+                for k in range( i+2, i+offset-1 ):
+                    if ligated[k%N]:
+                        w = Z_BPq.Q_bar[i%N][j%N] * Z_BP.Q[(i+1)%N][k%N] * C_eff_for_coax.Q[(k+1)%N][(j-1)%N] * self.compiled.coax_loop_weight[ q ]
+                        if w > 0: Z_BP.Q_bar[(i+1)%N][k%N] += w / Z_BP.Q[(i+1)%N][k%N]; C_eff_for_coax.Q_bar[(k+1)%N][(j-1)%N] += w / C_eff_for_coax.Q[(k+1)%N][(j-1)%N]; factor_bar[ factors.compiled.coax_loop_weight[ q ] ] += w
+                for k in range( i+2, i+offset-1 ):
+                    if ligated[(k-1)%N]:
+                        w = Z_BPq.Q_bar[i%N][j%N] * C_eff_for_coax.Q[(i+1)%N][(k-1)%N] * Z_BP.Q[k%N][(j-1)%N] * self.compiled.coax_loop_weight[ q ]
+                        if w > 0: C_eff_for_coax.Q_bar[(i+1)%N][(k-1)%N] += w / C_eff_for_coax.Q[(i+1)%N][(k-1)%N]; Z_BP.Q_bar[k%N][(j-1)%N] += w / Z_BP.Q[k%N][(j-1)%N]; factor_bar[ factors.compiled.coax_loop_weight[ q ] ] += w
+            if ligated[i%N]:
+                for k in range( i+2, i+offset ):
+                    w = Z_BPq.Q_bar[i%N][j%N] * Z_BP.Q[(i+1)%N][k%N] * Z_cut.Q[k%N][j%N] * self.compiled.coax_cut_weight[ q ]
+                    if w > 0: Z_BP.Q_bar[(i+1)%N][k%N] += w / Z_BP.Q[(i+1)%N][k%N]; Z_cut.Q_bar[k%N][j%N] += w / Z_cut.Q[k%N][j%N]; factor_bar[ factors.compiled.coax_cut_weight[ q ] ] += w
+            if ligated[(j-1)%N]:
+                for k in range( i, i+offset-1 ):
+                    w = Z_BPq.Q_bar[i%N][j%N] * Z_cut.Q[i%N][k%N] * Z_BP.Q[k%N][(j-1)%N] * self.compiled.coax_cut_weight[ q ]
+                    if w > 0: Z_cut.Q_bar[i%N][k%N] += w / Z_cut.Q[i%N][k%N]; Z_BP.Q_bar[k%N][(j-1)%N] += w / Z_BP.Q[k%N][(j-1)%N]; factor_bar[ factors.compiled.coax_cut_weight[ q ] ] += w
+        return
 
     (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
      sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
@@ -68,6 +138,7 @@ def update_Z_BPq( self, i, j, base_pair_type ):
     if not base_pair_type.is_match( sequence[i], sequence[j] ): return
 
     (Z_BPq, Kdq)  = ( self.Z_BPq[ base_pair_type ], base_pair_type.Kd )
+    q = self.compiled.base_pair_type_index[ base_pair_type ] # parameter products for this base pair type are precomputed in self.compiled
 
     if ligated[i%N] and ligated[(j-1)%N]:
         # base pair closes a loop
@@ -78,7 +149,7 @@ def update_Z_BPq( self, i, j, base_pair_type ):
         #   \       /
         #    i ... j
         #
-        Z_BPq.Q[i%N][j%N]  += (1.0/Kdq ) * ( C_eff_for_BP.Q[(i+1)%N][(j-1)%N] * l * l * l_BP)
+        Z_BPq.Q[i%N][j%N]  += self.compiled.loop_weight[ q ] * C_eff_for_BP.Q[(i+1)%N][(j-1)%N]
 
         # base pair forms a stacked pair with previous pair
         #
@@ -86,10 +157,10 @@ def update_Z_BPq( self, i, j, base_pair_type ):
         #    |     |
         #    i ... j
         #
-        for base_pair_type2 in self.params.base_pair_types:
+        for (q2, base_pair_type2) in enumerate( self.params.base_pair_types ):
             if base_pair_type2.is_match( sequence[(i+1)%N], sequence[(j-1)%N] ):
                 Z_BPq2 = self.Z_BPq[base_pair_type2]
-                Z_BPq.Q[i%N][j%N]  += (1.0/Kdq ) * self.params.C_eff_stack[base_pair_type][base_pair_type2] * Z_BPq2.Q[(i+1)%N][(j-1)%N]
+                Z_BPq.Q[i%N][j%N]  += self.compiled.stack_weight[ q ][ q2 ] * Z_BPq2.Q[(i+1)%N][(j-1)%N]
 
     # base pair forms a motif with previous pair
     #
@@ -111,7 +182,7 @@ def update_Z_BPq( self, i, j, base_pair_type ):
     #   \       /
     #    i ... j
     #
-    Z_BPq.Q[i%N][j%N] += (C_std/Kdq) * Z_cut.Q[i%N][j%N]
+    Z_BPq.Q[i%N][j%N] += self.compiled.cut_weight[ q ] * Z_cut.Q[i%N][j%N]
 
     if K_coax > 0.0:
         if ligated[i%N] and ligated[(j-1)%N]:
@@ -124,7 +195,7 @@ def update_Z_BPq( self, i, j, base_pair_type ):
             #    i ... j - j-1 ~
             #
             for k in range( i+2, i+offset-1 ):
-                if ligated[k%N]: Z_BPq.Q[i%N][j%N] += Z_BP.Q[(i+1)%N][k%N] * C_eff_for_coax.Q[(k+1)%N][(j-1)%N] * l**2 * l_coax * K_coax / Kdq
+                if ligated[k%N]: Z_BPq.Q[i%N][j%N] += Z_BP.Q[(i+1)%N][k%N] * C_eff_for_coax.Q[(k+1)%N][(j-1)%N] * self.compiled.coax_loop_weight[ q ]
 
             # coaxial stack of bp (i,j) and (k,j-1)...  close loop on left, and "right stack"
             #            ___
@@ -134,7 +205,7 @@ def update_Z_BPq( self, i, j, base_pair_type ):
             #  ~ i+1 - i ... j
             #
             for k in range( i+2, i+offset-1 ):
-                if ligated[(k-1)%N]: Z_BPq.Q[i%N][j%N] += C_eff_for_coax.Q[(i+1)%N][(k-1)%N] * Z_BP.Q[k%N][(j-1)%N] * l**2 * l_coax * K_coax / Kdq
+                if ligated[(k-1)%N]: Z_BPq.Q[i%N][j%N] += C_eff_for_coax.Q[(i+1)%N][(k-1)%N] * Z_BP.Q[k%N][(j-1)%N] * self.compiled.coax_loop_weight[ q ]
 
         # "left stack" but no loop closed on right (free strands hanging off j end)
         #      ___
@@ -145,7 +216,7 @@ def update_Z_BPq( self, i, j, base_pair_type ):
         #
         if ligated[i%N]:
             for k in range( i+2, i+offset ):
-                Z_BPq.Q[i%N][j%N] += Z_BP.Q[(i+1)%N][k%N] * Z_cut.Q[k%N][j%N] * C_std * K_coax / Kdq
+                Z_BPq.Q[i%N][j%N] += Z_BP.Q[(i+1)%N][k%N] * Z_cut.Q[k%N][j%N] * self.compiled.coax_cut_weight[ q ]
 
         # "right stack" but no loop closed on left (free strands hanging off i end)
         #       ___
@@ -156,12 +227,10 @@ def update_Z_BPq( self, i, j, base_pair_type ):
         #
         if ligated[(j-1)%N]:
             for k in range( i, i+offset-1 ):
-                Z_BPq.Q[i%N][j%N] += Z_cut.Q[i%N][k%N] * Z_BP.Q[k%N][(j-1)%N] * C_std * K_coax / Kdq
-
-    # key 'special sauce' for derivative w.r.t. Kd
-    if self.options.calc_deriv_DP: Z_BPq.dQ[i][j] += -(1.0/Kdq) * Z_BPq.Q[i][j]
+                Z_BPq.Q[i%N][j%N] += Z_cut.Q[i%N][k%N] * Z_BP.Q[k%N][(j-1)%N] * self.compiled.coax_cut_weight[ q ]
 
     if self.options.calc_deriv_DP: # AUTOGENERATED DERIV BLOCK
+        (param_log_derivs, tagged) = (self.options.forward_derivs.log_derivs, self.options.forward_derivs.tagged)
         (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
          sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
         offset = ( j - i ) % N
@@ -171,35 +240,52 @@ def update_Z_BPq( self, i, j, base_pair_type ):
         if ( all_ligated[j%N][i%N] and ( ((i-j-1) % N)) < min_loop_length ): return
         if not base_pair_type.is_match( sequence[i], sequence[j] ): return
         (Z_BPq, Kdq)  = ( self.Z_BPq[ base_pair_type ], base_pair_type.Kd )
+        q = self.compiled.base_pair_type_index[ base_pair_type ] # parameter products for this base pair type are precomputed in self.compiled
         if ligated[i%N] and ligated[(j-1)%N]:
-            Z_BPq.dQ[i%N][j%N]  += (1.0/Kdq ) * ( C_eff_for_BP.dQ[(i+1)%N][(j-1)%N] * l * l * l_BP)
-            for base_pair_type2 in self.params.base_pair_types:
+            if self.compiled.loop_weight[ q ] * C_eff_for_BP.Q[(i+1)%N][(j-1)%N] > 0:
+                Z_BPq.dQ[i%N][j%N]  += (self.compiled.loop_weight[ q ] * 1.0) * C_eff_for_BP.dQ[(i+1)%N][(j-1)%N]
+                Z_BPq.dQ[i%N][j%N]  += param_log_derivs( tagged.compiled.loop_weight[ q ] * C_eff_for_BP.Q[(i+1)%N][(j-1)%N] )
+            for (q2, base_pair_type2) in enumerate( self.params.base_pair_types ):
                 if base_pair_type2.is_match( sequence[(i+1)%N], sequence[(j-1)%N] ):
                     Z_BPq2 = self.Z_BPq[base_pair_type2]
-                    Z_BPq.dQ[i%N][j%N]  += (1.0/Kdq ) * self.params.C_eff_stack[base_pair_type][base_pair_type2] * Z_BPq2.dQ[(i+1)%N][(j-1)%N]
+                    if self.compiled.stack_weight[ q ][ q2 ] * Z_BPq2.Q[(i+1)%N][(j-1)%N] > 0:
+                        Z_BPq.dQ[i%N][j%N]  += (self.compiled.stack_weight[ q ][ q2 ] * 1.0) * Z_BPq2.dQ[(i+1)%N][(j-1)%N]
+                        Z_BPq.dQ[i%N][j%N]  += param_log_derivs( tagged.compiled.stack_weight[ q ][ q2 ] * Z_BPq2.Q[(i+1)%N][(j-1)%N] )
         for motif_type in self.params.motif_types:
             if motif_type.start_base_pair_type != base_pair_type: continue
             if motif_type.is_match( sequence, ligated, i, j ):
                 (base_pair_type2, i_next, j_next) = motif_type.get_other_base_pair( i, j )
                 Z_BPq2 = self.Z_BPq[base_pair_type2]
-                Z_BPq.dQ[i%N][j%N]  += (1.0/Kdq ) * motif_type.C_eff * Z_BPq2.dQ[(i_next)%N][(j_next)%N]
-        Z_BPq.dQ[i%N][j%N] += (C_std/Kdq) * Z_cut.dQ[i%N][j%N]
+                if (1.0/Kdq ) * motif_type.C_eff * Z_BPq2.Q[(i_next)%N][(j_next)%N] > 0:
+                    Z_BPq.dQ[i%N][j%N]  += ((1.0/Kdq ) * motif_type.C_eff * 1.0) * Z_BPq2.dQ[(i_next)%N][(j_next)%N]
+                    Z_BPq.dQ[i%N][j%N]  += param_log_derivs( (1.0/tagged.Kd[base_pair_type] ) * tagged.C_eff[motif_type] * Z_BPq2.Q[(i_next)%N][(j_next)%N] )
+        if self.compiled.cut_weight[ q ] * Z_cut.Q[i%N][j%N] > 0:
+            Z_BPq.dQ[i%N][j%N] += (self.compiled.cut_weight[ q ] * 1.0) * Z_cut.dQ[i%N][j%N]
+            Z_BPq.dQ[i%N][j%N] += param_log_derivs( tagged.compiled.cut_weight[ q ] * Z_cut.Q[i%N][j%N] )
         if K_coax > 0.0:
             if ligated[i%N] and ligated[(j-1)%N]:
                 for k in range( i+2, i+offset-1 ):
-                    if ligated[k%N]: Z_BPq.dQ[i%N][j%N] += Z_BP.dQ[(i+1)%N][k%N] * C_eff_for_coax.Q[(k+1)%N][(j-1)%N] * l**2 * l_coax * K_coax / Kdq
-                    if ligated[k%N]: Z_BPq.dQ[i%N][j%N] += Z_BP.Q[(i+1)%N][k%N] * C_eff_for_coax.dQ[(k+1)%N][(j-1)%N] * l**2 * l_coax * K_coax / Kdq
+                    if Z_BP.Q[(i+1)%N][k%N] * C_eff_for_coax.Q[(k+1)%N][(j-1)%N] * self.compiled.coax_loop_weight[ q ] > 0:
+                        if ligated[k%N]: Z_BPq.dQ[i%N][j%N] += (1.0 * C_eff_for_coax.Q[(k+1)%N][(j-1)%N] * self.compiled.coax_loop_weight[ q ]) * Z_BP.dQ[(i+1)%N][k%N]
+                        if ligated[k%N]: Z_BPq.dQ[i%N][j%N] += (Z_BP.Q[(i+1)%N][k%N] * 1.0 * self.compiled.coax_loop_weight[ q ]) * C_eff_for_coax.dQ[(k+1)%N][(j-1)%N]
+                        if ligated[k%N]: Z_BPq.dQ[i%N][j%N] += param_log_derivs( Z_BP.Q[(i+1)%N][k%N] * C_eff_for_coax.Q[(k+1)%N][(j-1)%N] * tagged.compiled.coax_loop_weight[ q ] )
                 for k in range( i+2, i+offset-1 ):
-                    if ligated[(k-1)%N]: Z_BPq.dQ[i%N][j%N] += C_eff_for_coax.dQ[(i+1)%N][(k-1)%N] * Z_BP.Q[k%N][(j-1)%N] * l**2 * l_coax * K_coax / Kdq
-                    if ligated[(k-1)%N]: Z_BPq.dQ[i%N][j%N] += C_eff_for_coax.Q[(i+1)%N][(k-1)%N] * Z_BP.dQ[k%N][(j-1)%N] * l**2 * l_coax * K_coax / Kdq
+                    if C_eff_for_coax.Q[(i+1)%N][(k-1)%N] * Z_BP.Q[k%N][(j-1)%N] * self.compiled.coax_loop_weight[ q ] > 0:
+                        if ligated[(k-1)%N]: Z_BPq.dQ[i%N][j%N] += (1.0 * Z_BP.Q[k%N][(j-1)%N] * self.compiled.coax_loop_weight[ q ]) * C_eff_for_coax.dQ[(i+1)%N][(k-1)%N]
+                        if ligated[(k-1)%N]: Z_BPq.dQ[i%N][j%N] += (C_eff_for_coax.Q[(i+1)%N][(k-1)%N] * 1.0 * self.compiled.coax_loop_weight[ q ]) * Z_BP.dQ[k%N][(j-1)%N]
+                        if ligated[(k-1)%N]: Z_BPq.dQ[i%N][j%N] += param_log_derivs( C_eff_for_coax.Q[(i+1)%N][(k-1)%N] * Z_BP.Q[k%N][(j-1)%N] * tagged.compiled.coax_loop_weight[ q ] )
             if ligated[i%N]:
                 for k in range( i+2, i+offset ):
-                    Z_BPq.dQ[i%N][j%N] += Z_BP.dQ[(i+1)%N][k%N] * Z_cut.Q[k%N][j%N] * C_std * K_coax / Kdq
-                    Z_BPq.dQ[i%N][j%N] += Z_BP.Q[(i+1)%N][k%N] * Z_cut.dQ[k%N][j%N] * C_std * K_coax / Kdq
+                    if Z_BP.Q[(i+1)%N][k%N] * Z_cut.Q[k%N][j%N] * self.compiled.coax_cut_weight[ q ] > 0:
+                        Z_BPq.dQ[i%N][j%N] += (1.0 * Z_cut.Q[k%N][j%N] * self.compiled.coax_cut_weight[ q ]) * Z_BP.dQ[(i+1)%N][k%N]
+                        Z_BPq.dQ[i%N][j%N] += (Z_BP.Q[(i+1)%N][k%N] * 1.0 * self.compiled.coax_cut_weight[ q ]) * Z_cut.dQ[k%N][j%N]
+                        Z_BPq.dQ[i%N][j%N] += param_log_derivs( Z_BP.Q[(i+1)%N][k%N] * Z_cut.Q[k%N][j%N] * tagged.compiled.coax_cut_weight[ q ] )
             if ligated[(j-1)%N]:
                 for k in range( i, i+offset-1 ):
-                    Z_BPq.dQ[i%N][j%N] += Z_cut.dQ[i%N][k%N] * Z_BP.Q[k%N][(j-1)%N] * C_std * K_coax / Kdq
-                    Z_BPq.dQ[i%N][j%N] += Z_cut.Q[i%N][k%N] * Z_BP.dQ[k%N][(j-1)%N] * C_std * K_coax / Kdq
+                    if Z_cut.Q[i%N][k%N] * Z_BP.Q[k%N][(j-1)%N] * self.compiled.coax_cut_weight[ q ] > 0:
+                        Z_BPq.dQ[i%N][j%N] += (1.0 * Z_BP.Q[k%N][(j-1)%N] * self.compiled.coax_cut_weight[ q ]) * Z_cut.dQ[i%N][k%N]
+                        Z_BPq.dQ[i%N][j%N] += (Z_cut.Q[i%N][k%N] * 1.0 * self.compiled.coax_cut_weight[ q ]) * Z_BP.dQ[k%N][(j-1)%N]
+                        Z_BPq.dQ[i%N][j%N] += param_log_derivs( Z_cut.Q[i%N][k%N] * Z_BP.Q[k%N][(j-1)%N] * tagged.compiled.coax_cut_weight[ q ] )
 
     if self.options.calc_contrib: # AUTOGENERATED CONTRIBS BLOCK
         (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
@@ -211,14 +297,15 @@ def update_Z_BPq( self, i, j, base_pair_type ):
         if ( all_ligated[j%N][i%N] and ( ((i-j-1) % N)) < min_loop_length ): return
         if not base_pair_type.is_match( sequence[i], sequence[j] ): return
         (Z_BPq, Kdq)  = ( self.Z_BPq[ base_pair_type ], base_pair_type.Kd )
+        q = self.compiled.base_pair_type_index[ base_pair_type ] # parameter products for this base pair type are precomputed in self.compiled
         if ligated[i%N] and ligated[(j-1)%N]:
-            if (1.0/Kdq ) * ( C_eff_for_BP.Q[(i+1)%N][(j-1)%N] * l * l * l_BP) > 0:
-                Z_BPq.contribs[i%N][j%N]  +=  [ ((1.0/Kdq ) * ( C_eff_for_BP.Q[(i+1)%N][(j-1)%N] * l * l * l_BP), [(C_eff_for_BP,(i+1)%N,(j-1)%N)] ) ]
-            for base_pair_type2 in self.params.base_pair_types:
+            if self.compiled.loop_weight[ q ] * C_eff_for_BP.Q[(i+1)%N][(j-1)%N] > 0:
+                Z_BPq.contribs[i%N][j%N]  +=  [ (self.compiled.loop_weight[ q ] * C_eff_for_BP.Q[(i+1)%N][(j-1)%N], [(C_eff_for_BP,(i+1)%N,(j-1)%N)] ) ]
+            for (q2, base_pair_type2) in enumerate( self.params.base_pair_types ):
                 if base_pair_type2.is_match( sequence[(i+1)%N], sequence[(j-1)%N] ):
                     Z_BPq2 = self.Z_BPq[base_pair_type2]
-                    if (1.0/Kdq ) * self.params.C_eff_stack[base_pair_type][base_pair_type2] * Z_BPq2.Q[(i+1)%N][(j-1)%N] > 0:
-                        Z_BPq.contribs[i%N][j%N]  +=  [ ((1.0/Kdq ) * self.params.C_eff_stack[base_pair_type][base_pair_type2] * Z_BPq2.Q[(i+1)%N][(j-1)%N], [(Z_BPq2,(i+1)%N,(j-1)%N)] ) ]
+                    if self.compiled.stack_weight[ q ][ q2 ] * Z_BPq2.Q[(i+1)%N][(j-1)%N] > 0:
+                        Z_BPq.contribs[i%N][j%N]  +=  [ (self.compiled.stack_weight[ q ][ q2 ] * Z_BPq2.Q[(i+1)%N][(j-1)%N], [(Z_BPq2,(i+1)%N,(j-1)%N)] ) ]
         for motif_type in self.params.motif_types:
             if motif_type.start_base_pair_type != base_pair_type: continue
             if motif_type.is_match( sequence, ligated, i, j ):
@@ -226,24 +313,24 @@ def update_Z_BPq( self, i, j, base_pair_type ):
                 Z_BPq2 = self.Z_BPq[base_pair_type2]
                 if (1.0/Kdq ) * motif_type.C_eff * Z_BPq2.Q[(i_next)%N][(j_next)%N] > 0:
                     Z_BPq.contribs[i%N][j%N]  +=  [ ((1.0/Kdq ) * motif_type.C_eff * Z_BPq2.Q[(i_next)%N][(j_next)%N], [(Z_BPq2,(i_next)%N,(j_next)%N)] ) ]
-        if (C_std/Kdq) * Z_cut.Q[i%N][j%N] > 0:
-            Z_BPq.contribs[i%N][j%N] +=  [ ((C_std/Kdq) * Z_cut.Q[i%N][j%N], [(Z_cut,i%N,j%N)] ) ]
+        if self.compiled.cut_weight[ q ] * Z_cut.Q[i%N][j%N] > 0:
+            Z_BPq.contribs[i%N][j%N] +=  [ (self.compiled.cut_weight[ q ] * Z_cut.Q[i%N][j%N], [(Z_cut,i%N,j%N)] ) ]
         if K_coax > 0.0:
             if ligated[i%N] and ligated[(j-1)%N]:
                 for k in range( i+2, i+offset-1 ):
-                    if Z_BP.Q[(i+1)%N][k%N] * C_eff_for_coax.Q[(k+1)%N][(j-1)%N] * l**2 * l_coax * K_coax / Kdq > 0:
-                        if ligated[k%N]: Z_BPq.contribs[i%N][j%N] +=  [ (Z_BP.Q[(i+1)%N][k%N] * C_eff_for_coax.Q[(k+1)%N][(j-1)%N] * l**2 * l_coax * K_coax / Kdq, [(Z_BP,(i+1)%N,k%N), (C_eff_for_coax,(k+1)%N,(j-1)%N)] ) ]
+                    if Z_BP.Q[(i+1)%N][k%N] * C_eff_for_coax.Q[(k+1)%N][(j-1)%N] * self.compiled.coax_loop_weight[ q ] > 0:
+                        if ligated[k%N]: Z_BPq.contribs[i%N][j%N] +=  [ (Z_BP.Q[(i+1)%N][k%N] * C_eff_for_coax.Q[(k+1)%N][(j-1)%N] * self.compiled.coax_loop_weight[ q ], [(Z_BP,(i+1)%N,k%N), (C_eff_for_coax,(k+1)%N,(j-1)%N)] ) ]
                 for k in range( i+2, i+offset-1 ):
-                    if C_eff_for_coax.Q[(i+1)%N][(k-1)%N] * Z_BP.Q[k%N][(j-1)%N] * l**2 * l_coax * K_coax / Kdq > 0:
-                        if ligated[(k-1)%N]: Z_BPq.contribs[i%N][j%N] +=  [ (C_eff_for_coax.Q[(i+1)%N][(k-1)%N] * Z_BP.Q[k%N][(j-1)%N] * l**2 * l_coax * K_coax / Kdq, [(C_eff_for_coax,(i+1)%N,(k-1)%N), (Z_BP,k%N,(j-1)%N)] ) ]
+                    if C_eff_for_coax.Q[(i+1)%N][(k-1)%N] * Z_BP.Q[k%N][(j-1)%N] * self.compiled.coax_loop_weight[ q ] > 0:
+                        if ligated[(k-1)%N]: Z_BPq.contribs[i%N][j%N] +=  [ (C_eff_for_coax.Q[(i+1)%N][(k-1)%N] * Z_BP.Q[k%N][(j-1)%N] * self.compiled.coax_loop_weight[ q ], [(C_eff_for_coax,(i+1)%N,(k-1)%N), (Z_BP,k%N,(j-1)%N)] ) ]
             if ligated[i%N]:
                 for k in range( i+2, i+offset ):
-                    if Z_BP.Q[(i+1)%N][k%N] * Z_cut.Q[k%N][j%N] * C_std * K_coax / Kdq > 0:
-                        Z_BPq.contribs[i%N][j%N] +=  [ (Z_BP.Q[(i+1)%N][k%N] * Z_cut.Q[k%N][j%N] * C_std * K_coax / Kdq, [(Z_BP,(i+1)%N,k%N), (Z_cut,k%N,j%N)] ) ]
+                    if Z_BP.Q[(i+1)%N][k%N] * Z_cut.Q[k%N][j%N] * self.compiled.coax_cut_weight[ q ] > 0:
+                        Z_BPq.contribs[i%N][j%N] +=  [ (Z_BP.Q[(i+1)%N][k%N] * Z_cut.Q[k%N][j%N] * self.compiled.coax_cut_weight[ q ], [(Z_BP,(i+1)%N,k%N), (Z_cut,k%N,j%N)] ) ]
             if ligated[(j-1)%N]:
                 for k in range( i, i+offset-1 ):
-                    if Z_cut.Q[i%N][k%N] * Z_BP.Q[k%N][(j-1)%N] * C_std * K_coax / Kdq > 0:
-                        Z_BPq.contribs[i%N][j%N] +=  [ (Z_cut.Q[i%N][k%N] * Z_BP.Q[k%N][(j-1)%N] * C_std * K_coax / Kdq, [(Z_cut,i%N,k%N), (Z_BP,k%N,(j-1)%N)] ) ]
+                    if Z_cut.Q[i%N][k%N] * Z_BP.Q[k%N][(j-1)%N] * self.compiled.coax_cut_weight[ q ] > 0:
+                        Z_BPq.contribs[i%N][j%N] +=  [ (Z_cut.Q[i%N][k%N] * Z_BP.Q[k%N][(j-1)%N] * self.compiled.coax_cut_weight[ q ], [(Z_cut,i%N,k%N), (Z_BP,k%N,(j-1)%N)] ) ]
 
 ##################################################################################################
 def update_Z_BP( self, i, j ):
@@ -252,19 +339,36 @@ def update_Z_BP( self, i, j ):
     All the Z_BPq (partition functions for each base pair type) must have been
     filled in already for i,j.
     '''
+    if self.options.calc_adjoint: # AUTOGENERATED ADJOINT BLOCK
+        (factor_bar, factors) = (self.options.adjoint_factors.bar, self.options.adjoint_factors)
+        (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
+         sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
+        for base_pair_type in self.base_pair_types:
+            Z_BPq = self.Z_BPq[base_pair_type]
+            w = Z_BP.Q_bar[i%N][j%N] * Z_BPq.Q[i%N][j%N]
+            if w > 0: Z_BPq.Q_bar[i%N][j%N] += w / Z_BPq.Q[i%N][j%N]
+        return
+
     (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
      sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
 
+    # i and j base paired, with any base pair type q
+    #
+    #       Z_BPq
+    #    i ... j
+    #
     for base_pair_type in self.base_pair_types:
         Z_BPq = self.Z_BPq[base_pair_type]
         Z_BP.Q[i%N][j%N]  += Z_BPq.Q[i%N][j%N]
 
     if self.options.calc_deriv_DP: # AUTOGENERATED DERIV BLOCK
+        (param_log_derivs, tagged) = (self.options.forward_derivs.log_derivs, self.options.forward_derivs.tagged)
         (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
          sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
         for base_pair_type in self.base_pair_types:
             Z_BPq = self.Z_BPq[base_pair_type]
-            Z_BP.dQ[i%N][j%N]  += Z_BPq.dQ[i%N][j%N]
+            if Z_BPq.Q[i%N][j%N] > 0:
+                Z_BP.dQ[i%N][j%N]  += Z_BPq.dQ[i%N][j%N]
 
     if self.options.calc_contrib: # AUTOGENERATED CONTRIBS BLOCK
         (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
@@ -279,6 +383,21 @@ def update_Z_coax( self, i, j ):
     '''
     Z_coax(i,j) is the partition function for all structures that form coaxial stacks between (i,k) and (k+1,j) for some k
     '''
+    if self.options.calc_adjoint: # AUTOGENERATED ADJOINT BLOCK
+        (factor_bar, factors) = (self.options.adjoint_factors.bar, self.options.adjoint_factors)
+        (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
+         sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
+        offset = ( j - i ) % N
+        if (offset == N-1) and ligated[j%N]: return
+        if K_coax > 0:
+            for k in range( i+1, i+offset-1 ):
+                if ligated[k%N]:
+                    if Z_BP.val(i,k) == 0.0: continue
+                    if Z_BP.val(k+1,j) == 0.0: continue
+                    w = Z_coax.Q_bar[i%N][j%N] * Z_BP.Q[i%N][k%N] * Z_BP.Q[(k+1)%N][j%N] * K_coax
+                    if w > 0: Z_BP.Q_bar[i%N][k%N] += w / Z_BP.Q[i%N][k%N]; Z_BP.Q_bar[(k+1)%N][j%N] += w / Z_BP.Q[(k+1)%N][j%N]; factor_bar[ factors.K_coax ] += w
+        return
+
     (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
      sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
     offset = ( j - i ) % N
@@ -300,6 +419,7 @@ def update_Z_coax( self, i, j ):
                 Z_coax.Q[i%N][j%N]  += Z_BP.Q[i%N][k%N] * Z_BP.Q[(k+1)%N][j%N] * K_coax
 
     if self.options.calc_deriv_DP: # AUTOGENERATED DERIV BLOCK
+        (param_log_derivs, tagged) = (self.options.forward_derivs.log_derivs, self.options.forward_derivs.tagged)
         (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
          sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
         offset = ( j - i ) % N
@@ -309,8 +429,10 @@ def update_Z_coax( self, i, j ):
                 if ligated[k%N]:
                     if Z_BP.val(i,k) == 0.0: continue
                     if Z_BP.val(k+1,j) == 0.0: continue
-                    Z_coax.dQ[i%N][j%N]  += Z_BP.dQ[i%N][k%N] * Z_BP.Q[(k+1)%N][j%N] * K_coax
-                    Z_coax.dQ[i%N][j%N]  += Z_BP.Q[i%N][k%N] * Z_BP.dQ[(k+1)%N][j%N] * K_coax
+                    if Z_BP.Q[i%N][k%N] * Z_BP.Q[(k+1)%N][j%N] * K_coax > 0:
+                        Z_coax.dQ[i%N][j%N]  += (1.0 * Z_BP.Q[(k+1)%N][j%N] * K_coax) * Z_BP.dQ[i%N][k%N]
+                        Z_coax.dQ[i%N][j%N]  += (Z_BP.Q[i%N][k%N] * 1.0 * K_coax) * Z_BP.dQ[(k+1)%N][j%N]
+                        Z_coax.dQ[i%N][j%N]  += param_log_derivs( Z_BP.Q[i%N][k%N] * Z_BP.Q[(k+1)%N][j%N] * tagged.K_coax )
 
     if self.options.calc_contrib: # AUTOGENERATED CONTRIBS BLOCK
         (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
@@ -337,6 +459,29 @@ def update_C_eff_basic( self, i, j ):
       allow for free energy costs of loop closure to scale approximately log-linearly rather than
       linearly with loop size.
     '''
+    if self.options.calc_adjoint: # AUTOGENERATED ADJOINT BLOCK
+        (factor_bar, factors) = (self.options.adjoint_factors.bar, self.options.adjoint_factors)
+        offset = ( j - i ) % self.N
+        (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
+         sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
+        allow_loop_extension = not ( self.in_forced_base_pair and self.in_forced_base_pair[j%N] )
+        if ligated[(j-1)%N] and allow_loop_extension:
+            w = C_eff_basic.Q_bar[i%N][j%N] * C_eff.Q[i%N][(j-1)%N] * l
+            if w > 0: C_eff.Q_bar[i%N][(j-1)%N] += w / C_eff.Q[i%N][(j-1)%N]; factor_bar[ factors.l ] += w
+        exclude_strained_3WJ = (not allow_strained_3WJ) and (offset == N-1) and ligated[j%N]
+        C_eff_for_BP = C_eff_no_coax_singlet if exclude_strained_3WJ else C_eff
+        for k in range( i+1, i+offset):
+            if ligated[(k-1)%N]:
+                w = C_eff_basic.Q_bar[i%N][j%N] * C_eff_for_BP.Q[i%N][(k-1)%N] * l * Z_BP.Q[k%N][j%N] * l_BP
+                if w > 0: C_eff_for_BP.Q_bar[i%N][(k-1)%N] += w / C_eff_for_BP.Q[i%N][(k-1)%N]; Z_BP.Q_bar[k%N][j%N] += w / Z_BP.Q[k%N][j%N]; factor_bar[ factors.l ] += w; factor_bar[ factors.l_BP ] += w
+        if K_coax > 0:
+            C_eff_for_coax = C_eff_no_BP_singlet if exclude_strained_3WJ else C_eff
+            for k in range( i+1, i+offset):
+                if ligated[(k-1)%N]:
+                    w = C_eff_basic.Q_bar[i%N][j%N] * C_eff_for_coax.Q[i%N][(k-1)%N] * Z_coax.Q[k%N][j%N] * l * l_coax
+                    if w > 0: C_eff_for_coax.Q_bar[i%N][(k-1)%N] += w / C_eff_for_coax.Q[i%N][(k-1)%N]; Z_coax.Q_bar[k%N][j%N] += w / Z_coax.Q[k%N][j%N]; factor_bar[ factors.l ] += w; factor_bar[ factors.l_coax ] += w
+        return
+
     offset = ( j - i ) % self.N
 
     (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
@@ -373,21 +518,28 @@ def update_C_eff_basic( self, i, j ):
             if ligated[(k-1)%N]: C_eff_basic.Q[i%N][j%N] += C_eff_for_coax.Q[i%N][(k-1)%N] * Z_coax.Q[k%N][j%N] * l * l_coax
 
     if self.options.calc_deriv_DP: # AUTOGENERATED DERIV BLOCK
+        (param_log_derivs, tagged) = (self.options.forward_derivs.log_derivs, self.options.forward_derivs.tagged)
         offset = ( j - i ) % self.N
         (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
          sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
         allow_loop_extension = not ( self.in_forced_base_pair and self.in_forced_base_pair[j%N] )
-        if ligated[(j-1)%N] and allow_loop_extension: C_eff_basic.dQ[i%N][j%N] += C_eff.dQ[i%N][(j-1)%N] * l
+        if C_eff.Q[i%N][(j-1)%N] * l > 0:
+            if ligated[(j-1)%N] and allow_loop_extension: C_eff_basic.dQ[i%N][j%N] += (1.0 * l) * C_eff.dQ[i%N][(j-1)%N]
+            if ligated[(j-1)%N] and allow_loop_extension: C_eff_basic.dQ[i%N][j%N] += param_log_derivs( C_eff.Q[i%N][(j-1)%N] * tagged.l )
         exclude_strained_3WJ = (not allow_strained_3WJ) and (offset == N-1) and ligated[j%N]
         C_eff_for_BP = C_eff_no_coax_singlet if exclude_strained_3WJ else C_eff
         for k in range( i+1, i+offset):
-            if ligated[(k-1)%N]: C_eff_basic.dQ[i%N][j%N] += C_eff_for_BP.dQ[i%N][(k-1)%N] * l * Z_BP.Q[k%N][j%N] * l_BP
-            if ligated[(k-1)%N]: C_eff_basic.dQ[i%N][j%N] += C_eff_for_BP.Q[i%N][(k-1)%N] * l * Z_BP.dQ[k%N][j%N] * l_BP
+            if C_eff_for_BP.Q[i%N][(k-1)%N] * l * Z_BP.Q[k%N][j%N] * l_BP > 0:
+                if ligated[(k-1)%N]: C_eff_basic.dQ[i%N][j%N] += (1.0 * l * Z_BP.Q[k%N][j%N] * l_BP) * C_eff_for_BP.dQ[i%N][(k-1)%N]
+                if ligated[(k-1)%N]: C_eff_basic.dQ[i%N][j%N] += (C_eff_for_BP.Q[i%N][(k-1)%N] * l * 1.0 * l_BP) * Z_BP.dQ[k%N][j%N]
+                if ligated[(k-1)%N]: C_eff_basic.dQ[i%N][j%N] += param_log_derivs( C_eff_for_BP.Q[i%N][(k-1)%N] * tagged.l * Z_BP.Q[k%N][j%N] * tagged.l_BP )
         if K_coax > 0:
             C_eff_for_coax = C_eff_no_BP_singlet if exclude_strained_3WJ else C_eff
             for k in range( i+1, i+offset):
-                if ligated[(k-1)%N]: C_eff_basic.dQ[i%N][j%N] += C_eff_for_coax.dQ[i%N][(k-1)%N] * Z_coax.Q[k%N][j%N] * l * l_coax
-                if ligated[(k-1)%N]: C_eff_basic.dQ[i%N][j%N] += C_eff_for_coax.Q[i%N][(k-1)%N] * Z_coax.dQ[k%N][j%N] * l * l_coax
+                if C_eff_for_coax.Q[i%N][(k-1)%N] * Z_coax.Q[k%N][j%N] * l * l_coax > 0:
+                    if ligated[(k-1)%N]: C_eff_basic.dQ[i%N][j%N] += (1.0 * Z_coax.Q[k%N][j%N] * l * l_coax) * C_eff_for_coax.dQ[i%N][(k-1)%N]
+                    if ligated[(k-1)%N]: C_eff_basic.dQ[i%N][j%N] += (C_eff_for_coax.Q[i%N][(k-1)%N] * 1.0 * l * l_coax) * Z_coax.dQ[k%N][j%N]
+                    if ligated[(k-1)%N]: C_eff_basic.dQ[i%N][j%N] += param_log_derivs( C_eff_for_coax.Q[i%N][(k-1)%N] * Z_coax.Q[k%N][j%N] * tagged.l * tagged.l_coax )
 
     if self.options.calc_contrib: # AUTOGENERATED CONTRIBS BLOCK
         offset = ( j - i ) % self.N
@@ -409,6 +561,16 @@ def update_C_eff_basic( self, i, j ):
 
 ##################################################################################################
 def update_C_eff_no_coax_singlet( self, i, j ):
+    if self.options.calc_adjoint: # AUTOGENERATED ADJOINT BLOCK
+        (factor_bar, factors) = (self.options.adjoint_factors.bar, self.options.adjoint_factors)
+        (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
+         sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
+        w = C_eff_no_coax_singlet.Q_bar[i%N][j%N] * C_eff_basic.Q[i%N][j%N]
+        if w > 0: C_eff_basic.Q_bar[i%N][j%N] += w / C_eff_basic.Q[i%N][j%N]
+        w = C_eff_no_coax_singlet.Q_bar[i%N][j%N] * C_init * Z_BP.Q[i%N][j%N] * l_BP
+        if w > 0: Z_BP.Q_bar[i%N][j%N] += w / Z_BP.Q[i%N][j%N]; factor_bar[ factors.C_init ] += w; factor_bar[ factors.l_BP ] += w
+        return
+
     (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
      sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
 
@@ -417,10 +579,14 @@ def update_C_eff_no_coax_singlet( self, i, j ):
     C_eff_no_coax_singlet.Q[i%N][j%N] += C_init * Z_BP.Q[i%N][j%N] * l_BP
 
     if self.options.calc_deriv_DP: # AUTOGENERATED DERIV BLOCK
+        (param_log_derivs, tagged) = (self.options.forward_derivs.log_derivs, self.options.forward_derivs.tagged)
         (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
          sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
-        C_eff_no_coax_singlet.dQ[i%N][j%N] += C_eff_basic.dQ[i%N][j%N]
-        C_eff_no_coax_singlet.dQ[i%N][j%N] += C_init * Z_BP.dQ[i%N][j%N] * l_BP
+        if C_eff_basic.Q[i%N][j%N] > 0:
+            C_eff_no_coax_singlet.dQ[i%N][j%N] += C_eff_basic.dQ[i%N][j%N]
+        if C_init * Z_BP.Q[i%N][j%N] * l_BP > 0:
+            C_eff_no_coax_singlet.dQ[i%N][j%N] += (C_init * 1.0 * l_BP) * Z_BP.dQ[i%N][j%N]
+            C_eff_no_coax_singlet.dQ[i%N][j%N] += param_log_derivs( tagged.C_init * Z_BP.Q[i%N][j%N] * tagged.l_BP )
 
     if self.options.calc_contrib: # AUTOGENERATED CONTRIBS BLOCK
         (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
@@ -432,6 +598,17 @@ def update_C_eff_no_coax_singlet( self, i, j ):
 
 ##################################################################################################
 def update_C_eff_no_BP_singlet( self, i, j ):
+    if self.options.calc_adjoint: # AUTOGENERATED ADJOINT BLOCK
+        (factor_bar, factors) = (self.options.adjoint_factors.bar, self.options.adjoint_factors)
+        (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
+         sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
+        if K_coax > 0.0:
+            w = C_eff_no_BP_singlet.Q_bar[i%N][j%N] * C_eff_basic.Q[i%N][j%N]
+            if w > 0: C_eff_basic.Q_bar[i%N][j%N] += w / C_eff_basic.Q[i%N][j%N]
+            w = C_eff_no_BP_singlet.Q_bar[i%N][j%N] * C_init * Z_coax.Q[i%N][j%N] * l_coax
+            if w > 0: Z_coax.Q_bar[i%N][j%N] += w / Z_coax.Q[i%N][j%N]; factor_bar[ factors.C_init ] += w; factor_bar[ factors.l_coax ] += w
+        return
+
     (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
      sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
 
@@ -440,11 +617,15 @@ def update_C_eff_no_BP_singlet( self, i, j ):
         C_eff_no_BP_singlet.Q[i%N][j%N] += C_init * Z_coax.Q[i%N][j%N] * l_coax
 
     if self.options.calc_deriv_DP: # AUTOGENERATED DERIV BLOCK
+        (param_log_derivs, tagged) = (self.options.forward_derivs.log_derivs, self.options.forward_derivs.tagged)
         (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
          sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
         if K_coax > 0.0:
-            C_eff_no_BP_singlet.dQ[i%N][j%N] += C_eff_basic.dQ[i%N][j%N]
-            C_eff_no_BP_singlet.dQ[i%N][j%N] += C_init * Z_coax.dQ[i%N][j%N] * l_coax
+            if C_eff_basic.Q[i%N][j%N] > 0:
+                C_eff_no_BP_singlet.dQ[i%N][j%N] += C_eff_basic.dQ[i%N][j%N]
+            if C_init * Z_coax.Q[i%N][j%N] * l_coax > 0:
+                C_eff_no_BP_singlet.dQ[i%N][j%N] += (C_init * 1.0 * l_coax) * Z_coax.dQ[i%N][j%N]
+                C_eff_no_BP_singlet.dQ[i%N][j%N] += param_log_derivs( tagged.C_init * Z_coax.Q[i%N][j%N] * tagged.l_coax )
 
     if self.options.calc_contrib: # AUTOGENERATED CONTRIBS BLOCK
         (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
@@ -457,6 +638,19 @@ def update_C_eff_no_BP_singlet( self, i, j ):
 
 ##################################################################################################
 def update_C_eff( self, i, j ):
+    if self.options.calc_adjoint: # AUTOGENERATED ADJOINT BLOCK
+        (factor_bar, factors) = (self.options.adjoint_factors.bar, self.options.adjoint_factors)
+        (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
+         sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
+        w = C_eff.Q_bar[i%N][j%N] * C_eff_basic.Q[i%N][j%N]
+        if w > 0: C_eff_basic.Q_bar[i%N][j%N] += w / C_eff_basic.Q[i%N][j%N]
+        w = C_eff.Q_bar[i%N][j%N] * C_init * Z_BP.Q[i%N][j%N] * l_BP
+        if w > 0: Z_BP.Q_bar[i%N][j%N] += w / Z_BP.Q[i%N][j%N]; factor_bar[ factors.C_init ] += w; factor_bar[ factors.l_BP ] += w
+        if K_coax > 0.0:
+            w = C_eff.Q_bar[i%N][j%N] * C_init * Z_coax.Q[i%N][j%N] * l_coax
+            if w > 0: Z_coax.Q_bar[i%N][j%N] += w / Z_coax.Q[i%N][j%N]; factor_bar[ factors.C_init ] += w; factor_bar[ factors.l_coax ] += w
+        return
+
     (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
      sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
 
@@ -481,12 +675,18 @@ def update_C_eff( self, i, j ):
         C_eff.Q[i%N][j%N] += C_init * Z_coax.Q[i%N][j%N] * l_coax
 
     if self.options.calc_deriv_DP: # AUTOGENERATED DERIV BLOCK
+        (param_log_derivs, tagged) = (self.options.forward_derivs.log_derivs, self.options.forward_derivs.tagged)
         (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
          sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
-        C_eff.dQ[i%N][j%N] += C_eff_basic.dQ[i%N][j%N]
-        C_eff.dQ[i%N][j%N] += C_init * Z_BP.dQ[i%N][j%N] * l_BP
+        if C_eff_basic.Q[i%N][j%N] > 0:
+            C_eff.dQ[i%N][j%N] += C_eff_basic.dQ[i%N][j%N]
+        if C_init * Z_BP.Q[i%N][j%N] * l_BP > 0:
+            C_eff.dQ[i%N][j%N] += (C_init * 1.0 * l_BP) * Z_BP.dQ[i%N][j%N]
+            C_eff.dQ[i%N][j%N] += param_log_derivs( tagged.C_init * Z_BP.Q[i%N][j%N] * tagged.l_BP )
         if K_coax > 0.0:
-            C_eff.dQ[i%N][j%N] += C_init * Z_coax.dQ[i%N][j%N] * l_coax
+            if C_init * Z_coax.Q[i%N][j%N] * l_coax > 0:
+                C_eff.dQ[i%N][j%N] += (C_init * 1.0 * l_coax) * Z_coax.dQ[i%N][j%N]
+                C_eff.dQ[i%N][j%N] += param_log_derivs( tagged.C_init * Z_coax.Q[i%N][j%N] * tagged.l_coax )
 
     if self.options.calc_contrib: # AUTOGENERATED CONTRIBS BLOCK
         (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
@@ -506,6 +706,30 @@ def update_Z_linear( self, i, j ):
     Relies on previous Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear available for subfragments.
     Relies on Z_BP being already filled out for i,j
     '''
+    if self.options.calc_adjoint: # AUTOGENERATED ADJOINT BLOCK
+        (factor_bar, factors) = (self.options.adjoint_factors.bar, self.options.adjoint_factors)
+        offset = ( j - i ) % self.N
+        (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
+         sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
+        allow_loop_extension = ( not self.in_forced_base_pair ) or ( not self.in_forced_base_pair[j%N] )
+        if ligated[(j-1)%N] and allow_loop_extension:
+            w = Z_linear.Q_bar[i%N][j%N] * Z_linear.Q[i%N][(j-1)%N]
+            if w > 0: Z_linear.Q_bar[i%N][(j-1)%N] += w / Z_linear.Q[i%N][(j-1)%N]
+        w = Z_linear.Q_bar[i%N][j%N] * Z_BP.Q[i%N][j%N]
+        if w > 0: Z_BP.Q_bar[i%N][j%N] += w / Z_BP.Q[i%N][j%N]
+        for k in range( i+1, i+offset):
+            if ligated[(k-1)%N]:
+                w = Z_linear.Q_bar[i%N][j%N] * Z_linear.Q[i%N][(k-1)%N] * Z_BP.Q[k%N][j%N]
+                if w > 0: Z_linear.Q_bar[i%N][(k-1)%N] += w / Z_linear.Q[i%N][(k-1)%N]; Z_BP.Q_bar[k%N][j%N] += w / Z_BP.Q[k%N][j%N]
+        if K_coax > 0.0:
+            w = Z_linear.Q_bar[i%N][j%N] * Z_coax.Q[i%N][j%N]
+            if w > 0: Z_coax.Q_bar[i%N][j%N] += w / Z_coax.Q[i%N][j%N]
+            for k in range( i+1, i+offset):
+                if ligated[(k-1)%N]:
+                    w = Z_linear.Q_bar[i%N][j%N] * Z_linear.Q[i%N][(k-1)%N] * Z_coax.Q[k%N][j%N]
+                    if w > 0: Z_linear.Q_bar[i%N][(k-1)%N] += w / Z_linear.Q[i%N][(k-1)%N]; Z_coax.Q_bar[k%N][j%N] += w / Z_coax.Q[k%N][j%N]
+        return
+
     offset = ( j - i ) % self.N
 
     (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
@@ -554,20 +778,26 @@ def update_Z_linear( self, i, j ):
 
 
     if self.options.calc_deriv_DP: # AUTOGENERATED DERIV BLOCK
+        (param_log_derivs, tagged) = (self.options.forward_derivs.log_derivs, self.options.forward_derivs.tagged)
         offset = ( j - i ) % self.N
         (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
          sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
         allow_loop_extension = ( not self.in_forced_base_pair ) or ( not self.in_forced_base_pair[j%N] )
-        if ligated[(j-1)%N] and allow_loop_extension: Z_linear.dQ[i%N][j%N] += Z_linear.dQ[i%N][(j-1)%N]
-        Z_linear.dQ[i%N][j%N] += Z_BP.dQ[i%N][j%N]
+        if Z_linear.Q[i%N][(j-1)%N] > 0:
+            if ligated[(j-1)%N] and allow_loop_extension: Z_linear.dQ[i%N][j%N] += Z_linear.dQ[i%N][(j-1)%N]
+        if Z_BP.Q[i%N][j%N] > 0:
+            Z_linear.dQ[i%N][j%N] += Z_BP.dQ[i%N][j%N]
         for k in range( i+1, i+offset):
-            if ligated[(k-1)%N]: Z_linear.dQ[i%N][j%N] += Z_linear.dQ[i%N][(k-1)%N] * Z_BP.Q[k%N][j%N]
-            if ligated[(k-1)%N]: Z_linear.dQ[i%N][j%N] += Z_linear.Q[i%N][(k-1)%N] * Z_BP.dQ[k%N][j%N]
+            if Z_linear.Q[i%N][(k-1)%N] * Z_BP.Q[k%N][j%N] > 0:
+                if ligated[(k-1)%N]: Z_linear.dQ[i%N][j%N] += (1.0 * Z_BP.Q[k%N][j%N]) * Z_linear.dQ[i%N][(k-1)%N]
+                if ligated[(k-1)%N]: Z_linear.dQ[i%N][j%N] += (Z_linear.Q[i%N][(k-1)%N] * 1.0) * Z_BP.dQ[k%N][j%N]
         if K_coax > 0.0:
-            Z_linear.dQ[i%N][j%N] += Z_coax.dQ[i%N][j%N]
+            if Z_coax.Q[i%N][j%N] > 0:
+                Z_linear.dQ[i%N][j%N] += Z_coax.dQ[i%N][j%N]
             for k in range( i+1, i+offset):
-                if ligated[(k-1)%N]: Z_linear.dQ[i%N][j%N] += Z_linear.dQ[i%N][(k-1)%N] * Z_coax.Q[k%N][j%N]
-                if ligated[(k-1)%N]: Z_linear.dQ[i%N][j%N] += Z_linear.Q[i%N][(k-1)%N] * Z_coax.dQ[k%N][j%N]
+                if Z_linear.Q[i%N][(k-1)%N] * Z_coax.Q[k%N][j%N] > 0:
+                    if ligated[(k-1)%N]: Z_linear.dQ[i%N][j%N] += (1.0 * Z_coax.Q[k%N][j%N]) * Z_linear.dQ[i%N][(k-1)%N]
+                    if ligated[(k-1)%N]: Z_linear.dQ[i%N][j%N] += (Z_linear.Q[i%N][(k-1)%N] * 1.0) * Z_coax.dQ[k%N][j%N]
 
     if self.options.calc_contrib: # AUTOGENERATED CONTRIBS BLOCK
         offset = ( j - i ) % self.N
@@ -590,6 +820,58 @@ def update_Z_linear( self, i, j ):
 
 ##################################################################################################
 def update_Z_final( self, i ):
+    if self.options.calc_adjoint: # AUTOGENERATED ADJOINT BLOCK
+        (factor_bar, factors) = (self.options.adjoint_factors.bar, self.options.adjoint_factors)
+        (C_init, l, l_BP, K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
+         sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
+        Z_final = self.Z_final
+        if not ligated[((i - 1))%N]:
+            w = Z_final.Q_bar[i%N] * Z_linear.Q[i%N][(i-1)%N]
+            if w > 0: Z_linear.Q_bar[i%N][(i-1)%N] += w / Z_linear.Q[i%N][(i-1)%N]
+        else:
+            w = Z_final.Q_bar[i%N] * C_eff_no_coax_singlet.Q[i%N][(i-1)%N] * l / C_std
+            if w > 0: C_eff_no_coax_singlet.Q_bar[i%N][(i-1)%N] += w / C_eff_no_coax_singlet.Q[i%N][(i-1)%N]; factor_bar[ factors.l ] += w; factor_bar[ factors.C_std ] -= w
+            for c in range( i, i + N - 1):
+                if not ligated[c%N]:
+                    w = Z_final.Q_bar[i%N] * Z_linear.Q[i%N][c%N] * Z_linear.Q[(c+1)%N][(i-1)%N]
+                    if w > 0: Z_linear.Q_bar[i%N][c%N] += w / Z_linear.Q[i%N][c%N]; Z_linear.Q_bar[(c+1)%N][(i-1)%N] += w / Z_linear.Q[(c+1)%N][(i-1)%N]
+            for j in range( i+1, (i + N - 1) ):
+                if ligated[j%N]:
+                    if Z_BP.val(i,j) > 0.0 and Z_BP.val(j+1,i-1) > 0.0:
+                        for base_pair_type in self.params.base_pair_types:
+                            if self.Z_BPq[base_pair_type].val(i,j) == 0.0: continue
+                            for base_pair_type2 in self.params.base_pair_types:
+                                if self.Z_BPq[base_pair_type2].val(j+1,i-1) == 0.0: continue
+                                Z_BPq1 = self.Z_BPq[base_pair_type]
+                                Z_BPq2 = self.Z_BPq[base_pair_type2]
+                                w = Z_final.Q_bar[i%N] * self.params.C_eff_stack[base_pair_type2.flipped][base_pair_type] * Z_BPq2.Q[(j+1)%N][(i-1)%N] * Z_BPq1.Q[i%N][j%N]
+                                if w > 0: Z_BPq2.Q_bar[(j+1)%N][(i-1)%N] += w / Z_BPq2.Q[(j+1)%N][(i-1)%N]; Z_BPq1.Q_bar[i%N][j%N] += w / Z_BPq1.Q[i%N][j%N]; factor_bar[ factors.C_eff_stack[base_pair_type2.flipped][base_pair_type] ] += w
+                for motif_type in self.params.motif_types:
+                    for k in range( i, i+len( motif_type.strands[-1] )-1 ):
+                        if motif_type.is_match( sequence, ligated, j, k ):
+                            (base_pair_type2, j_next, k_next) = motif_type.get_other_base_pair( j, k )
+                            Z_BPq1 = self.Z_BPq[motif_type.start_base_pair_type.flipped]
+                            Z_BPq2 = self.Z_BPq[base_pair_type2]
+                            w = Z_final.Q_bar[i%N] * motif_type.C_eff * Z_BPq2.Q[(j_next)%N][(k_next)%N] * Z_BPq1.Q[k%N][j%N]
+                            if w > 0: Z_BPq2.Q_bar[(j_next)%N][(k_next)%N] += w / Z_BPq2.Q[(j_next)%N][(k_next)%N]; Z_BPq1.Q_bar[k%N][j%N] += w / Z_BPq1.Q[k%N][j%N]; factor_bar[ factors.C_eff[motif_type] ] += w
+            if K_coax > 0:
+                C_eff_for_coax = C_eff if allow_strained_3WJ else C_eff_no_BP_singlet
+                for j in range( i + 1, i + N - 2):
+                    for k in range( j + 2, i + N - 1):
+                        if not ligated[j%N]: continue
+                        if not ligated[(k-1)%N]: continue
+                        if Z_BP.val(i,j) == 0: continue
+                        if Z_BP.val(k,i-1) == 0: continue
+                        w = Z_final.Q_bar[i%N] * Z_BP.Q[i%N][j%N] * C_eff_for_coax.Q[(j+1)%N][(k-1)%N] * Z_BP.Q[k%N][(i-1)%N] * l * l * l_coax * K_coax
+                        if w > 0: Z_BP.Q_bar[i%N][j%N] += w / Z_BP.Q[i%N][j%N]; C_eff_for_coax.Q_bar[(j+1)%N][(k-1)%N] += w / C_eff_for_coax.Q[(j+1)%N][(k-1)%N]; Z_BP.Q_bar[k%N][(i-1)%N] += w / Z_BP.Q[k%N][(i-1)%N]; factor_bar[ factors.l ] += w; factor_bar[ factors.l ] += w; factor_bar[ factors.l_coax ] += w; factor_bar[ factors.K_coax ] += w
+                    for k in range( j + 1, i + N - 1):
+                        if Z_BP.val(i,j) == 0: continue
+                        if Z_BP.val(k,i-1) == 0: continue
+                        if (k-j)%N == 1 and ligated[j%N]: continue
+                        w = Z_final.Q_bar[i%N] * Z_BP.Q[i%N][j%N] * Z_cut.Q[j%N][k%N] * Z_BP.Q[k%N][(i-1)%N] * K_coax
+                        if w > 0: Z_BP.Q_bar[i%N][j%N] += w / Z_BP.Q[i%N][j%N]; Z_cut.Q_bar[j%N][k%N] += w / Z_cut.Q[j%N][k%N]; Z_BP.Q_bar[k%N][(i-1)%N] += w / Z_BP.Q[k%N][(i-1)%N]; factor_bar[ factors.K_coax ] += w
+        return
+
     # Z_final is total partition function, and is computed at end of filling dynamic programming arrays
     # Get the answer (in N ways!) --> so final output is actually Z_final(i), an array.
     # Equality of the array is tested in run_cross_checks()
@@ -598,6 +880,7 @@ def update_Z_final( self, i ):
 
     Z_final = self.Z_final
     if not ligated[((i - 1))%N]:
+        # i-1 and i are not ligated, so one segment runs from i around to i-1
         #
         #      i ------- i-1
         #
@@ -700,16 +983,21 @@ def update_Z_final( self, i ):
 
 
     if self.options.calc_deriv_DP: # AUTOGENERATED DERIV BLOCK
+        (param_log_derivs, tagged) = (self.options.forward_derivs.log_derivs, self.options.forward_derivs.tagged)
         (C_init, l, l_BP, K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
          sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
         Z_final = self.Z_final
         if not ligated[((i - 1))%N]:
-            Z_final.dQ[i%N] += Z_linear.dQ[i%N][(i-1)%N]
+            if Z_linear.Q[i%N][(i-1)%N] > 0:
+                Z_final.dQ[i%N] += Z_linear.dQ[i%N][(i-1)%N]
         else:
-            Z_final.dQ[i%N] += C_eff_no_coax_singlet.dQ[i%N][(i-1)%N] * l / C_std
+            if C_eff_no_coax_singlet.Q[i%N][(i-1)%N] * l / C_std > 0:
+                Z_final.dQ[i%N] += (1.0 * l / C_std) * C_eff_no_coax_singlet.dQ[i%N][(i-1)%N]
+                Z_final.dQ[i%N] += param_log_derivs( C_eff_no_coax_singlet.Q[i%N][(i-1)%N] * tagged.l / tagged.C_std )
             for c in range( i, i + N - 1):
-                if not ligated[c%N]: Z_final.dQ[i%N] += Z_linear.dQ[i%N][c%N] * Z_linear.Q[(c+1)%N][(i-1)%N]
-                if not ligated[c%N]: Z_final.dQ[i%N] += Z_linear.Q[i%N][c%N] * Z_linear.dQ[(c+1)%N][(i-1)%N]
+                if Z_linear.Q[i%N][c%N] * Z_linear.Q[(c+1)%N][(i-1)%N] > 0:
+                    if not ligated[c%N]: Z_final.dQ[i%N] += (1.0 * Z_linear.Q[(c+1)%N][(i-1)%N]) * Z_linear.dQ[i%N][c%N]
+                    if not ligated[c%N]: Z_final.dQ[i%N] += (Z_linear.Q[i%N][c%N] * 1.0) * Z_linear.dQ[(c+1)%N][(i-1)%N]
             for j in range( i+1, (i + N - 1) ):
                 if ligated[j%N]:
                     if Z_BP.val(i,j) > 0.0 and Z_BP.val(j+1,i-1) > 0.0:
@@ -719,16 +1007,20 @@ def update_Z_final( self, i ):
                                 if self.Z_BPq[base_pair_type2].val(j+1,i-1) == 0.0: continue
                                 Z_BPq1 = self.Z_BPq[base_pair_type]
                                 Z_BPq2 = self.Z_BPq[base_pair_type2]
-                                Z_final.dQ[i%N] += self.params.C_eff_stack[base_pair_type2.flipped][base_pair_type] * Z_BPq2.dQ[(j+1)%N][(i-1)%N] * Z_BPq1.Q[i%N][j%N]
-                                Z_final.dQ[i%N] += self.params.C_eff_stack[base_pair_type2.flipped][base_pair_type] * Z_BPq2.Q[(j+1)%N][(i-1)%N] * Z_BPq1.dQ[i%N][j%N]
+                                if self.params.C_eff_stack[base_pair_type2.flipped][base_pair_type] * Z_BPq2.Q[(j+1)%N][(i-1)%N] * Z_BPq1.Q[i%N][j%N] > 0:
+                                    Z_final.dQ[i%N] += (self.params.C_eff_stack[base_pair_type2.flipped][base_pair_type] * 1.0 * Z_BPq1.Q[i%N][j%N]) * Z_BPq2.dQ[(j+1)%N][(i-1)%N]
+                                    Z_final.dQ[i%N] += (self.params.C_eff_stack[base_pair_type2.flipped][base_pair_type] * Z_BPq2.Q[(j+1)%N][(i-1)%N] * 1.0) * Z_BPq1.dQ[i%N][j%N]
+                                    Z_final.dQ[i%N] += param_log_derivs( tagged.C_eff_stack[base_pair_type2.flipped][base_pair_type] * Z_BPq2.Q[(j+1)%N][(i-1)%N] * Z_BPq1.Q[i%N][j%N] )
                 for motif_type in self.params.motif_types:
                     for k in range( i, i+len( motif_type.strands[-1] )-1 ):
                         if motif_type.is_match( sequence, ligated, j, k ):
                             (base_pair_type2, j_next, k_next) = motif_type.get_other_base_pair( j, k )
                             Z_BPq1 = self.Z_BPq[motif_type.start_base_pair_type.flipped]
                             Z_BPq2 = self.Z_BPq[base_pair_type2]
-                            Z_final.dQ[i%N]  += motif_type.C_eff * Z_BPq2.dQ[(j_next)%N][(k_next)%N] * Z_BPq1.Q[k%N][j%N]
-                            Z_final.dQ[i%N]  += motif_type.C_eff * Z_BPq2.Q[(j_next)%N][(k_next)%N] * Z_BPq1.dQ[k%N][j%N]
+                            if motif_type.C_eff * Z_BPq2.Q[(j_next)%N][(k_next)%N] * Z_BPq1.Q[k%N][j%N] > 0:
+                                Z_final.dQ[i%N]  += (motif_type.C_eff * 1.0 * Z_BPq1.Q[k%N][j%N]) * Z_BPq2.dQ[(j_next)%N][(k_next)%N]
+                                Z_final.dQ[i%N]  += (motif_type.C_eff * Z_BPq2.Q[(j_next)%N][(k_next)%N] * 1.0) * Z_BPq1.dQ[k%N][j%N]
+                                Z_final.dQ[i%N]  += param_log_derivs( tagged.C_eff[motif_type] * Z_BPq2.Q[(j_next)%N][(k_next)%N] * Z_BPq1.Q[k%N][j%N] )
             if K_coax > 0:
                 C_eff_for_coax = C_eff if allow_strained_3WJ else C_eff_no_BP_singlet
                 for j in range( i + 1, i + N - 2):
@@ -737,16 +1029,20 @@ def update_Z_final( self, i ):
                         if not ligated[(k-1)%N]: continue
                         if Z_BP.val(i,j) == 0: continue
                         if Z_BP.val(k,i-1) == 0: continue
-                        Z_final.dQ[i%N] += Z_BP.dQ[i%N][j%N] * C_eff_for_coax.Q[(j+1)%N][(k-1)%N] * Z_BP.Q[k%N][(i-1)%N] * l * l * l_coax * K_coax
-                        Z_final.dQ[i%N] += Z_BP.Q[i%N][j%N] * C_eff_for_coax.dQ[(j+1)%N][(k-1)%N] * Z_BP.Q[k%N][(i-1)%N] * l * l * l_coax * K_coax
-                        Z_final.dQ[i%N] += Z_BP.Q[i%N][j%N] * C_eff_for_coax.Q[(j+1)%N][(k-1)%N] * Z_BP.dQ[k%N][(i-1)%N] * l * l * l_coax * K_coax
+                        if Z_BP.Q[i%N][j%N] * C_eff_for_coax.Q[(j+1)%N][(k-1)%N] * Z_BP.Q[k%N][(i-1)%N] * l * l * l_coax * K_coax > 0:
+                            Z_final.dQ[i%N] += (1.0 * C_eff_for_coax.Q[(j+1)%N][(k-1)%N] * Z_BP.Q[k%N][(i-1)%N] * l * l * l_coax * K_coax) * Z_BP.dQ[i%N][j%N]
+                            Z_final.dQ[i%N] += (Z_BP.Q[i%N][j%N] * 1.0 * Z_BP.Q[k%N][(i-1)%N] * l * l * l_coax * K_coax) * C_eff_for_coax.dQ[(j+1)%N][(k-1)%N]
+                            Z_final.dQ[i%N] += (Z_BP.Q[i%N][j%N] * C_eff_for_coax.Q[(j+1)%N][(k-1)%N] * 1.0 * l * l * l_coax * K_coax) * Z_BP.dQ[k%N][(i-1)%N]
+                            Z_final.dQ[i%N] += param_log_derivs( Z_BP.Q[i%N][j%N] * C_eff_for_coax.Q[(j+1)%N][(k-1)%N] * Z_BP.Q[k%N][(i-1)%N] * tagged.l * tagged.l * tagged.l_coax * tagged.K_coax )
                     for k in range( j + 1, i + N - 1):
                         if Z_BP.val(i,j) == 0: continue
                         if Z_BP.val(k,i-1) == 0: continue
                         if (k-j)%N == 1 and ligated[j%N]: continue
-                        Z_final.dQ[i%N] += Z_BP.dQ[i%N][j%N] * Z_cut.Q[j%N][k%N] * Z_BP.Q[k%N][(i-1)%N] * K_coax
-                        Z_final.dQ[i%N] += Z_BP.Q[i%N][j%N] * Z_cut.dQ[j%N][k%N] * Z_BP.Q[k%N][(i-1)%N] * K_coax
-                        Z_final.dQ[i%N] += Z_BP.Q[i%N][j%N] * Z_cut.Q[j%N][k%N] * Z_BP.dQ[k%N][(i-1)%N] * K_coax
+                        if Z_BP.Q[i%N][j%N] * Z_cut.Q[j%N][k%N] * Z_BP.Q[k%N][(i-1)%N] * K_coax > 0:
+                            Z_final.dQ[i%N] += (1.0 * Z_cut.Q[j%N][k%N] * Z_BP.Q[k%N][(i-1)%N] * K_coax) * Z_BP.dQ[i%N][j%N]
+                            Z_final.dQ[i%N] += (Z_BP.Q[i%N][j%N] * 1.0 * Z_BP.Q[k%N][(i-1)%N] * K_coax) * Z_cut.dQ[j%N][k%N]
+                            Z_final.dQ[i%N] += (Z_BP.Q[i%N][j%N] * Z_cut.Q[j%N][k%N] * 1.0 * K_coax) * Z_BP.dQ[k%N][(i-1)%N]
+                            Z_final.dQ[i%N] += param_log_derivs( Z_BP.Q[i%N][j%N] * Z_cut.Q[j%N][k%N] * Z_BP.Q[k%N][(i-1)%N] * tagged.K_coax )
 
     if self.options.calc_contrib: # AUTOGENERATED CONTRIBS BLOCK
         (C_init, l, l_BP, K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
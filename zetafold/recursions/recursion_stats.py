@@ -0,0 +1,197 @@
+from __future__ import print_function
+import ast
+import os
+import re
+import time
+
+##################################################################################################
+# Per-update-function and per-term profiling of the recursions, for partition( calc_stats = True ).
+#
+# The recursions are not touched. Instead, when stats are asked for, recursions.py or
+#  explicit_recursions.py is compiled a second time from its syntax tree, with counters and timers
+#  added, and those functions go into the dynamic programming matrices instead. Without stats,
+#  the usual functions run as is, with no overhead at all.
+#
+# Terms are the diagrammed pieces of each update function -- a term starts at a statement with a
+#  comment right above it, labeled by the first line of that comment (e.g., 'base pair forms a
+#  stacked pair with previous pair'), and goes on until the next comment at that level. For each
+#  term, p.stats has
+#
+#   updates     = number of times the term added to a DP matrix (the += lines),
+#   iterations  = number of times through its innermost loops (motif scans, coax partners, ...),
+#   time        = seconds spent in it,
+#
+#  and for each update function, the number of calls and seconds spent. The forward-mode
+#  derivative and contribs blocks of explicit_recursions.py count as terms of their own.
+#  Profiling makes the recursions several times slower, so compare times within a run.
+##################################################################################################
+_block_labels = { 'calc_deriv_DP': 'derivatives (forward mode)', 'calc_contrib': 'contribs (backtracking)', 'calc_adjoint': 'adjoint (reverse sweep)' }
+_profiled_recursions = {} # compiled once per process, for each of explicit and simple recursions
+_code_in_comment = re.compile( r'\bself\.\w|\w\[.*\]' ) # e.g., commented-out alternatives to the line below
+
+def get_recursions_file( use_simple_recursions = False ):
+    return os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'recursions.py' if use_simple_recursions else 'explicit_recursions.py' )
+
+def get_profiled_recursions( use_simple_recursions = False ):
+    '''
+    Namespace of the recursions with counters and timers, i.e., { 'update_Z_BPq': update_Z_BPq, ... }.
+    The update functions record into self.stats, a RecursionStats for this namespace.
+    '''
+    if not use_simple_recursions in _profiled_recursions:
+        recursions_file = get_recursions_file( use_simple_recursions )
+        source = open( recursions_file ).read()
+        ( tree, functions, terms ) = instrument_recursions( ast.parse( source, recursions_file ), source.split( '\n' ) )
+        recursions = { '__name__': 'zetafold.recursions.profiled_recursions', '_time': time.time,
+                       '_profiled_file': recursions_file, '_profiled_functions': functions, '_profiled_terms': terms }
+        exec( compile( tree, recursions_file, 'exec' ), recursions )
+        _profiled_recursions[ use_simple_recursions ] = recursions
+    return _profiled_recursions[ use_simple_recursions ]
+
+##################################################################################################
+class RecursionStats:
+    '''
+    Counters filled in by the profiled recursions (p.stats). Update functions are listed in
+     functions, with calls and time (s); terms are ( function, label, line ), with updates,
+     iterations, and time.
+    '''
+    def __init__( self, recursions ):
+        self.recursions_file = recursions[ '_profiled_file' ]
+        self.functions = recursions[ '_profiled_functions' ]
+        self.terms     = recursions[ '_profiled_terms' ]
+        self.calls = [ 0 ] * len( self.functions )
+        self.time  = [ 0.0 ] * len( self.functions )
+        self.term_updates    = [ 0 ] * len( self.terms )
+        self.term_iterations = [ 0 ] * len( self.terms )
+        self.term_time       = [ 0.0 ] * len( self.terms )
+
+    def get_function_stats( self, function ):
+        '''
+        ( calls, time ) for update function (e.g., 'update_Z_BPq')
+        '''
+        n = self.functions.index( function )
+        return ( self.calls[ n ], self.time[ n ] )
+
+    def get_term_stats( self, function, label ):
+        '''
+        ( updates, iterations, time ), summed over terms of function whose label contains label (e.g., 'left stack')
+        '''
+        ks = [ k for ( k, term ) in enumerate( self.terms ) if term[ 0 ] == function and label in term[ 1 ] ]
+        assert( ks )
+        return ( sum( self.term_updates[ k ] for k in ks ), sum( self.term_iterations[ k ] for k in ks ), sum( self.term_time[ k ] for k in ks ) )
+
+    def show( self ):
+        total_time = sum( self.time )
+        def percent( seconds ): return 100.0 * seconds / total_time if total_time > 0 else 0.0
+        print()
+        print( 'Recursion stats (%s; line numbers are for terms):' % os.path.basename( self.recursions_file ) )
+        print( '%12s %12s %10s %7s   %s' % ( 'calls', '', 'time (s)', '%', 'update function' ) )
+        print( '%12s %12s %10s %7s   %s' % ( 'updates', 'iterations', '', '', '  term' ) )
+        for n in sorted( range( len( self.functions ) ), key = lambda n: -self.time[ n ] ):
+            if self.calls[ n ] == 0: continue
+            print( '%12d %12s %10.4f %6.1f%%   %s' % ( self.calls[ n ], '', self.time[ n ], percent( self.time[ n ] ), self.functions[ n ] ) )
+            for ( k, ( function, label, line ) ) in enumerate( self.terms ):
+                if function != self.functions[ n ] or ( self.term_updates[ k ] == 0 and self.term_iterations[ k ] == 0 ): continue
+                print( '%12d %12d %10.4f %6.1f%%     %s [line %d]' % ( self.term_updates[ k ], self.term_iterations[ k ], self.term_time[ k ], percent( self.term_time[ k ] ), label, line ) )
+        print( '%12s %12s %10.4f %6.1f%%   %s' % ( '', '', total_time, 100.0, 'total' ) )
+        print()
+
+##################################################################################################
+# Syntax tree surgery
+##################################################################################################
+def instrument_recursions( tree, lines ):
+    '''
+    Add counters and timers to each update_* function in tree (parsed from lines).
+    Returns ( tree, functions, terms ), with the functions and terms ( function, label, line ) that
+     the counters refer to, by index.
+    '''
+    ( functions, terms ) = ( [], [] )
+    for function_def in tree.body:
+        if isinstance( function_def, ast.FunctionDef ) and function_def.name.startswith( 'update_' ):
+            instrument_function( function_def, lines, functions, terms )
+    return ( ast.fix_missing_locations( tree ), functions, terms )
+
+def instrument_function( function_def, lines, functions, terms ):
+    n = len( functions )
+    functions.append( function_def.name )
+    body = instrument_block( function_def.body, lines, function_def.name, None, terms )
+    docstring = []
+    if isinstance( body[ 0 ], ast.Expr ) and isinstance( body[ 0 ].value, ast.Str ): docstring = [ body.pop( 0 ) ]
+    function_def.body = docstring + [ make_statement( 'self.stats.calls[%d] += 1' % n, body[ 0 ] ) ] + \
+                        timed( body, 'self.stats.time[%d]' % n, '_stats_call_start' )
+
+def instrument_block( statements, lines, function, label, terms ):
+    '''
+    Statements with the terms in them counted and timed. label is that of the term the block is in,
+     if any; the innermost labeled statements are the ones that get timed.
+    '''
+    instrumented = []
+    for statement in statements:
+        label = get_label( statement, lines ) or label
+        if not has_update( statement ):
+            instrumented.append( statement )
+        elif any( get_label( inner, lines ) for inner in ast.walk( statement ) if inner is not statement and isinstance( inner, ast.stmt ) ):
+            for block in get_blocks( statement ): block[:] = instrument_block( block, lines, function, label, terms )
+            instrumented.append( statement )
+        else:
+            key = ( function, label or '(no diagram)' )
+            keys = [ term[ :2 ] for term in terms ]
+            if not key in keys:
+                terms.append( key + ( statement.lineno, ) )
+                keys.append( key )
+            k = keys.index( key )
+            instrumented += timed( add_counters( [ statement ], k ), 'self.stats.term_time[%d]' % k, '_stats_term_start' )
+    return instrumented
+
+def add_counters( statements, k ):
+    '''
+    Count updates (+=) and iterations of innermost loops in statements, for term k.
+    '''
+    counted = []
+    for statement in statements:
+        is_update = isinstance( statement, ast.AugAssign )
+        is_innermost_loop = isinstance( statement, ( ast.For, ast.While ) ) and not any( isinstance( inner, ( ast.For, ast.While ) ) for inner in ast.walk( statement ) if inner is not statement )
+        for block in get_blocks( statement ): block[:] = add_counters( block, k )
+        if is_update: counted.append( make_statement( 'self.stats.term_updates[%d] += 1' % k, statement ) )
+        if is_innermost_loop: statement.body.insert( 0, make_statement( 'self.stats.term_iterations[%d] += 1' % k, statement.body[ 0 ] ) )
+        counted.append( statement )
+    return counted
+
+def timed( statements, total, start ):
+    '''
+    [ start = _time(), try: statements, finally: total += _time() - start ]
+    '''
+    last_line = max( node.lineno for statement in statements for node in ast.walk( statement ) if hasattr( node, 'lineno' ) )
+    try_finally = ast.TryFinally( body = statements, finalbody = [ make_statement( '%s += _time() - %s' % ( total, start ), statements[ 0 ], last_line ) ] )
+    ast.copy_location( try_finally, statements[ 0 ] )
+    return [ make_statement( '%s = _time()' % start, statements[ 0 ] ), try_finally ]
+
+def make_statement( source, location, lineno = None ):
+    statement = ast.parse( source ).body[ 0 ]
+    for node in ast.walk( statement ):
+        if 'lineno' in node._attributes:
+            node.lineno = location.lineno if lineno == None else lineno
+            node.col_offset = location.col_offset
+    return statement
+
+def get_blocks( statement ):
+    blocks = [ getattr( statement, field ) for field in ( 'body', 'orelse', 'finalbody' ) if isinstance( getattr( statement, field, None ), list ) ]
+    return blocks + [ handler.body for handler in getattr( statement, 'handlers', [] ) ]
+
+def has_update( statement ): return any( isinstance( node, ast.AugAssign ) for node in ast.walk( statement ) )
+
+def get_label( statement, lines ):
+    '''
+    First line of the comment right above statement, or a name for autogenerated deriv/contrib blocks.
+    Comment lines with code in them are not labels -- if there is nothing else, the term goes with the
+     statement it is in.
+    '''
+    if isinstance( statement, ast.If ) and isinstance( statement.test, ast.Attribute ) and statement.test.attr in _block_labels:
+        return _block_labels[ statement.test.attr ]
+    comments = []
+    n = statement.lineno - 2
+    while n >= 0 and lines[ n ].strip().startswith( '#' ):
+        comments.insert( 0, lines[ n ].strip().strip( '#' ).strip() )
+        n -= 1
+    for comment in comments:
+        if comment and not _code_in_comment.search( comment ): return ' '.join( comment.split() )
+    return None
@@ -44,6 +44,7 @@ def update_Z_BPq( self, i, j, base_pair_type ):
     if not base_pair_type.is_match( sequence[i], sequence[j] ): return
 
     (Z_BPq, Kdq)  = ( self.Z_BPq[ base_pair_type ], base_pair_type.Kd )
+    q = self.compiled.base_pair_type_index[ base_pair_type ] # parameter products for this base pair type are precomputed in self.compiled
 
     if ligated[i] and ligated[j-1]:
         # base pair closes a loop
@@ -54,7 +55,7 @@ def update_Z_BPq( self, i, j, base_pair_type ):
         #   \       /
         #    i ... j
         #
-        Z_BPq[i][j]  += (1.0/Kdq ) * ( C_eff_for_BP[i+1][j-1] * l * l * l_BP)
+        Z_BPq[i][j]  += self.compiled.loop_weight[ q ] * C_eff_for_BP[i+1][j-1]
 
         # base pair forms a stacked pair with previous pair
         #
@@ -62,10 +63,10 @@ def update_Z_BPq( self, i, j, base_pair_type ):
         #    |     |
         #    i ... j
         #
-        for base_pair_type2 in self.params.base_pair_types:
+        for (q2, base_pair_type2) in enumerate( self.params.base_pair_types ):
             if base_pair_type2.is_match( sequence[(i+1)%N], sequence[(j-1)%N] ):
                 Z_BPq2 = self.Z_BPq[base_pair_type2]
-                Z_BPq[i][j]  += (1.0/Kdq ) * self.params.C_eff_stack[base_pair_type][base_pair_type2] * Z_BPq2[i+1][j-1]
+                Z_BPq[i][j]  += self.compiled.stack_weight[ q ][ q2 ] * Z_BPq2[i+1][j-1]
 
     # base pair forms a motif with previous pair
     #
@@ -87,7 +88,7 @@ def update_Z_BPq( self, i, j, base_pair_type ):
     #   \       /
     #    i ... j
     #
-    Z_BPq[i][j] += (C_std/Kdq) * Z_cut[i][j]
+    Z_BPq[i][j] += self.compiled.cut_weight[ q ] * Z_cut[i][j]
 
     if K_coax > 0.0:
         if ligated[i] and ligated[j-1]:
@@ -100,7 +101,7 @@ def update_Z_BPq( self, i, j, base_pair_type ):
             #    i ... j - j-1 ~
             #
             for k in range( i+2, i+offset-1 ):
-                if ligated[k]: Z_BPq[i][j] += Z_BP[i+1][k] * C_eff_for_coax[k+1][j-1] * l**2 * l_coax * K_coax / Kdq
+                if ligated[k]: Z_BPq[i][j] += Z_BP[i+1][k] * C_eff_for_coax[k+1][j-1] * self.compiled.coax_loop_weight[ q ]
 
             # coaxial stack of bp (i,j) and (k,j-1)...  close loop on left, and "right stack"
             #            ___
@@ -110,7 +111,7 @@ def update_Z_BPq( self, i, j, base_pair_type ):
             #  ~ i+1 - i ... j
             #
             for k in range( i+2, i+offset-1 ):
-                if ligated[k-1]: Z_BPq[i][j] += C_eff_for_coax[i+1][k-1] * Z_BP[k][j-1] * l**2 * l_coax * K_coax / Kdq
+                if ligated[k-1]: Z_BPq[i][j] += C_eff_for_coax[i+1][k-1] * Z_BP[k][j-1] * self.compiled.coax_loop_weight[ q ]
 
         # "left stack" but no loop closed on right (free strands hanging off j end)
         #      ___
@@ -121,7 +122,7 @@ def update_Z_BPq( self, i, j, base_pair_type ):
         #
         if ligated[i]:
             for k in range( i+2, i+offset ):
-                Z_BPq[i][j] += Z_BP[i+1][k] * Z_cut[k][j] * C_std * K_coax / Kdq
+                Z_BPq[i][j] += Z_BP[i+1][k] * Z_cut[k][j] * self.compiled.coax_cut_weight[ q ]
 
         # "right stack" but no loop closed on left (free strands hanging off i end)
         #       ___
@@ -132,10 +133,7 @@ def update_Z_BPq( self, i, j, base_pair_type ):
         #
         if ligated[j-1]:
             for k in range( i, i+offset-1 ):
-                Z_BPq[i][j] += Z_cut[i][k] * Z_BP[k][j-1] * C_std * K_coax / Kdq
-
-    # key 'special sauce' for derivative w.r.t. Kd
-    if self.options.calc_deriv_DP: Z_BPq[i][j].dQ += -(1.0/Kdq) * Z_BPq[i][j].Q
+                Z_BPq[i][j] += Z_cut[i][k] * Z_BP[k][j-1] * self.compiled.coax_cut_weight[ q ]
 
 ##################################################################################################
 def update_Z_BP( self, i, j ):
@@ -147,6 +145,11 @@ def update_Z_BP( self, i, j ):
     (C_init, l, l_BP,  K_coax, l_coax, C_std, min_loop_length, allow_strained_3WJ, N, \
      sequence, ligated, all_ligated, Z_BP, C_eff_basic, C_eff_no_BP_singlet, C_eff_no_coax_singlet, C_eff, Z_linear, Z_cut, Z_coax ) = unpack_variables( self )
 
+    # i and j base paired, with any base pair type q
+    #
+    #       Z_BPq
+    #    i ... j
+    #
     for base_pair_type in self.base_pair_types:
         Z_BPq = self.Z_BPq[base_pair_type]
         Z_BP[i][j]  += Z_BPq[i][j]
@@ -330,6 +333,7 @@ def update_Z_final( self, i ):
 
     Z_final = self.Z_final
     if not ligated[(i - 1)]:
+        # i-1 and i are not ligated, so one segment runs from i around to i-1
         #
         #      i ------- i-1
         #
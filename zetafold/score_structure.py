@@ -2,6 +2,7 @@
 from __future__ import print_function
 import argparse
 from math import log,exp
+import numpy as np
 import sys
 import os
 if __package__ == None: sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -13,72 +14,32 @@ from zetafold.util.assert_equal import assert_equal
 from zetafold.util.constants import KT_IN_KCAL
 from zetafold.util.output_util import show_derivs
 
-def score_structure( sequences, structure, circle = False, params = None, test_mode = False, allow_extra_base_pairs = False, deriv_params = None, deriv_check = False ):
+def score_structure( sequences, structure, circle = False, params = None, test_mode = False, allow_extra_base_pairs = False, deriv_params = None, deriv_check = False, hessian_vector = None ):
 
     # What we get if we parse out motifs
-    structure = secstruct_util.get_structure_string( structure )
-    bps_list  = secstruct_util.bps_from_secstruct( structure )
-    motifs = secstruct_util.parse_motifs( structure )
+    if not isinstance( structure, np.ndarray ): structure = secstruct_util.get_structure_string( structure ) # else a pair table
     sequence, ligated, sequences = sequence_util.initialize_sequence_and_ligated( sequences, circle )
     params = get_params( params, suppress_all_output = True )
     Kd_ref = params.base_pair_types[0].Kd # Kd[G-C], a la Turner rule convention
     C_std  = params.C_std
     log_derivs = None
+    log_derivs_hessian_vector = None
     if deriv_check and deriv_params == None: deriv_params = params.parameter_tags
 
     # Now go through each motif parsed out of the target structure
     Z = 1.0
-    for motif in motifs:
-        motif_res = []
-        motif_sequences = []
-        for strand in motif:
-            strand_sequence = ''
-            for i in strand:
-                motif_res.append( i )
-                strand_sequence += sequence[i]
-                if not ligated[i]:
-                    motif_sequences.append( strand_sequence )
-                    strand_sequence = ''
-            if len( strand_sequence ) > 0: motif_sequences.append( strand_sequence )
-        motif_circle = ligated[ motif_res[-1] ] and ( (motif_res[0] - motif_res[-1]) % len(sequence) == 1 )
-        motif_sequence = ''.join( motif_sequences )
+    for motif in get_motifs( sequence, ligated, structure ):
+        ( Z_motif, log_derivs_motif, log_derivs_hessian_vector_motif ) = score_motif( motif, params, deriv_params = deriv_params, allow_extra_base_pairs = allow_extra_base_pairs, hessian_vector = hessian_vector )
 
-        # each motif res better show up only once
-        assert( len( set( motif_res ) ) == len( motif_res ) )
-
-        motif_bps_list = []
-        for i,j in bps_list:
-            if motif_res.count( i ) == 0: continue
-            if motif_res.count( j ) == 0: continue
-            motif_bps_list.append( (motif_res.index(i), motif_res.index(j)) )
-        motif_structure = secstruct_util.secstruct_from_bps( motif_bps_list, len( motif_res ) )
-
-        p = partition.partition( motif_sequences, circle = motif_circle, structure = motif_structure, params = params, suppress_all_output = True, deriv_params = deriv_params, allow_extra_base_pairs = allow_extra_base_pairs )
-        Z_motif = p.Z
-        log_derivs_motif = p.log_derivs
-
-        # Need to 'correct' for half-terminal penalties (a la Turner rules) and also remove extra costs
-        # for connecting these 'sub-strands' together.
-
-        Z_motif *= ( Kd_ref / C_std ) ** sequence_util.get_num_strand_connections( motif_sequences, motif_circle )
-        for i_motif, j_motif in motif_bps_list:
-            # what kind of base pair is this?
-            for base_pair_type in p.params.base_pair_types:
-                if base_pair_type.is_match( motif_sequence[ i_motif ], motif_sequence[ j_motif ] ):
-                    Z_motif *= ( base_pair_type.Kd / Kd_ref )**(0.5)
-                    if deriv_params:
-                        Kd_tags = ["Kd_"+base_pair_type.get_tag(), "Kd_"+base_pair_type.flipped.get_tag()]
-                        for Kd_tag in Kd_tags:
-                            if deriv_params.count( Kd_tag ): log_derivs_motif[ deriv_params.index( Kd_tag ) ] += 0.5
-                    break
-
-        if test_mode: print("Motif: ", Z_motif, motif, motif_sequences, motif_structure)
+        if test_mode: print("Motif: ", Z_motif, motif[0], motif[2])
 
         Z *= Z_motif
-        if Z_motif == 0.0: print( 'Hey, motif not permitted!: ', motif_sequences, motif_structure )
         if deriv_params:
             if log_derivs == None: log_derivs = [0.0]*len( deriv_params )
             for n, log_deriv_motif in enumerate( log_derivs_motif ): log_derivs[n] += log_deriv_motif
+        if hessian_vector is not None:
+            if log_derivs_hessian_vector is None: log_derivs_hessian_vector = np.zeros( np.shape( hessian_vector ) )
+            log_derivs_hessian_vector += np.array( log_derivs_hessian_vector_motif )
 
     # Compute cost of connecting the strands into a complex
     Z_connect = ( C_std / Kd_ref ) ** sequence_util.get_num_strand_connections( sequences, circle )
@@ -86,6 +47,7 @@ def score_structure( sequences, structure, circle = False, params = None, test_m
     dG = -KT_IN_KCAL * log( Z )
 
     if deriv_params and log_derivs == None: log_derivs = [0.0]*len( deriv_params )
+    if hessian_vector is not None and log_derivs_hessian_vector is None: log_derivs_hessian_vector = np.zeros( np.shape( hessian_vector ) )
 
     if test_mode:
         print("Connect strands: ", Z_connect)
@@ -130,9 +92,114 @@ def score_structure( sequences, structure, circle = False, params = None, test_m
         for val1,val2 in zip(analytic_grad_val,numerical_grad_val): assert_equal( val1, val2 )
         print()
 
+    if hessian_vector is not None: return (dG,log_derivs,log_derivs_hessian_vector.tolist())
     if deriv_params: return (dG,log_derivs)
     return dG
 
+def get_motifs( sequence, ligated, structure ):
+    '''
+    Motifs (hairpins, interior loops, junctions, exterior strands) of structure, each as
+       ( motif_sequences, motif_circle, motif_structure, motif_bps_list )
+    with motif_sequences and motif_bps_list as tuples, so that identical motifs compare (and hash) equal.
+    structure can be a dot-paren string or a pair table (see secstruct_util).
+    '''
+    structure = secstruct_util.get_pair_table( structure )
+    pair_table = structure.tolist()
+    motifs = []
+    for motif in secstruct_util.parse_motifs( structure ):
+        motif_res = []
+        motif_sequences = []
+        for strand in motif:
+            strand_sequence = ''
+            for i in strand:
+                motif_res.append( i )
+                strand_sequence += sequence[i]
+                if not ligated[i]:
+                    motif_sequences.append( strand_sequence )
+                    strand_sequence = ''
+            if len( strand_sequence ) > 0: motif_sequences.append( strand_sequence )
+        motif_circle = ligated[ motif_res[-1] ] and ( (motif_res[0] - motif_res[-1]) % len(sequence) == 1 )
+
+        # each motif res better show up only once
+        assert( len( set( motif_res ) ) == len( motif_res ) )
+
+        motif_idx = dict( (i,n) for (n,i) in enumerate( motif_res ) )
+        motif_bps_list = []
+        for i in sorted( motif_res ):
+            j = pair_table[ i ]
+            if j > i and j in motif_idx: motif_bps_list.append( (motif_idx[i], motif_idx[j]) )
+        motif_structure = secstruct_util.secstruct_from_bps( motif_bps_list, len( motif_res ) )
+        motifs.append( ( tuple( motif_sequences ), motif_circle, motif_structure, tuple( motif_bps_list ) ) )
+    return motifs
+
+def score_motif( motif, params, deriv_params = None, allow_extra_base_pairs = False, hessian_vector = None ):
+    '''
+    Z_motif, log_derivs_motif, log_derivs_hessian_vector_motif for one motif from get_motifs().
+    '''
+    ( motif_sequences, motif_circle, motif_structure, motif_bps_list ) = motif
+    motif_sequences = list( motif_sequences )
+    motif_sequence = ''.join( motif_sequences )
+    Kd_ref = params.base_pair_types[0].Kd # Kd[G-C], a la Turner rule convention
+    C_std  = params.C_std
+
+    p = partition.partition( motif_sequences, circle = motif_circle, structure = motif_structure, params = params, suppress_all_output = True, deriv_params = deriv_params, allow_extra_base_pairs = allow_extra_base_pairs, hessian_vector = hessian_vector )
+    Z_motif = p.Z
+    log_derivs_motif = p.log_derivs
+
+    # Need to 'correct' for half-terminal penalties (a la Turner rules) and also remove extra costs
+    # for connecting these 'sub-strands' together.
+
+    Z_motif *= ( Kd_ref / C_std ) ** sequence_util.get_num_strand_connections( motif_sequences, motif_circle )
+    for i_motif, j_motif in motif_bps_list:
+        # what kind of base pair is this?
+        for base_pair_type in p.params.base_pair_types:
+            if base_pair_type.is_match( motif_sequence[ i_motif ], motif_sequence[ j_motif ] ):
+                Z_motif *= ( base_pair_type.Kd / Kd_ref )**(0.5)
+                if deriv_params:
+                    Kd_tags = ["Kd_"+base_pair_type.get_tag(), "Kd_"+base_pair_type.flipped.get_tag()]
+                    for Kd_tag in Kd_tags:
+                        if deriv_params.count( Kd_tag ): log_derivs_motif[ deriv_params.index( Kd_tag ) ] += 0.5
+                break
+
+    if Z_motif == 0.0: print( 'Hey, motif not permitted!: ', motif_sequences, motif_structure )
+
+    # the Kd corrections above are linear in log Kd, so they do not show up in the hessian-vector product.
+    return ( Z_motif, log_derivs_motif, p.log_derivs_hessian_vector )
+
+def score_structures( sequences, structures, circle = False, params = None, allow_extra_base_pairs = False, deriv_params = None ):
+    '''
+    score_structure() for many structures of the same sequences, e.g., stochastic samples or design candidates.
+    Motifs that show up in more than one structure are only scored once.
+
+    Output: numpy array of dG, one per structure -- or (dG, log_derivs) if deriv_params is given,
+      with log_derivs a numpy array of shape ( number of structures, number of deriv_params )
+    '''
+    sequence, ligated, sequences = sequence_util.initialize_sequence_and_ligated( sequences, circle )
+    params = get_params( params, suppress_all_output = True )
+    if deriv_params == []: deriv_params = list( params.parameter_tags )
+    Kd_ref = params.base_pair_types[0].Kd
+    C_std  = params.C_std
+    log_Z_connect = sequence_util.get_num_strand_connections( sequences, circle ) * log( C_std / Kd_ref )
+
+    motif_scores = {}
+    log_Z = np.zeros( len( structures ) )
+    log_derivs = np.zeros( ( len( structures ), len( deriv_params ) ) ) if deriv_params else None
+    pair_tables = secstruct_util.pair_tables_from_secstructs( [ secstruct_util.get_structure_string( structure ) for structure in structures ] )
+    for n,pair_table in enumerate( pair_tables ):
+        for motif in get_motifs( sequence, ligated, pair_table ):
+            if not motif in motif_scores:
+                ( Z_motif, log_derivs_motif, _ ) = score_motif( motif, params, deriv_params = deriv_params, allow_extra_base_pairs = allow_extra_base_pairs )
+                log_Z_motif = log( Z_motif ) if Z_motif > 0.0 else float( '-inf' )
+                motif_scores[ motif ] = ( log_Z_motif, np.array( log_derivs_motif ) if deriv_params else None )
+            ( log_Z_motif, log_derivs_motif ) = motif_scores[ motif ]
+            log_Z[ n ] += log_Z_motif
+            if deriv_params: log_derivs[ n ] += log_derivs_motif
+        log_Z[ n ] += log_Z_connect
+
+    dG = -KT_IN_KCAL * log_Z
+    if deriv_params: return ( dG, log_derivs )
+    return dG
+
 if __name__=='__main__':
     parser = argparse.ArgumentParser( description = "Compute nearest neighbor model partitition function for RNA sequence" )
     parser.add_argument( "-s","-seq","--sequences",help="RNA sequences (separate by space)",nargs='*')
@@ -0,0 +1,373 @@
+#!/usr/bin/python
+from __future__ import print_function
+import argparse
+import os
+import sys
+import json
+import time
+import threading
+import traceback
+import Queue
+import BaseHTTPServer
+import SocketServer
+from collections import OrderedDict
+from multiprocessing import Pool, TimeoutError
+if __package__ == None: sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from zetafold.parameters import get_params
+from zetafold.partition import partition
+from zetafold.partition_cache import cached_partition, PartitionCache
+from zetafold.score_structure import score_structures
+from zetafold.util.output_util import get_bpp_triplets
+
+##################################################################################################
+# Folding server.
+#
+# Keeps parameters loaded and worker processes running, and answers JSON requests over HTTP
+#  (on a port, or on a Unix socket):
+#
+#    POST /fold    { "sequences": "GCAACG CGAAGC", "circle": false, "structure": null, "allow_extra_base_pairs": false,
+#                    "mfe": false, "bpp": false, "bpp_cutoff": 1e-5, "n_stochastic": 0,
+#                    "deriv_params": null, "deriv_method": "analytic" }
+#              --> { "Z", "dG", and "mfe", "bpp" as [ i, j, p ] triplets, "stochastic", "log_derivs" as requested }
+#
+#    POST /score   { "sequences": ..., "circle": false, "structures": [ ... ] (or "structure": ...), "deriv_params": null }
+#              --> { "dG": [ ... ], "log_derivs": [ [ ... ], ... ] }
+#
+#  Every response also has "timing": seconds spent waiting (for a batch and for a worker), computing, and in total.
+#  A request whose result is not back within --timeout seconds gets a 504 with its "id".
+#  With "async": true, a request returns { "id": ... } right away; GET /result/<id> gives the
+#  result once it is ready (and { "id", "status": "pending" } before that), for up to --result_ttl
+#  seconds after it is ready. GET /status shows counts.
+#
+# Requests that arrive within batch_window of each other are sent to the workers together:
+#  identical fold requests are only computed once, and score requests for the same sequences
+#  go through one score_structures() call, so motifs shared between them are scored once (if
+#  that call fails, each of them is scored on its own, so an error only fails its own request).
+##################################################################################################
+class Job:
+    def __init__( self, job_id, kind, request ):
+        self.job_id = job_id
+        self.kind = kind
+        self.request = request
+        self.result = None
+        self.done = threading.Event()
+        self.submit_time = time.time()
+        self.start_time = None
+        self.finish_time = None
+
+    def finish( self, result, start_time, compute_time ):
+        '''
+        start_time is when a worker started on the job (None if it never did).
+        '''
+        self.finish_time = time.time()
+        self.start_time = start_time if start_time != None else self.finish_time
+        result[ 'timing' ] = OrderedDict( [ ( 'queue', self.start_time - self.submit_time ),
+                                            ( 'compute', compute_time ),
+                                            ( 'total', self.finish_time - self.submit_time ) ] )
+        self.result = result
+        self.done.set()
+
+class FoldingServer:
+    '''
+    Batches up submitted Jobs and runs them on jobs worker processes (or in a background thread of this process, if jobs = 1).
+    Finished jobs are forgotten once their result is fetched, or result_ttl seconds after they finish.
+    Jobs whose workers have not come back after timeout seconds (e.g., a worker died) finish with an error.
+    '''
+    def __init__( self, params, jobs = 1, batch_window = 0.005, max_batch = 64, cache_dir = None, result_ttl = 600.0, timeout = 600.0 ):
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.result_ttl = result_ttl
+        self.timeout = timeout
+        self.queue = Queue.Queue()
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.num_jobs = 0
+        self.num_batches = 0
+        self.pool = None
+        worker_args = ( params, cache_dir )
+        if jobs > 1: self.pool = Pool( jobs, initializer = init_server_worker, initargs = worker_args )
+        else: init_server_worker( *worker_args )
+        dispatcher = threading.Thread( target = self.dispatch )
+        dispatcher.daemon = True
+        dispatcher.start()
+
+    def submit( self, kind, request ):
+        with self.lock:
+            self.expire_jobs()
+            self.num_jobs += 1
+            job = Job( '%d' % self.num_jobs, kind, request )
+            self.jobs[ job.job_id ] = job
+        self.queue.put( job )
+        return job
+
+    def pop_job( self, job_id ):
+        '''
+        Job for job_id, forgotten by the server once it is done. None if no such job.
+        '''
+        with self.lock:
+            job = self.jobs.get( job_id )
+            if job and job.done.is_set(): del self.jobs[ job_id ]
+        return job
+
+    def expire_jobs( self ):
+        '''
+        Forget results that nobody fetched within result_ttl seconds (call with lock held).
+        '''
+        expire_time = time.time() - self.result_ttl
+        for job_id in [ job_id for ( job_id, job ) in self.jobs.items() if job.done.is_set() and job.finish_time < expire_time ]:
+            del self.jobs[ job_id ]
+
+    def get_status( self ):
+        with self.lock:
+            self.expire_jobs()
+            pending = sum( 1 for job in self.jobs.values() if not job.done.is_set() )
+        return OrderedDict( [ ( 'jobs', self.num_jobs ), ( 'batches', self.num_batches ), ( 'pending', pending ), ( 'queued', self.queue.qsize() ) ] )
+
+    def dispatch( self ):
+        while True:
+            batch = [ self.queue.get() ]
+            deadline = time.time() + self.batch_window
+            while len( batch ) < self.max_batch:
+                try:
+                    batch.append( self.queue.get( timeout = max( deadline - time.time(), 0.0 ) ) )
+                except Queue.Empty:
+                    break
+            self.run_batch( batch )
+
+    def run_batch( self, batch ):
+        self.num_batches += 1
+        ( tasks, task_jobs ) = group_jobs( batch )
+        def finish( outputs ):
+            for ( ( results, start_time, compute_time ), jobs ) in zip( outputs, task_jobs ):
+                if len( results ) == 1: results = results * len( jobs ) # identical fold requests share one result
+                for ( job, result ) in zip( jobs, results ): job.finish( OrderedDict( result ), start_time, compute_time )
+        if self.pool:
+            waiter = threading.Thread( target = self.wait_for_batch, args = ( self.pool.map_async( run_server_task, tasks, chunksize = 1 ), finish, batch ) )
+            waiter.daemon = True
+            waiter.start()
+        else: finish( map( run_server_task, tasks ) )
+
+    def wait_for_batch( self, async_result, finish, batch ):
+        '''
+        Hand the workers' outputs to finish(), or, if they do not all come back within timeout
+         (a task is lost if its worker dies), finish the jobs still waiting with an error.
+        '''
+        try:
+            return finish( async_result.get( self.timeout ) )
+        except TimeoutError:
+            error = OrderedDict( [ ( 'error', 'No result from the workers after %.0f s' % self.timeout ) ] )
+        except Exception as e:
+            error = get_error_result( e )
+        for job in batch:
+            if not job.done.is_set(): job.finish( OrderedDict( error ), None, 0.0 )
+
+def group_jobs( batch ):
+    '''
+    Tasks for the workers, and for each task, the jobs that get its results (see run_server_task()).
+    '''
+    tasks = []
+    task_jobs = []
+    task_idx = {}
+    for job in batch:
+        request = job.request
+        if job.kind == 'score':
+            key = ( 'score', json.dumps( [ request.get( 'sequences' ), request.get( 'circle', False ), request.get( 'allow_extra_base_pairs', False ), request.get( 'deriv_params' ) ] ) )
+        else:
+            key = ( job.kind, json.dumps( request, sort_keys = True ) )
+        if not key in task_idx:
+            task_idx[ key ] = len( tasks )
+            tasks.append( ( job.kind, [] ) )
+            task_jobs.append( [] )
+        n = task_idx[ key ]
+        if job.kind == 'score' or not task_jobs[ n ]: tasks[ n ][ 1 ].append( request ) # identical fold requests are only computed once
+        task_jobs[ n ].append( job )
+    return ( tasks, task_jobs )
+
+##################################################################################################
+_worker = {} # params and cache for this process
+
+def init_server_worker( params, cache_dir ):
+    _worker[ 'params' ] = params
+    _worker[ 'cache' ] = PartitionCache( cache_dir, max_entries = 1000 )
+
+def run_server_task( task ):
+    '''
+    ( results, start time, compute time ) for task = ( kind, requests ): one result for each request.
+    Score requests in a task all have the same sequences, and their structures are scored together;
+     fold tasks have a single request.
+    '''
+    ( kind, requests ) = task
+    start_time = time.time()
+    try:
+        if kind == 'fold': results = [ fold_request( request ) for request in requests ]
+        elif kind == 'score': results = score_requests( requests )
+        else: raise ValueError( 'Unknown request type %s' % kind )
+    except Exception as e:
+        results = [ get_error_result( e ) for request in requests ]
+    return ( [ OrderedDict( result ) for result in results ], start_time, time.time() - start_time )
+
+def get_error_result( e ):
+    return OrderedDict( [ ( 'error', ''.join( traceback.format_exception_only( type( e ), e ) ).strip() ) ] )
+
+def fold_request( request ):
+    sequences = request[ 'sequences' ]
+    circle = request.get( 'circle', False )
+    structure = request.get( 'structure' )
+    allow_extra_base_pairs = request.get( 'allow_extra_base_pairs', False )
+    deriv_params = request.get( 'deriv_params' )
+    deriv_method = request.get( 'deriv_method', 'analytic' )
+    n_stochastic = request.get( 'n_stochastic', 0 )
+    result = OrderedDict()
+    if n_stochastic > 0:
+        # samples are random, so don't cache them
+        p = partition( sequences, circle = circle, params = _worker[ 'params' ], mfe = request.get( 'mfe', False ), calc_bpp = request.get( 'bpp', False ),
+                       n_stochastic = n_stochastic, structure = structure, allow_extra_base_pairs = allow_extra_base_pairs,
+                       deriv_params = deriv_params, deriv_method = deriv_method, suppress_all_output = True, production = True )
+        ( result[ 'Z' ], result[ 'dG' ] ) = ( p.Z, p.dG )
+        if request.get( 'mfe' ): result[ 'mfe' ] = p.struct_MFE
+        if request.get( 'bpp' ): result[ 'bpp' ] = get_bpp_list( get_bpp_triplets( p.bpp, request.get( 'bpp_cutoff', 1.0e-5 ) ) )
+        result[ 'stochastic' ] = p.struct_stochastic
+        deriv_params, log_derivs = p.deriv_params, p.log_derivs
+    else:
+        r = cached_partition( sequences, circle = circle, params = _worker[ 'params' ], mfe = request.get( 'mfe', False ), calc_bpp = request.get( 'bpp', False ),
+                              structure = structure, allow_extra_base_pairs = allow_extra_base_pairs,
+                              deriv_params = deriv_params, deriv_method = deriv_method,
+                              cache = _worker[ 'cache' ], bpp_cutoff = request.get( 'bpp_cutoff', 1.0e-5 ) )
+        ( result[ 'Z' ], result[ 'dG' ] ) = ( r.Z, r.dG )
+        if request.get( 'mfe' ): result[ 'mfe' ] = r.struct_MFE
+        if request.get( 'bpp' ): result[ 'bpp' ] = get_bpp_list( ( r.bpp_i, r.bpp_j, r.bpp_p ) )
+        deriv_params, log_derivs = r.deriv_params, r.log_derivs
+    if deriv_params: result[ 'log_derivs' ] = OrderedDict( ( parameter, float( log_deriv ) ) for ( parameter, log_deriv ) in zip( deriv_params, log_derivs ) )
+    return result
+
+def get_bpp_list( bpp_triplets ):
+    return [ [ int( i ), int( j ), float( bpp_ij ) ] for ( i, j, bpp_ij ) in zip( *bpp_triplets ) ]
+
+def score_requests( requests ):
+    '''
+    Results for score requests on the same sequences, with all their structures scored in one go.
+    If that fails (e.g., one request has a bad structure), each request is scored on its own, so
+     that the error only goes back to the request that caused it.
+    '''
+    try:
+        return score_requests_together( requests )
+    except Exception:
+        if len( requests ) == 1: raise
+    results = []
+    for request in requests:
+        try: results += score_requests_together( [ request ] )
+        except Exception as e: results.append( get_error_result( e ) )
+    return results
+
+def score_requests_together( requests ):
+    request = requests[ 0 ]
+    structures_for_request = [ request.get( 'structures', [ request.get( 'structure' ) ] ) for request in requests ]
+    all_structures = [ structure for structures in structures_for_request for structure in structures ]
+    deriv_params = request.get( 'deriv_params' )
+    scores = score_structures( request[ 'sequences' ], all_structures, circle = request.get( 'circle', False ), params = _worker[ 'params' ],
+                               allow_extra_base_pairs = request.get( 'allow_extra_base_pairs', False ), deriv_params = deriv_params )
+    ( dG, log_derivs ) = scores if deriv_params != None else ( scores, None )
+    results = []
+    n = 0
+    for structures in structures_for_request:
+        result = OrderedDict( [ ( 'dG', [ float( val ) for val in dG[ n : n + len( structures ) ] ] ) ] )
+        if log_derivs is not None: result[ 'log_derivs' ] = [ [ float( val ) for val in row ] for row in log_derivs[ n : n + len( structures ) ] ]
+        results.append( result )
+        n += len( structures )
+    return results
+
+##################################################################################################
+class FoldingRequestHandler( BaseHTTPServer.BaseHTTPRequestHandler ):
+    '''
+    HTTP front end for self.server.folding_server (see above).
+    '''
+    def do_POST( self ):
+        kind = self.path.strip( '/' )
+        if not kind in ( 'fold', 'score' ): return self.send_json( 404, { 'error': 'Unknown path %s' % self.path } )
+        try:
+            request = get_str( json.loads( self.rfile.read( int( self.headers.getheader( 'content-length', 0 ) ) ) ) )
+            assert( isinstance( request, dict ) and 'sequences' in request )
+        except ( ValueError, AssertionError ):
+            return self.send_json( 400, { 'error': 'Need a JSON object with sequences' } )
+        run_async = request.pop( 'async', False )
+        job = self.server.folding_server.submit( kind, request )
+        if run_async: return self.send_json( 202, OrderedDict( [ ( 'id', job.job_id ), ( 'status', 'pending' ) ] ) )
+        if not job.done.wait( self.server.folding_server.timeout ):
+            return self.send_json( 504, OrderedDict( [ ( 'id', job.job_id ), ( 'status', 'pending' ), ( 'error', 'Timed out; GET /result/%s for the result' % job.job_id ) ] ) )
+        self.server.folding_server.pop_job( job.job_id )
+        self.send_json( 200, job.result )
+
+    def do_GET( self ):
+        if self.path.strip( '/' ) == 'status': return self.send_json( 200, self.server.folding_server.get_status() )
+        if not self.path.startswith( '/result/' ): return self.send_json( 404, { 'error': 'Unknown path %s' % self.path } )
+        job_id = self.path[ len( '/result/' ): ].strip( '/' )
+        job = self.server.folding_server.pop_job( job_id )
+        if job == None: return self.send_json( 404, { 'error': 'No job %s' % job_id } )
+        if not job.done.is_set(): return self.send_json( 202, OrderedDict( [ ( 'id', job_id ), ( 'status', 'pending' ) ] ) )
+        self.send_json( 200, job.result )
+
+    def send_json( self, code, output ):
+        body = json.dumps( output )
+        self.send_response( code )
+        self.send_header( 'Content-Type', 'application/json' )
+        self.send_header( 'Content-Length', str( len( body ) ) )
+        self.end_headers()
+        self.wfile.write( body )
+
+    def address_string( self ):
+        if not isinstance( self.client_address, tuple ): return 'unix' # Unix socket
+        return BaseHTTPServer.BaseHTTPRequestHandler.address_string( self )
+
+    def log_message( self, format, *args ):
+        if not self.server.quiet: BaseHTTPServer.BaseHTTPRequestHandler.log_message( self, format, *args )
+
+def get_str( val ):
+    '''
+    JSON strings come in as unicode, but sequences and structures need to be str.
+    '''
+    if isinstance( val, unicode ): return str( val )
+    if isinstance( val, list ): return [ get_str( x ) for x in val ]
+    if isinstance( val, dict ): return dict( ( get_str( key ), get_str( x ) ) for ( key, x ) in val.items() )
+    return val
+
+class ThreadedHTTPServer( SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer ):
+    daemon_threads = True
+
+class ThreadedUnixHTTPServer( SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer ):
+    daemon_threads = True
+
+def make_http_server( folding_server, port = 8000, host = '127.0.0.1', socket_file = None, quiet = False ):
+    '''
+    HTTP server on host:port, or on socket_file if given, that hands requests to folding_server.
+    '''
+    if socket_file:
+        if os.path.exists( socket_file ): os.remove( socket_file )
+        http_server = ThreadedUnixHTTPServer( socket_file, FoldingRequestHandler )
+    else:
+        http_server = ThreadedHTTPServer( ( host, port ), FoldingRequestHandler )
+    http_server.folding_server = folding_server
+    http_server.quiet = quiet
+    return http_server
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser( description = "Serve partition function, base pair probability, MFE, sampling and scoring requests as JSON over HTTP" )
+    parser.add_argument("-params","--parameters",type=str, default='', help='Parameter file to use [default: '', which triggers latest version]')
+    parser.add_argument("--no_coax", action='store_true', default=False, help='Turn off coaxial stacking')
+    parser.add_argument("--port", type=int, default=8000, help='Port to listen on')
+    parser.add_argument("--host", type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument("--socket", type=str, default=None, help='Listen on this Unix socket instead of a port')
+    parser.add_argument("-j","--jobs", type=int, default=1, help='Number of worker processes')
+    parser.add_argument("--batch_window", type=float, default=0.005, help='Seconds to wait for more requests to batch together')
+    parser.add_argument("--max_batch", type=int, default=64, help='Maximum number of requests per batch')
+    parser.add_argument("--cache_dir", type=str, default=None, help='Directory to cache fold results in, shared with other runs')
+    parser.add_argument("--result_ttl", type=float, default=600.0, help='Seconds to keep async results that have not been fetched')
+    parser.add_argument("--timeout", type=float, default=600.0, help='Seconds to wait for a result before giving up on it (e.g., if a worker died)')
+    parser.add_argument("-q","--quiet", action='store_true', default=False, help='Do not log each request')
+    args = parser.parse_args()
+
+    params = get_params( args.parameters )
+    if args.no_coax: params.set_parameter( 'K_coax', 0.0 )
+    folding_server = FoldingServer( params, jobs = args.jobs, batch_window = args.batch_window, max_batch = args.max_batch, cache_dir = args.cache_dir, result_ttl = args.result_ttl, timeout = args.timeout )
+    http_server = make_http_server( folding_server, args.port, args.host, args.socket, args.quiet )
+    print( 'Serving on', args.socket if args.socket else '%s:%d' % ( args.host, args.port ) )
+    http_server.serve_forever()
@@ -0,0 +1,183 @@
+from __future__ import print_function
+from math import log
+import numpy as np
+from .partition import partition
+from .parameters import compile_params
+from .adjoint import ParameterMonomial, get_parameter_slots, get_slots_for_parameter, get_diagonal_values, tag_parameter_slots, restore_parameter_slots, _combined_powers
+from .util.constants import KT_IN_KCAL
+from .util.assert_equal import assert_equal
+
+##################################################################################################
+# Fixed secondary structures compiled into feature counts.
+#
+# The Boltzmann weight of one secondary structure is a sum of a few terms (e.g., alternative
+#  coaxial stacks in a junction), each of which is a constant times a product of parameters:
+#
+#      Z_structure = sum_k  w_k * prod_n parameter_n ^ counts_k[ n ]
+#
+#  Once the weights and counts are known, dG of the structure and its derivatives with respect to
+#  log parameters need no dynamic programming at all. For a structure with a single term,
+#  log Z_structure is just the dot product of counts with the log parameters.
+#
+#  The terms are read off from one partition() run with the structure forced, by expanding its
+#  contribs with the parameters tagged as in adjoint.py.
+##################################################################################################
+def get_structure_features( sequences, structure, params, parameters, circle = False, allow_extra_base_pairs = False, max_terms = 100000 ):
+    '''
+    StructureFeatures for structure, with counts of the parameters in parameters -- or None if the
+     weight of the structure can't be compiled that way (extra base pairs allowed, or more than
+     max_terms terms).
+    '''
+    if allow_extra_base_pairs: return None
+    features = StructureFeatures( sequences, structure, params, parameters, circle, max_terms )
+    if features.log_weights is None: return None
+    return features
+
+class StructureFeatures:
+    '''
+    Weights w_k and parameter counts counts_k (see above), compiled at the current parameter values.
+    Parameters that are not in parameters are assumed not to change afterwards. Terms with parameters
+     that are zero drop out, so those parameters need to stay zero (see matches()).
+    '''
+    def __init__( self, sequences, structure, params, parameters, circle = False, max_terms = 100000 ):
+        self.parameters = list( parameters )
+        self.nonzero = np.array( [ params.get_parameter_value( parameter ) != 0.0 for parameter in parameters ] )
+        self.log_params_ref = self.get_log_params( params )
+        self.log_weights = None
+        self.counts = None
+
+        p = partition( sequences, circle = circle, structure = structure, params = params, suppress_all_output = True )
+        if p.Z == 0.0: return
+        weights = expand_Z( p, parameters, max_terms )
+        if weights == None: return
+        assert_equal( sum( weights.values() ), p.Z )
+
+        self.counts = np.array( weights.keys(), dtype = float ).reshape( len( weights ), len( parameters ) )
+        self.log_weights = np.log( weights.values() )
+
+    def get_log_params( self, params ):
+        return np.array( [ log( params.get_parameter_value( parameter ) ) if nonzero else 0.0 for (parameter,nonzero) in zip( self.parameters, self.nonzero ) ] )
+
+    def matches( self, params ):
+        '''
+        Can score() be used with params? Not if a parameter that was zero at compile time has changed.
+        '''
+        return all( nonzero or params.get_parameter_value( parameter ) == 0.0 for (parameter,nonzero) in zip( self.parameters, self.nonzero ) )
+
+    def score( self, params, calc_deriv = False, hessian_vector = None ):
+        '''
+        Same outputs as score_structure(), with deriv_params = parameters:
+          dG, or (dG, log_derivs) if calc_deriv, or (dG, log_derivs, log_derivs_hessian_vector) if hessian_vector is given
+        '''
+        log_terms = self.log_weights + self.counts.dot( self.get_log_params( params ) - self.log_params_ref )
+        log_term_max = max( log_terms )
+        probs = np.exp( log_terms - log_term_max )
+        Z = sum( probs )
+        probs /= Z
+        dG = float( -KT_IN_KCAL * ( log_term_max + log( Z ) ) )
+        if not calc_deriv and hessian_vector is None: return dG
+
+        log_derivs = probs.dot( self.counts )
+        if hessian_vector is None: return ( dG, list( log_derivs ) )
+
+        # covariance of counts over the terms, times hessian_vector (or each of a list of vectors)
+        vectors = np.atleast_2d( hessian_vector )
+        count_dirs = self.counts.dot( vectors.T )
+        hessian_vector_products = ( probs[ :, None ] * count_dirs ).T.dot( self.counts ) - np.outer( vectors.dot( log_derivs ), log_derivs )
+        if np.ndim( hessian_vector ) == 1: return ( dG, list( log_derivs ), list( hessian_vector_products[ 0 ] ) )
+        return ( dG, list( log_derivs ), [ list( product ) for product in hessian_vector_products ] )
+
+##################################################################################################
+def expand_Z( self, parameters, max_terms ):
+    '''
+    Z of Partition self as a dict { counts: value }, where counts are the powers of each of parameters,
+     and value is the sum of the terms with those counts. None if there are more than max_terms
+     distinct terms in any cell.
+    '''
+    slots = get_parameter_slots( self.params )
+    slot_parameters = {}
+    for n,parameter in enumerate( parameters ):
+        for m in get_slots_for_parameter( self.params, slots, parameter ): slot_parameters.setdefault( m, [] ).append( n )
+    def get_counts( val ):
+        counts = [ 0 ]*len( parameters )
+        if isinstance( val, ParameterMonomial ):
+            for m,power in val.powers.items():
+                for n in slot_parameters.get( m, [] ): counts[ n ] += power
+        return tuple( counts )
+
+    save_vals = tag_parameter_slots( slots )
+    try:
+        self.compiled = compile_params( self.params )
+        leaves = {}
+        for X,diag_val in get_diagonal_values( self ): leaves[ X ] = diag_val
+
+        # cells in contribs may have indices outside 0...N-1 (e.g., i-1 for i = 0), so take them mod N.
+        def get_cells( cells ): return [ (X,i % self.N,j % self.N) for (X,i,j) in cells ]
+
+        def get_contribs( cell ):
+            (X,i,j) = cell
+            X.contribs_updated[ i ][ j ] = False
+            return [ (val,get_cells( cells )) for (val,cells) in X.get_contribs( self, i, j ) ]
+
+        def expand_leaf( cell ):
+            (X,i,j) = cell
+            val = X.val( i, i )
+            if val != 0.0 and X in leaves: val = leaves[ X ]
+            return { get_counts( val ): float( val ) }
+
+        def expand_contribs( contribs, total = None ):
+            terms = {}
+            if total != None:
+                # anything not recorded in contribs (e.g., Z_cut = 1 across a strand break) does not depend on parameters.
+                remainder = total - sum( float( val ) for (val,cells) in contribs )
+                if abs( remainder ) > 1.0e-12 * abs( total ): terms[ get_counts( 1.0 ) ] = remainder
+            for (val,cells) in contribs:
+                if val == 0.0: continue
+                cells = get_cells( cells )
+                coeff = float( val )
+                for (X,i,j) in cells: coeff /= X.val( i, j )
+                product = { get_counts( val ): coeff }
+                for cell in cells: product = multiply_terms( product, expansions[ cell ] )
+                for counts,term_val in product.items(): terms[ counts ] = terms.get( counts, 0.0 ) + term_val
+            return terms
+
+        # go through cells depth-first with an explicit stack, since recursions can nest N deep.
+        expansions = {}
+        self.Z_final.contribs_updated[ 0 ] = False
+        stack = [ cell for (val,cells) in self.Z_final.get_contribs( self, 0 ) if val != 0.0 for cell in get_cells( cells ) ]
+        cell_contribs = {}
+        terms = None
+        while stack:
+            cell = stack[ -1 ]
+            if cell in expansions:
+                stack.pop()
+                continue
+            (X,i,j) = cell
+            if i == j:
+                expansions[ cell ] = expand_leaf( cell )
+                stack.pop()
+                continue
+            if not cell in cell_contribs: cell_contribs[ cell ] = get_contribs( cell )
+            missing = [ cell2 for (val,cells) in cell_contribs[ cell ] if val != 0.0 for cell2 in cells if not cell2 in expansions ]
+            if missing:
+                stack += missing
+                continue
+            expansions[ cell ] = expand_contribs( cell_contribs.pop( cell ), X.val( i, j ) )
+            stack.pop()
+            if len( expansions[ cell ] ) > max_terms: break
+        else:
+            terms = expand_contribs( self.Z_final.get_contribs( self, 0 ) )
+            if len( terms ) > max_terms: terms = None
+    finally:
+        restore_parameter_slots( slots, save_vals )
+        self.compiled = self.params.get_compiled()
+        _combined_powers.clear()
+    return terms
+
+def multiply_terms( terms1, terms2 ):
+    product = {}
+    for counts1,val1 in terms1.items():
+        for counts2,val2 in terms2.items():
+            counts = tuple( c1 + c2 for (c1,c2) in zip( counts1, counts2 ) )
+            product[ counts ] = product.get( counts, 0.0 ) + val1 * val2
+    return product
@@ -3,29 +3,60 @@ from __future__ import print_function
 import numpy as np
 import sys
 import os
+import time
+import cPickle as pickle
+from itertools import imap
 from .parameters import get_params
 from .partition import partition
 from .score_structure import score_structure
+from .structure_features import get_structure_features
 from .util.constants import KT_IN_KCAL
-from scipy.optimize import check_grad
+from .deriv_check import get_numerical_derivs, show_deriv_check
+from multiprocessing import Pool
 
 def calc_dG_gap( training_example ):
-    ( sequence, structure, force_base_pairs, params, train_parameters, allow_extra_base_pairs ) = ( training_example.sequence, training_example.structure, training_example.force_base_pairs, training_example.params, training_example.train_parameters, training_example.allow_extra_base_pairs )
-    dG_structure = score_structure( sequence, structure, params = params, allow_extra_base_pairs = allow_extra_base_pairs  )
-    p = partition( sequence, params = params, suppress_all_output = True, mfe = True, structure = force_base_pairs, allow_extra_base_pairs = allow_extra_base_pairs )
+    ( sequence, structure, force_pair_table, params, train_parameters, allow_extra_base_pairs ) = ( training_example.sequence, training_example.pair_table, training_example.force_pair_table, training_example.params, training_example.train_parameters, training_example.allow_extra_base_pairs )
+    dG_structure = score_reference_structure( training_example )
+    p = partition( sequence, params = params, suppress_all_output = True, mfe = True, structure = force_pair_table, allow_extra_base_pairs = allow_extra_base_pairs, production = True )
     dG = p.dG
     dG_gap = dG_structure - dG # will be a positive number, best case zero.
     print(p.struct_MFE, training_example.name, dG_gap)
     return dG_gap
 
 def calc_dG_gap_deriv( training_example ):
-    ( sequence, structure, force_base_pairs, params, train_parameters, allow_extra_base_pairs ) = ( training_example.sequence, training_example.structure, training_example.force_base_pairs, training_example.params, training_example.train_parameters, training_example.allow_extra_base_pairs )
-    (dG_structure, log_derivs_structure ) = score_structure( sequence, structure, params = params, deriv_params = train_parameters, allow_extra_base_pairs = allow_extra_base_pairs )
-    p = partition( sequence, params = params, suppress_all_output = True, mfe = True, structure = force_base_pairs, allow_extra_base_pairs = allow_extra_base_pairs, deriv_params = train_parameters )
+    return calc_dG_gap_and_deriv( training_example, tag = ' in deriv' )[ 1 ]
+
+def calc_dG_gap_and_deriv( training_example, tag = '' ):
+    ( sequence, structure, force_pair_table, params, train_parameters, allow_extra_base_pairs ) = ( training_example.sequence, training_example.pair_table, training_example.force_pair_table, training_example.params, training_example.train_parameters, training_example.allow_extra_base_pairs )
+    (dG_structure, log_derivs_structure ) = score_reference_structure( training_example, calc_deriv = True )
+    p = partition( sequence, params = params, suppress_all_output = True, mfe = True, structure = force_pair_table, allow_extra_base_pairs = allow_extra_base_pairs, deriv_params = train_parameters, production = True )
     log_derivs = p.log_derivs
     dG_gap = dG_structure - p.dG
-    print(p.struct_MFE, training_example.name, dG_gap, ' in deriv' )
-    return KT_IN_KCAL * ( np.array( log_derivs ) - np.array( log_derivs_structure ) )
+    print(p.struct_MFE, training_example.name, dG_gap, tag )
+    return ( dG_gap, KT_IN_KCAL * ( np.array( log_derivs ) - np.array( log_derivs_structure ) ) )
+
+def calc_dG_gap_hessp( training_example ):
+    ( sequence, structure, force_pair_table, params, train_parameters, allow_extra_base_pairs, hessian_vector ) = ( training_example.sequence, training_example.pair_table, training_example.force_pair_table, training_example.params, training_example.train_parameters, training_example.allow_extra_base_pairs, training_example.hessian_vector )
+    (dG_structure, log_derivs_structure, hessp_structure ) = score_reference_structure( training_example, calc_deriv = True, hessian_vector = hessian_vector )
+    p = partition( sequence, params = params, suppress_all_output = True, structure = force_pair_table, allow_extra_base_pairs = allow_extra_base_pairs, deriv_params = train_parameters, hessian_vector = hessian_vector, production = True )
+    print(training_example.name, dG_structure - p.dG, ' in hessp' )
+    return KT_IN_KCAL * ( np.array( p.log_derivs_hessian_vector ) - np.array( hessp_structure ) )
+
+def score_reference_structure( training_example, calc_deriv = False, hessian_vector = None ):
+    '''
+    score_structure() for the target structure of training_example, with derivatives for train_parameters
+     if calc_deriv. Uses feature counts compiled the first time the example is scored (see structure_features.py),
+     so that no dynamic programming is needed after that.
+    '''
+    ( sequence, structure, params, train_parameters, allow_extra_base_pairs ) = ( training_example.sequence, training_example.pair_table, training_example.params, training_example.train_parameters, training_example.allow_extra_base_pairs )
+    features = getattr( training_example, 'structure_features', None )
+    if not hasattr( training_example, 'structure_features' ) or \
+       ( features and ( features.parameters != list( train_parameters ) or not features.matches( params ) ) ):
+        features = get_structure_features( sequence, structure, params, train_parameters, allow_extra_base_pairs = allow_extra_base_pairs )
+        training_example.structure_features = features # None if structure can't be compiled -- don't try again.
+    if features: return features.score( params, calc_deriv, hessian_vector )
+    deriv_params = train_parameters if calc_deriv else None
+    return score_structure( sequence, structure, params = params, deriv_params = deriv_params, allow_extra_base_pairs = allow_extra_base_pairs, hessian_vector = hessian_vector )
 
 def pack_variables( x, params, train_parameters, training_examples = None, allow_extra_base_pairs = False):
     for n,param_tag in enumerate(train_parameters):
@@ -37,40 +68,397 @@ def pack_variables( x, params, train_parameters, training_examples = None, allow
         training_example.train_parameters = train_parameters
         training_example.allow_extra_base_pairs = allow_extra_base_pairs
 
-def free_energy_gap( x, params, train_parameters, training_examples, allow_extra_base_pairs, priors, pool, outfile ):
-    pack_variables( x, params, train_parameters, training_examples, allow_extra_base_pairs )
+def free_energy_gap( x, params, train_parameters, priors, pool, outfile ):
+    pack_variables( x, params, train_parameters )
     params.output_to_file( 'current.params' )
     print('\n',np.exp(x))
-    all_dG_gap = pool.map( calc_dG_gap, training_examples )
+    all_dG_gap = pool.map( calc_dG_gap, x )
     sum_dG_gap = sum( all_dG_gap )
     output_info( outfile, x, sum_dG_gap )
     loss = sum_dG_gap
     if priors: loss += priors(x)[0]
     return loss
 
-def free_energy_gap_deriv( x, params, train_parameters, training_examples, allow_extra_base_pairs, priors, pool ):
-    pack_variables( x, params, train_parameters, training_examples, allow_extra_base_pairs )
-    all_dG_gap_deriv = pool.map( calc_dG_gap_deriv, training_examples )
+def free_energy_gaps( xs, params, train_parameters, priors, pool ):
+    '''
+    free_energy_gap() at each of xs, scoring all the training examples at all of them in one pass through the pool.
+    '''
+    all_dG_gaps = pool.map_many( calc_dG_gap, xs )
+    losses = [ sum( dG_gaps ) for dG_gaps in all_dG_gaps ]
+    if priors: losses = [ loss + priors(x)[0] for (loss,x) in zip( losses, xs ) ]
+    return losses
+
+def free_energy_gap_deriv( x, params, train_parameters, priors, pool ):
+    all_dG_gap_deriv = pool.map( calc_dG_gap_deriv, x )
     deriv = sum( all_dG_gap_deriv )
     if priors: deriv += priors(x)[1]
     return deriv
 
+def free_energy_gap_and_deriv( x, params, train_parameters, priors, pool, outfile ):
+    '''
+    free_energy_gap() and free_energy_gap_deriv() together, from one pass through the training examples.
+    '''
+    pack_variables( x, params, train_parameters )
+    params.output_to_file( 'current.params' )
+    print('\n',np.exp(x))
+    all_dG_gap_and_deriv = pool.map( calc_dG_gap_and_deriv, x )
+    sum_dG_gap = sum( dG_gap for (dG_gap,dG_gap_deriv) in all_dG_gap_and_deriv )
+    output_info( outfile, x, sum_dG_gap )
+    loss  = sum_dG_gap
+    deriv = sum( dG_gap_deriv for (dG_gap,dG_gap_deriv) in all_dG_gap_and_deriv )
+    if priors:
+        prior_vals = priors(x)
+        loss  += prior_vals[0]
+        deriv += prior_vals[1]
+    return (loss,deriv)
+
+def minibatch_free_energy_gap_and_deriv( x, params, train_parameters, priors, pool, examples ):
+    '''
+    Estimate of free_energy_gap_and_deriv() from a minibatch of training examples (indices into pool),
+     scaled up to the size of the full training set.
+    '''
+    all_dG_gap_and_deriv = pool.map( calc_dG_gap_and_deriv, x, examples = examples )
+    scale = float( len( pool.training_indices ) ) / len( examples )
+    loss  = scale * sum( dG_gap for (dG_gap,dG_gap_deriv) in all_dG_gap_and_deriv )
+    deriv = scale * sum( dG_gap_deriv for (dG_gap,dG_gap_deriv) in all_dG_gap_and_deriv )
+    if priors:
+        prior_vals = priors(x)
+        loss  += prior_vals[0]
+        deriv += prior_vals[1]
+    return (loss,deriv)
+
+def validation_free_energy_gap( x, pool ):
+    '''
+    Sum of free energy gaps over the held-out validation examples in pool (no priors).
+    '''
+    return sum( pool.map( calc_dG_gap, x, examples = pool.validation_indices ) )
+
+def stochastic_minimize( minibatch_loss_and_grad, x0, num_examples, method = 'Adam', minibatch_size = 10,
+                         learning_rate = 0.1, lr_decay = 0.0, num_steps = 100, bounds = None,
+                         validation_loss = None, validate_every = 10, patience = None, seed = 0, outfile = None,
+                         state = None, checkpoint = None ):
+    '''
+    Minibatch stochastic gradient descent ('SGD') or Adam in log-parameter space. Each step only scores
+     minibatch_size training examples, taken in order from a reshuffled list each epoch, with
+     minibatch_loss_and_grad( x, example_indices ).
+
+    Learning rate at step t is learning_rate / ( 1 + lr_decay * t ). With bounds, x is clipped to stay
+     inside them after each step.
+
+    If validation_loss( x ) is given, it is evaluated every validate_every steps; the x with the lowest
+     validation loss is returned, and training stops early after patience evaluations without improvement.
+
+    All optimizer state lives in the dict state, which is handed to checkpoint( state ) after every step;
+     pass a saved state back in to pick up where a run left off.
+
+    Returns an OptimizeResult, like scipy's minimize().
+    '''
+    (beta1, beta2, epsilon) = (0.9, 0.999, 1.0e-8) # Adam defaults
+    minibatch_size = min( minibatch_size, num_examples )
+    if state == None:
+        x = np.array( x0, dtype = float )
+        state = { 'step': 0, 'x': x, 'm': np.zeros( len( x ) ), 's': np.zeros( len( x ) ),
+                  'random_state': np.random.RandomState( seed ), 'queue': [],
+                  'best_x': np.array( x ), 'best_validation_loss': None, 'num_no_improvement': 0 }
+    message = 'Reached maximum number of steps.'
+    while state[ 'step' ] < num_steps:
+        step = state[ 'step' ]
+        x = state[ 'x' ]
+        if len( state[ 'queue' ] ) < minibatch_size: state[ 'queue' ] += list( state[ 'random_state' ].permutation( num_examples ) )
+        examples = sorted( state[ 'queue' ][ :minibatch_size ] )
+        state[ 'queue' ] = state[ 'queue' ][ minibatch_size: ]
+
+        (loss, grad) = minibatch_loss_and_grad( x, examples )
+        output_info( outfile, x, loss )
+        step_size = learning_rate / ( 1.0 + lr_decay * step )
+        if method == 'Adam':
+            state[ 'm' ] = beta1 * state[ 'm' ] + ( 1 - beta1 ) * grad
+            state[ 's' ] = beta2 * state[ 's' ] + ( 1 - beta2 ) * grad**2
+            m_hat = state[ 'm' ] / ( 1 - beta1**( step+1 ) )
+            s_hat = state[ 's' ] / ( 1 - beta2**( step+1 ) )
+            x = x - step_size * m_hat / ( np.sqrt( s_hat ) + epsilon )
+        else:
+            assert( method == 'SGD' )
+            x = x - step_size * grad
+        if bounds: x = np.clip( x, [ bound[0] for bound in bounds ], [ bound[1] for bound in bounds ] )
+        print( 'Step %d  minibatch loss %f  learning rate %f' % ( step+1, loss, step_size ) )
+        state[ 'x' ] = x
+        state[ 'step' ] = step + 1
+
+        stop = False
+        if validation_loss and ( step+1 ) % validate_every == 0:
+            val = validation_loss( x )
+            print( 'Step %d  validation loss %f' % ( step+1, val ) )
+            if state[ 'best_validation_loss' ] == None or val < state[ 'best_validation_loss' ]:
+                (state[ 'best_x' ], state[ 'best_validation_loss' ], state[ 'num_no_improvement' ]) = (np.array( x ), val, 0)
+            else:
+                state[ 'num_no_improvement' ] += 1
+                stop = ( patience and state[ 'num_no_improvement' ] >= patience )
+        if checkpoint: checkpoint( state )
+        if stop:
+            message = 'No improvement in validation loss in %d evaluations.' % state[ 'num_no_improvement' ]
+            break
+
+    from scipy.optimize import OptimizeResult # scipy is slow to import, and only needed here
+    best_x = state[ 'best_x' ] if validation_loss else state[ 'x' ]
+    return OptimizeResult( x = best_x, fun = state[ 'best_validation_loss' ], nit = state[ 'step' ], success = True, message = message )
+
+def bfgs_minimize( fun, x0, jac = None, maxiter = None, gtol = 1.0e-5, state = None, checkpoint = None ):
+    '''
+    BFGS, taking the same steps as scipy's minimize( method = 'BFGS' ), but with all optimizer state
+     (x, loss, gradient, inverse Hessian, iteration count and budget) in the dict state, which is handed
+     to checkpoint( state ) after every iteration; pass a saved state back in to pick up where a run
+     left off, without rebuilding the inverse Hessian or re-paying iterations. (scipy's own BFGS can only
+     be restarted from x, with an identity inverse Hessian and a fresh maxiter.)
+
+    With jac = True, fun( x ) returns ( loss, gradient ); otherwise the gradient is estimated by
+     finite differences. Returns an OptimizeResult, like scipy's minimize().
+    '''
+    from scipy.optimize import OptimizeResult, approx_fprime # scipy is slow to import, and only needed here
+    ( _line_search_wolfe12, _LineSearchError, _status_message, _epsilon ) = get_scipy_bfgs_internals()
+    if jac is True:
+        fun_and_grad = MemoizeLastX( fun )
+        ( f, fprime ) = ( lambda x: fun_and_grad( x )[ 0 ], lambda x: fun_and_grad( x )[ 1 ] )
+    else:
+        ( f, fprime ) = ( fun, lambda x: approx_fprime( x, fun, _epsilon ) )
+    if state == None:
+        x = np.array( x0, dtype = float ).flatten()
+        grad = fprime( x )
+        loss = f( x )
+        # initial step guess of dx ~ 1, as in scipy
+        state = { 'iteration': 0, 'maxiter': maxiter if maxiter != None else 200 * len( x ), 'x': x, 'loss': loss, 'old_loss': loss + np.linalg.norm( grad ) / 2,
+                  'grad': grad, 'hess_inv': np.eye( len( x ) ) }
+    I = np.eye( len( state[ 'x' ] ) )
+    warnflag = 0
+    while np.max( np.abs( state[ 'grad' ] ) ) > gtol and state[ 'iteration' ] < state[ 'maxiter' ]:
+        ( x, grad, hess_inv ) = ( state[ 'x' ], state[ 'grad' ], state[ 'hess_inv' ] )
+        direction = -np.dot( hess_inv, grad )
+        try:
+            ( alpha, fc, gc, loss, old_loss, new_grad ) = _line_search_wolfe12( f, fprime, x, direction, grad, state[ 'loss' ], state[ 'old_loss' ], amin = 1e-100, amax = 1e100 )
+        except _LineSearchError:
+            warnflag = 2 # line search failed to find a better solution
+            break
+        new_x = x + alpha * direction
+        if new_grad is None: new_grad = fprime( new_x )
+        ( s, y ) = ( new_x - x, new_grad - grad )
+        state.update( { 'iteration': state[ 'iteration' ] + 1, 'x': new_x, 'loss': loss, 'old_loss': old_loss, 'grad': new_grad } )
+        if np.max( np.abs( new_grad ) ) > gtol and np.isfinite( loss ):
+            rho = 1.0 / np.dot( y, s ) if np.dot( y, s ) != 0.0 else 1000.0
+            if np.isinf( rho ): rho = 1000.0
+            A1 = I - s[ :, np.newaxis ] * y[ np.newaxis, : ] * rho
+            A2 = I - y[ :, np.newaxis ] * s[ np.newaxis, : ] * rho
+            state[ 'hess_inv' ] = np.dot( A1, np.dot( hess_inv, A2 ) ) + rho * s[ :, np.newaxis ] * s[ np.newaxis, : ]
+        if checkpoint: checkpoint( state )
+        if not np.isfinite( loss ):
+            warnflag = 2
+            break
+    if np.isnan( state[ 'loss' ] ): warnflag = 2
+    if warnflag == 0 and state[ 'iteration' ] >= state[ 'maxiter' ]: warnflag = 1
+    message = _status_message[ { 0: 'success', 1: 'maxiter', 2: 'pr_loss' }[ warnflag ] ]
+    return OptimizeResult( x = state[ 'x' ], fun = state[ 'loss' ], jac = state[ 'grad' ], hess_inv = state[ 'hess_inv' ], nit = state[ 'iteration' ],
+                           status = warnflag, success = ( warnflag == 0 ), message = message )
+
+def get_scipy_bfgs_internals():
+    '''
+    The line search, its exception, status messages, and finite-difference step that scipy's BFGS uses. These
+     are not public, and have moved between scipy versions, so look in each place they have been.
+    '''
+    import importlib
+    for module_name in ( 'scipy.optimize._optimize', 'scipy.optimize.optimize' ):
+        try:
+            module = importlib.import_module( module_name )
+            return ( module._line_search_wolfe12, module._LineSearchError, module._status_message, module._epsilon )
+        except ( ImportError, AttributeError ): pass
+    import scipy
+    raise ImportError( "bfgs_minimize() needs the line search inside scipy's BFGS, which scipy %s does not have where expected; "
+                       "scipy's minimize( method = 'BFGS' ) minimizes the same way, but cannot pick up from a saved state." % scipy.__version__ )
+
+class TrainingCheckpoint:
+    '''
+    Periodic binary (pickle) snapshots of a training run: method, train_parameters, iteration count, current x,
+     and any optimizer state (see stochastic_minimize() and bfgs_minimize()), so that a run that dies can be resumed.
+
+    scipy's other minimizers do not expose their internal state, so for those methods a resumed run restarts
+     the minimizer from the saved x.
+    '''
+    def __init__( self, checkpoint_file, method, train_parameters, checkpoint_every = 1 ):
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_every = checkpoint_every
+        self.state = { 'method': method, 'train_parameters': list( train_parameters ), 'iteration': 0, 'x': None, 'optimizer_state': None }
+
+    def resume( self ):
+        with open( self.checkpoint_file, 'rb' ) as fid: state = pickle.load( fid )
+        assert( state[ 'method' ] == self.state[ 'method' ] )
+        assert( state[ 'train_parameters' ] == self.state[ 'train_parameters' ] )
+        self.state = state
+        print( 'Resuming from %s at iteration %d' % ( self.checkpoint_file, state[ 'iteration' ] ) )
+        return state
+
+    def update( self, x, optimizer_state = None ):
+        self.state[ 'iteration' ] += 1
+        self.state[ 'x' ] = np.array( x )
+        self.state[ 'optimizer_state' ] = optimizer_state
+        if self.state[ 'iteration' ] % self.checkpoint_every == 0: self.save()
+
+    def save( self ):
+        # write to a temporary file first, so a crash mid-write leaves the last checkpoint intact.
+        tmp_file = self.checkpoint_file + '.tmp'
+        with open( tmp_file, 'wb' ) as fid: pickle.dump( self.state, fid, pickle.HIGHEST_PROTOCOL )
+        os.rename( tmp_file, self.checkpoint_file )
+
+class MemoizeLastX:
+    '''
+    Wrap a function of x so that a repeat call at the same x (e.g., final evaluation at the
+    optimizer's result) gives back the last value instead of folding the training set again.
+    '''
+    def __init__( self, func ):
+        self.func = func
+        self.x = None
+        self.val = None
+
+    def __call__( self, x ):
+        if self.x is None or not np.array_equal( self.x, x ):
+            self.val = self.func( x )
+            self.x = np.array( x ) # need to make an actual copy
+        return self.val
+
+def free_energy_gap_hessian( x, params, train_parameters, priors, pool ):
+    '''
+    Hessian of free_energy_gap() at x, for Newton-CG and trust-region minimizers. The directions along
+     all the train_parameters go through the same fold of each training example (see hessian.py), so this
+     takes one pass, and the minimizer's Hessian-vector products at this x need no more folding.
+    '''
+    all_dG_gap_hessian = pool.map( calc_dG_gap_hessp, x, np.eye( len( x ) ) )
+    hessian = sum( all_dG_gap_hessian )
+    if priors: hessian += np.diag( priors(x)[2] )
+    return hessian
+
+class TrainingPool:
+    '''
+    Workers that hold on to their own copy of params and the training examples for the whole run.
+    Each evaluation only sends out the log-parameter vector x (and Hessian-vector directions v,
+    if needed); workers update their params from x before scoring their examples.
+    With jobs = 1, the examples are just scored in this process.
+
+    Examples go out one at a time, most expensive first (see CostModel), so that long RNAs
+    do not hold up the end of each pass.
+
+    Any validation_examples are held by the workers too, at validation_indices, but are only
+    scored when asked for explicitly.
+    '''
+    def __init__( self, jobs, params, train_parameters, training_examples, allow_extra_base_pairs, validation_examples = [] ):
+        all_examples = training_examples + validation_examples
+        self.training_indices   = range( len( training_examples ) )
+        self.validation_indices = range( len( training_examples ), len( all_examples ) )
+        self.cost_model = CostModel( [ get_sequence_length( training_example.sequence ) for training_example in all_examples ] )
+        worker_args = ( params, train_parameters, all_examples, allow_extra_base_pairs )
+        self.pool = None
+        if jobs > 1: self.pool = Pool( jobs, initializer = init_training_worker, initargs = worker_args )
+        else: init_training_worker( *worker_args )
+
+    def map( self, func, x, v = None, examples = None ):
+        '''
+        func( training_example ) for all training examples (or those at indices in examples),
+         with parameters set by log-parameter vector x.
+        '''
+        if examples == None: examples = self.training_indices
+        x = np.array( x )
+        tasks = [ (func, x, v, n) for n in self.cost_model.schedule( examples ) ]
+        if self.pool: results = self.pool.imap_unordered( run_training_task, tasks )
+        else:         results = imap( run_training_task, tasks )
+        outputs = {}
+        for (n, output, elapsed_time) in results:
+            outputs[ n ] = output
+            self.cost_model.record( n, elapsed_time )
+        return [ outputs[ n ] for n in examples ]
+
+    def map_many( self, func, xs, examples = None ):
+        '''
+        map() at each of log-parameter vectors xs, with the tasks for all of them sent out together, so that
+         workers stay busy across xs. Returns one list of outputs per x.
+        '''
+        if examples == None: examples = self.training_indices
+        xs = [ np.array( x ) for x in xs ]
+        tasks = [ (func, x, None, n) for n in self.cost_model.schedule( examples ) for x in xs ]
+        if self.pool: results = self.pool.imap( run_training_task, tasks )
+        else:         results = imap( run_training_task, tasks )
+        outputs = [ {} for x in xs ]
+        for k,(n, output, elapsed_time) in enumerate( results ):
+            outputs[ k % len( xs ) ][ n ] = output
+            self.cost_model.record( n, elapsed_time )
+        return [ [ x_outputs[ n ] for n in examples ] for x_outputs in outputs ]
+
+class CostModel:
+    '''
+    Estimated time to score each training example. Dynamic programming goes as N^3, so an example that
+    has not been timed yet is assumed to cost N^3 times a factor calibrated on the examples that have.
+    '''
+    def __init__( self, lengths ):
+        self.lengths = lengths
+        self.times = [None]*len( lengths )
+
+    def record( self, n, elapsed_time ): self.times[ n ] = elapsed_time
+
+    def estimate( self ):
+        timed = [ (elapsed_time, L) for (elapsed_time, L) in zip( self.times, self.lengths ) if elapsed_time != None ]
+        scale = 1.0
+        if timed: scale = sum( elapsed_time for (elapsed_time, L) in timed ) / sum( float( L )**3 for (elapsed_time, L) in timed )
+        return [ elapsed_time if elapsed_time != None else scale * float( L )**3 for (elapsed_time, L) in zip( self.times, self.lengths ) ]
+
+    def schedule( self, examples ):
+        '''
+        Example indices, longest expected time first.
+        '''
+        costs = self.estimate()
+        return sorted( examples, key = lambda n: -costs[ n ] )
+
+def get_sequence_length( sequence ):
+    if isinstance( sequence, list ): return sum( len( strand ) for strand in sequence )
+    return len( sequence )
+
+_worker = {} # params, train_parameters, training_examples, and last x for this process
+
+def init_training_worker( params, train_parameters, training_examples, allow_extra_base_pairs ):
+    _worker[ 'params' ] = params
+    _worker[ 'train_parameters' ] = train_parameters
+    _worker[ 'training_examples' ] = training_examples
+    _worker[ 'x' ] = None
+    for training_example in training_examples:
+        training_example.params = params
+        training_example.train_parameters = train_parameters
+        training_example.allow_extra_base_pairs = allow_extra_base_pairs
+
+def run_training_task( task ):
+    ( func, x, v, n ) = task
+    if _worker[ 'x' ] is None or not np.array_equal( _worker[ 'x' ], x ):
+        pack_variables( x, _worker[ 'params' ], _worker[ 'train_parameters' ] )
+        _worker[ 'x' ] = x
+    training_example = _worker[ 'training_examples' ][ n ]
+    training_example.hessian_vector = v
+    start_time = time.time()
+    output = func( training_example )
+    return ( n, output, time.time() - start_time )
+
 def eval_priors( x_list, bounds_list ):
     '''
     A prior for the log parameters that is zero within two bounds, but then rises
     quadratically outside those bounds, with log-parameter scale delta.
+    Returns value, derivative, and (diagonal) second derivative.
     '''
     val = 0
     delta = 0.1 # can lead to overflow -- might be better (and softer) to set at 1.0
     deriv = np.zeros( len( x_list ) )
+    hess_diag = np.zeros( len( x_list ) )
     for i,(x,bounds) in enumerate(zip( x_list, bounds_list )):
         if x < bounds[0]:
             val += ( abs(x - bounds[0]) / delta )**2
             deriv[ i ] +=  2 * ( x - bounds[0] )/delta**2
+            hess_diag[ i ] += 2 / delta**2
         if x > bounds[1]:
             val += ( abs(x - bounds[1]) / delta )**2
             deriv[ i ] +=  2 * ( x - bounds[1] )/delta**2
-    return (val,deriv)
+            hess_diag[ i ] += 2 / delta**2
+    return (val,deriv,hess_diag)
 
 def get_priors( train_parameters ):
     bounds = get_bounds( train_parameters )
@@ -90,23 +478,26 @@ def create_outfile( outfile, params, training_params ):
     for param_tag in training_params: fid.write( '%25s' % param_tag )
     fid.write( '\n' )
 
-def train_deriv_check( x0, loss, grad, train_parameters ):
+def train_deriv_check( x0, loss, grad, train_parameters, losses = None, central = False ):
+    '''
+    Compare grad to finite differences of loss at x0 (see deriv_check.py), then exit.
+    losses( xs ) gives loss at several x in one go (e.g., free_energy_gaps(), which runs them all in parallel);
+     otherwise loss is called for each x in turn.
+    '''
     # Not enough output from scipy.check_grad, so I wrote my own deriv_check
     #print( 'Deriv error: ', check_grad( loss, grad, x0 ) )
     loss_val = loss( x0 )
     analytic_grad_val = grad( x0 )
-    numerical_grad_val = []
-    epsilon = 1.0e-8
-    for n in range( len(x0) ):
-        x = np.array( x0 ) # need to make an actual copy
-        x[ n ] += epsilon
-        numerical_grad_val.append( ( loss( x ) - loss_val ) / epsilon )
-    print()
-    print( '%20s %25s' % ('','-dG/d(log parameter)' ) )
-    print( '%20s %25s %25s %25s' % ('parameter','analytic','numerical','diff' ) )
-    for i,parameter in enumerate(train_parameters):
-           print( '%20s %25.12f %25.12f %25.12f' % (parameter, analytic_grad_val[i], numerical_grad_val[i], analytic_grad_val[i] - numerical_grad_val[i]  ) )
-    print()
+    if losses == None: losses = lambda xs: [ loss( x ) for x in xs ]
+    def evaluate( shifts ):
+        xs = []
+        for ( n, shift ) in shifts:
+            x = np.array( x0, dtype = float ) # need to make an actual copy
+            x[ n ] += shift
+            xs.append( x )
+        return losses( xs )
+    numerical_grad_val = get_numerical_derivs( evaluate, len( x0 ), loss_val, central )
+    show_deriv_check( train_parameters, analytic_grad_val, numerical_grad_val, '-dG/d(log parameter)' )
 
     exit()
 
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+from __future__ import print_function
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+##################################################################################################
+# Import time report, like python3 -X importtime (which python2 does not have).
+#
+# The target module is imported in a fresh interpreter with __import__ wrapped, so every module
+#  loaded along the way gets timed: self is time spent in its own code, cumulative includes the
+#  modules it imports in turn. Output follows -X importtime, in the order imports finish:
+#
+#      import time: self [us] | cumulative | imported package
+#      import time:       812 |        812 |     zetafold.util.constants
+#      ...
+#
+# Short jobs (one sequence from the workflow manager) pay this on every launch, so importing
+#  zetafold.partition has a budget, and should never pull in heavy modules that folding does
+#  not use (scipy, matplotlib, the tests, multiprocessing, the server).
+##################################################################################################
+import_budget_ms = { 'zetafold.partition': 150 }
+unneeded_modules = [ 'scipy', 'matplotlib', 'tests_zetafold', 'multiprocessing', 'BaseHTTPServer', 'zetafold.training', 'zetafold.score_structure' ]
+
+_hook_script = r'''
+import sys, time, json, __builtin__
+sys.path.insert( 0, %(root)r )
+_import = __builtin__.__import__
+child_times = []
+records = []
+
+def get_candidates( name, globals, level ):
+    if level == 0 or not globals or not name: return [ name ]
+    package = globals.get( '__package__' ) or globals.get( '__name__', '' )
+    if not globals.get( '__package__' ) and not '__path__' in globals: package = package.rpartition( '.' )[ 0 ]
+    if level > 1: package = package.rsplit( '.', level - 1 )[ 0 ]
+    if not package: return [ name ]
+    return [ package + '.' + name, name ]
+
+def timed_import( name, globals = None, locals = None, fromlist = None, level = -1 ):
+    candidates = get_candidates( name, globals, level )
+    if any( sys.modules.get( candidate ) is not None for candidate in candidates ): return _import( name, globals, locals, fromlist, level )
+    depth = len( child_times )
+    child_times.append( 0.0 )
+    start = time.time()
+    try:
+        return _import( name, globals, locals, fromlist, level )
+    finally:
+        cumulative = time.time() - start
+        children = child_times.pop()
+        loaded = [ candidate for candidate in candidates if sys.modules.get( candidate ) is not None ]
+        if loaded:
+            records.append( ( loaded[ 0 ], cumulative - children, cumulative, depth ) )
+            if child_times: child_times[ -1 ] += cumulative
+
+__builtin__.__import__ = timed_import
+import %(module)s
+__builtin__.__import__ = _import
+sys.stdout.write( '\n' + json.dumps( records ) + '\n' )
+'''
+
+def get_import_times( module_name, python = sys.executable ):
+    '''
+    [ ( module, self seconds, cumulative seconds, depth ), ... ] in the order imports finished,
+     for importing module_name in a fresh interpreter.
+    '''
+    root = os.path.dirname( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+    script = _hook_script % { 'root': root, 'module': module_name }
+    output = subprocess.check_output( [ python, '-c', script ], cwd = root )
+    return [ tuple( record ) for record in json.loads( output.strip().split( '\n' )[ -1 ] ) ]
+
+def get_total_time( import_times ):
+    return sum( cumulative for ( module, self_time, cumulative, depth ) in import_times if depth == 0 )
+
+def show_import_times( import_times, top = None ):
+    if top:
+        import_times = sorted( import_times, key = lambda record: -record[ 1 ] )[ :top ]
+        for ( module, self_time, cumulative, depth ) in import_times:
+            print( 'import time: %9d | %10d | %s' % ( 1e6 * self_time, 1e6 * cumulative, module ) )
+        return
+    print( 'import time: self [us] | cumulative | imported package' )
+    for ( module, self_time, cumulative, depth ) in import_times:
+        print( 'import time: %9d | %10d | %s%s' % ( 1e6 * self_time, 1e6 * cumulative, '  ' * depth, module ) )
+
+def get_unneeded_modules( import_times ):
+    '''
+    Modules in import_times that folding should not need (see unneeded_modules above).
+    '''
+    return [ module for ( module, self_time, cumulative, depth ) in import_times
+             if any( module == unneeded or module.startswith( unneeded + '.' ) for unneeded in unneeded_modules ) ]
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser( description = "Report time spent importing a module, python -X importtime style, and check it against a budget" )
+    parser.add_argument( "modules", nargs = '*', default = [ 'zetafold.partition' ], help = 'Modules to import [default: zetafold.partition]' )
+    parser.add_argument( "--budget", type = float, default = None, help = 'Budget in ms for each module [default: from import_budget_ms, if there]' )
+    parser.add_argument( "--top", type = int, default = None, help = 'Only show this many modules, slowest (self time) first' )
+    parser.add_argument( "-n", "--repeat", type = int, default = 3, help = 'Take the fastest of this many imports' )
+    args = parser.parse_args()
+
+    over_budget = False
+    for module_name in args.modules:
+        import_times = min( [ get_import_times( module_name ) for n in range( args.repeat ) ], key = get_total_time )
+        show_import_times( import_times, args.top )
+        total_ms = 1e3 * get_total_time( import_times )
+        budget = args.budget if args.budget != None else import_budget_ms.get( module_name )
+        print( 'Importing %s took %.1f ms%s' % ( module_name, total_ms, ' (budget: %.0f ms)' % budget if budget != None else '' ) )
+        unneeded = get_unneeded_modules( import_times ) if module_name in import_budget_ms else []
+        if unneeded:
+            print( 'Importing %s also loads modules it should not need: %s' % ( module_name, ' '.join( unneeded ) ) )
+            over_budget = True
+        if budget != None and total_ms > budget:
+            print( 'Importing %s is over budget!' % module_name )
+            over_budget = True
+    if over_budget: exit( 1 )
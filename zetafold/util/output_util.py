@@ -2,12 +2,17 @@ from __future__ import print_function
 import math
 from .constants import KT_IN_KCAL
 from .assert_equal import assert_equal
+from .secstruct_util import secstruct_from_pair_table
 import sys
+import os
+import numpy as np
 
 def _show_results( self ):
     fid = sys.stdout
     write_result( 'sequence',self.sequence, self.ligated, fid )
-    write_result( 'input structure',self.structure, self.ligated, fid )
+    structure = self.structure
+    if structure == None and self.structure_pair_table is not None: structure = secstruct_from_pair_table( self.structure_pair_table )
+    write_result( 'input structure',structure, self.ligated, fid )
     write_result( 'calculate gap structure',self.calc_gap_structure, self.ligated, fid )
     write_result( '(pseudo)MFE',self.struct_MFE, self.ligated, fid )
     write_result( 'stochastic',self.struct_stochastic, self.ligated, fid )
@@ -22,7 +27,7 @@ def _show_results( self ):
         show_derivs( self.deriv_params, self.log_derivs )
     if self.bpp and not self.suppress_bpp_output:
         output_bpp_matrix( self )
-        output_bpp_plot( self )
+        if self.bpp_plot: output_bpp_plot( self )
 
 def write_result( tag, variable, ligated, fid ):
     if variable == None: return
@@ -42,22 +47,93 @@ def write_string_with_spaces( sequence, ligated, fid ):
         fid.write( ' [circularized]' )
 
 
+##################################################################################################
+# Base pair probability output formats:
+#
+#   matrix  N lines of N numbers (' %25.12f'), the original format  [default, unless the file ends in .npy or .npz]
+#   sparse  one line 'i j bpp' (0-indexed, i < j) per pair with bpp above bpp_cutoff, after a '# N' header line
+#   npy     N x N numpy array, see numpy.load()                      [default for .npy files]
+#   npz     sparse arrays i, j, p (as in get_bpp_triplets()) and N  [default for .npz files]
+#
+# Text formats are written one row at a time, so output never needs more than one row of text in memory.
+##################################################################################################
+bpp_formats = [ 'matrix', 'sparse', 'npy', 'npz' ]
+
+def get_bpp_format( bpp_file, bpp_format = None ):
+    if bpp_format != None:
+        assert( bpp_format in bpp_formats )
+        return bpp_format
+    extension = os.path.splitext( bpp_file )[ 1 ]
+    if extension in ( '.npy', '.npz' ): return extension[ 1: ]
+    return 'matrix'
+
 def output_bpp_matrix( self ):
-    bpp_file = 'bpp.txt'
+    bpp_file = self.bpp_file
+    bpp_format = get_bpp_format( bpp_file, self.bpp_format )
+    write_bpp( self.bpp, bpp_file, bpp_format, self.bpp_cutoff )
+    print( 'Outputted base pair probabilities (%s) to: ' % bpp_format, bpp_file )
+
+def write_bpp( bpp, bpp_file, bpp_format = None, bpp_cutoff = 0.0 ):
+    '''
+    Save N x N base pair probability matrix bpp to bpp_file in bpp_format (see above).
+    bpp_cutoff only applies to the sparse formats.
+    '''
+    bpp_format = get_bpp_format( bpp_file, bpp_format )
+    if bpp_format == 'npy':
+        np.save( bpp_file, np.array( bpp, dtype = float ) )
+        return
+    if bpp_format == 'npz':
+        ( i, j, p ) = get_bpp_triplets( bpp, bpp_cutoff )
+        np.savez_compressed( bpp_file, i = i, j = j, p = p, N = len( bpp ) )
+        return
     fid = open( bpp_file, 'w' )
-    for i in range( self.N ):
-        for j in range( self.N ):
-            fid.write(' %25.12f' % self.bpp[i][j] )
-        fid.write('\n')
+    if bpp_format == 'matrix':
+        for bpp_i in bpp: fid.write( ''.join( ' %25.12f' % bpp_ij for bpp_ij in bpp_i ) + '\n' )
+    else:
+        fid.write( '# %d\n' % len( bpp ) )
+        for i,bpp_i in enumerate( bpp ):
+            bpp_i = np.asarray( bpp_i[ i+1: ], dtype = float )
+            js = np.nonzero( bpp_i > bpp_cutoff )[ 0 ]
+            fid.write( ''.join( '%d %d %.12g\n' % (i,i+1+j,bpp_i[j]) for j in js ) )
     fid.close()
-    print( 'Outputted base pair probability matrix  to: ', bpp_file )
+
+def read_bpp( bpp_file, bpp_format = None ):
+    '''
+    N x N numpy array of base pair probabilities from a file written by write_bpp() (zero below any cutoff).
+    Text files with a '# N' header are taken to be sparse.
+    '''
+    if bpp_format == None and get_bpp_format( bpp_file ) == 'matrix' and open( bpp_file ).read( 1 ) == '#': bpp_format = 'sparse'
+    bpp_format = get_bpp_format( bpp_file, bpp_format )
+    if bpp_format == 'npy': return np.load( bpp_file )
+    if bpp_format == 'matrix': return np.loadtxt( bpp_file, ndmin = 2 )
+    if bpp_format == 'npz':
+        data = np.load( bpp_file )
+        ( N, i, j, p ) = ( int( data[ 'N' ] ), data[ 'i' ], data[ 'j' ], data[ 'p' ] )
+    else:
+        fid = open( bpp_file )
+        N = int( fid.readline().lstrip( '#' ) )
+        triplets = np.array( [ line.split() for line in fid if line.strip() ], dtype = float ).reshape( -1, 3 )
+        fid.close()
+        ( i, j, p ) = ( triplets[ :, 0 ].astype( int ), triplets[ :, 1 ].astype( int ), triplets[ :, 2 ] )
+    bpp = np.zeros( ( N, N ) )
+    bpp[ i, j ] = p
+    bpp[ j, i ] = p
+    return bpp
+
+def get_bpp_triplets( bpp, bpp_cutoff = 0.0 ):
+    '''
+    Arrays ( i, j, bpp[i][j] ) for i < j and bpp[i][j] > bpp_cutoff.
+    '''
+    bpp = np.array( bpp, dtype = float )
+    ( i, j ) = np.nonzero( np.triu( bpp, 1 ) > bpp_cutoff )
+    return ( i.astype( np.int32 ), j.astype( np.int32 ), bpp[ i, j ] )
 
 def output_bpp_plot( self ):
     import matplotlib.pyplot as plt
     import seaborn as sns
     f, ax = plt.subplots(dpi=50)
     sns.heatmap( self.bpp, linewidths=0.1,square=True, vmin=0, vmax=1,ax=ax)
-    bpp_fig_file = 'bpp.png'
+    bpp_fig_file = os.path.splitext( self.bpp_file )[ 0 ] + '.png'
     plt.savefig( bpp_fig_file )
     print( 'Outputted base pair probability heatmap to: ', bpp_fig_file )
 
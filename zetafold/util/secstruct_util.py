@@ -1,3 +1,75 @@
+import numpy as np
+
+##################################################################################################
+# Base pairs are stored as a pair table: an integer array with the partner of each position,
+#  or -1 if the position is unpaired. Conversions to and from dot-parens and lists of base pairs
+#  go through the pair table, and take time linear in N.
+##################################################################################################
+def pair_table_from_secstruct( secstruct ):
+    '''
+    Convert dot-paren secstruct into pair table.
+    '''
+    pair_table = np.full( len( secstruct ), -1, dtype = int )
+    leftbrackets = []
+    for i,char in enumerate( secstruct ):
+        if char == ')':
+            j = leftbrackets.pop()
+            pair_table[ i ] = j
+            pair_table[ j ] = i
+        elif char == '(':
+            leftbrackets.append( i )
+    assert( len( leftbrackets ) == 0 )
+    return pair_table
+
+def pair_tables_from_secstructs( secstructs ):
+    '''
+    Pair tables for many dot-paren secstructs of the same length at once, as a 2D array with one row per secstruct.
+
+    Each '(' at depth d (after opening) pairs with the next ')' at depth d (before closing) in the
+     same secstruct, so sorting brackets by secstruct, depth, and position lines up partners next to each other.
+    '''
+    if len( secstructs ) == 0: return np.zeros( ( 0, 0 ), dtype = int )
+    N = len( secstructs[ 0 ] )
+    assert( all( len( secstruct ) == N for secstruct in secstructs ) )
+    chars = np.frombuffer( ''.join( secstructs ), dtype = 'S1' ).reshape( len( secstructs ), N )
+    num_structs = len( secstructs )
+    pair_table = np.full( ( num_structs, N ), -1, dtype = int )
+    is_open = ( chars == '(' )
+    is_close = ( chars == ')' )
+    depth = np.cumsum( is_open.astype( int ) - is_close.astype( int ), axis = 1 )
+    assert( np.all( depth >= 0 ) and np.all( depth[:,-1] == 0 ) )
+    depth[ is_close ] += 1
+
+    ( rows, cols ) = np.nonzero( is_open | is_close )
+    order = np.lexsort( ( cols, depth[ rows, cols ], rows ) )
+    ( rows, cols ) = ( rows[ order ], cols[ order ] )
+    ( rows, left, right ) = ( rows[ 0::2 ], cols[ 0::2 ], cols[ 1::2 ] )
+    assert( np.all( is_open[ rows, left ] ) and np.all( is_close[ rows, right ] ) )
+    pair_table[ rows, left ] = right
+    pair_table[ rows, right ] = left
+    return pair_table
+
+def pair_table_from_bps( bps, N ):
+    pair_table = np.full( N, -1, dtype = int )
+    for i,j in bps:
+        pair_table[ i ] = j
+        pair_table[ j ] = i
+    return pair_table
+
+def bps_from_pair_table( pair_table ):
+    '''
+    Sorted list of base pairs (i,j), with i < j.
+    '''
+    i = np.nonzero( pair_table > np.arange( len( pair_table ) ) )[ 0 ]
+    return zip( i.tolist(), pair_table[ i ].tolist() )
+
+def secstruct_from_pair_table( pair_table ):
+    secstruct = np.full( len( pair_table ), '.', dtype = 'S1' )
+    idx = np.arange( len( pair_table ) )
+    secstruct[ ( pair_table >= 0 ) & ( pair_table > idx ) ] = '('
+    secstruct[ ( pair_table >= 0 ) & ( pair_table < idx ) ] = ')'
+    return secstruct.tostring()
+
 def secstruct_from_bps( bps, N ):
     '''
     Convert list of base pairs to dot-paren string. N is length of RNA.
@@ -14,40 +86,38 @@ def bps_from_secstruct( secstruct ):
     '''
     Convert dot-paren secstruct into sorted list of base pairs
     '''
-    bps_list = []
-    N = len ( secstruct )
-    leftbrackets = []
-    for i,char in enumerate( secstruct ):
-        if char == ')':
-            bps_list.append( (leftbrackets[-1],i) )
-            leftbrackets = leftbrackets[:-1]
-        elif char == '(':
-            leftbrackets.append( i )
-    assert( len( leftbrackets ) == 0 )
-    bps_list.sort()
-    return bps_list
+    return bps_from_pair_table( pair_table_from_secstruct( secstruct ) )
 
 def get_structure_string( structure ):
     if structure == None: return None
     if isinstance( structure, list ): structure = ''.join( structure )
     return structure.replace( ' ','' ).replace('+','').replace(',','')
 
+def get_pair_table( structure ):
+    '''
+    Pair table for structure given as dot-parens (possibly with strand breaks) or already as a pair table.
+    '''
+    if structure is None: return None
+    if isinstance( structure, np.ndarray ): return np.asarray( structure, dtype = int )
+    return pair_table_from_secstruct( get_structure_string( structure ) )
+
 def parse_motifs( secstruct, N = 0 ):
     '''
     Parse secstruct into its structural motifs:
       hairpins, interior loops, multiway junctions, exterior strands
+    secstruct can be a dot-paren string, a list of base pairs (then give N), or a pair table.
     '''
-    if isinstance( secstruct, list ):
-        bps_list = secstruct
+    if isinstance( secstruct, np.ndarray ):
+        pair_table = secstruct
+        N = len( pair_table )
+    elif isinstance( secstruct, list ):
         assert( N > 0 ) # must provide N if secstruct is entered as a list.
+        pair_table = pair_table_from_bps( secstruct, N )
     else:
         assert( isinstance( secstruct, str ) )
-        bps_list = bps_from_secstruct( secstruct )
+        pair_table = pair_table_from_secstruct( secstruct )
         N = len( secstruct )
-    pair_map = {}
-    for i,j in bps_list:
-        pair_map[i] = j
-        pair_map[j] = i
+    pair_table = pair_table.tolist() # plain list indexing is faster than numpy for single elements
 
     motifs = []
     motif = []
@@ -60,24 +130,24 @@ def parse_motifs( secstruct, N = 0 ):
             continue
         # continue down a strand until we hit a base pair
         strand.append( i )
-        if i != strand[ 0 ] and i in pair_map.keys():
+        if i != strand[ 0 ] and pair_table[ i ] >= 0:
             # OK found a base pair, first strand is defined
             motif.append( strand )
             motif_start = strand[0]
-            j = pair_map[i]
+            j = pair_table[i]
             strand = []
             # now follow it around until either we come back (cycle) or hit N (exterior loop)
             while j != motif_start:
                 strand.append( j )
                 j = (j + 1) % N
                 strand.append( j )
-                while not j in pair_map.keys() and j != motif_start:
+                while pair_table[ j ] < 0 and j != motif_start:
                     j = ( j + 1 ) % N
                     strand.append( j )
                 motif.append( strand )
                 strand = []
                 if j == motif_start: break
-                j = pair_map[ j ]
+                j = pair_table[ j ]
             if motif[-1][-1] == motif[0][0]:
                 # merge last and first strand (they form a cycle that goes across the circle from N-1 back around to 0)
                 motif[0] = motif[-1][:-1] + motif[0]
@@ -91,3 +161,27 @@ def parse_motifs( secstruct, N = 0 ):
     motifs.sort()
     return motifs
 
+
+def get_allow_base_pair_mask( pair_table, allow_extra_base_pairs = False ):
+    '''
+    N x N boolean array of base pairs that may form when the base pairs in pair_table are forced:
+     just those pairs, or (with allow_extra_base_pairs) also any pair that does not cross them
+     or take the partner of a forced position.
+
+    Two unpaired positions are on the same side of every forced pair exactly when they sit in
+     the same loop, i.e., have the same innermost enclosing forced pair.
+    '''
+    N = len( pair_table )
+    paired = ( pair_table >= 0 )
+    mask = np.zeros( ( N, N ), dtype = bool )
+    if allow_extra_base_pairs:
+        enclosing_pair = np.full( N, -1, dtype = int )
+        stack = [ -1 ]
+        for i,j in enumerate( pair_table.tolist() ):
+            if j > i: stack.append( i )
+            elif 0 <= j < i: stack.pop()
+            else: enclosing_pair[ i ] = stack[ -1 ]
+        mask = ( enclosing_pair[ :, None ] == enclosing_pair[ None, : ] ) & ~paired[ :, None ] & ~paired[ None, : ]
+    i = np.nonzero( paired )[ 0 ]
+    mask[ i, pair_table[ i ] ] = True
+    return mask